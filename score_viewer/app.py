@@ -1,14 +1,44 @@
 # app.py
 import mimetypes
 import logging
+import ast
 import traceback
+import os
+import sys
+import time
+import math
+import heapq
+import ctypes
+import functools
+import base64
+import zipfile
+import concurrent.futures
+import multiprocessing
+import atexit
+import signal
+import hashlib
+import json
+import threading
+import struct
+import array
+import bisect
+import contextlib
+import copy
+import gc
+import io
+import marshal
+import cProfile
+import pstats
+import tracemalloc
 import xml.etree.ElementTree as ET
-from flask import Flask, render_template, request, jsonify, Response
+from collections import OrderedDict
+import numpy as np
+from flask import Flask, render_template, request, jsonify, Response, g
 
 # ==== NUEVO: imports ampliados de music21 ====
 from music21 import (
     converter, stream, note, chord, meter, clef, key, tempo, expressions, duration,
-    harmony, roman, metadata, bar
+    harmony, roman, metadata, bar, volume
 )
 from music21.musicxml import m21ToXml
 import re
@@ -165,6 +195,7 @@ def safe_create_chord_symbol(figure: str, warnings_list=None):
         te = expressions.TextExpression(figure)
         te.placement = 'below'
         warnings_list.append(f"Cifrado inválido '{figure}', mostrado como texto: {str(e)}")
+        metrics.inc('score_viewer_chord_fallbacks_total')
         return te, 'text'
 
 # ============================================================
@@ -339,11 +370,87 @@ def normalize_to_score(obj, warnings_list=None):
     except Exception as e:
         raise TypeError(f"No se pudo normalizar objeto de tipo {type(obj)}: {str(e)}")
 
-def finalize_notation(score: stream.Score) -> stream.Score:
+# Figuras con corchete: dos o más sin barras en un compás indican que faltan barras
+BEAMABLE_TYPES = frozenset({'eighth', '16th', '32nd', '64th', '128th', '256th'})
+
+def measure_notation_needs(measure, bar_ql, key_alters, check_beams, check_accidentals, check_tuplets):
+    """
+    Comprobación barata de si un compás ya está notado (sin llamar a music21.makeNotation).
+    Como makeNotation, confía en el streamStatus de la parte (p. ej. tras leer MusicXML).
+    Devuelve el conjunto de tareas pendientes: 'ties' (duraciones que desbordan el compás
+    o no representables), 'accidentals' (alteraciones sin decidir o becuadros implícitos),
+    'beams' y 'tuplets'.
+    """
+    needs = set()
+    containers = [measure, *measure.voices] if measure.voices else [measure]
+    for container in containers:
+        beamable = beamed = 0
+        tuplet_notes = tuplet_starts = 0
+        state = {}  # (step, octave) → alteración vigente en el compás
+        for el in container.notesAndRests:
+            ql = el.duration.quarterLength
+            if not ql and isinstance(el, harmony.Harmony):
+                continue
+            if el.duration.type in ('complex', 'inexpressible') or \
+                    container.elementOffset(el) + ql > bar_ql + 1e-6:
+                needs.add('ties')
+            if el.isRest or isinstance(el, harmony.Harmony):
+                continue  # los cifrados no llevan barras ni alteraciones escritas
+            if check_beams and ql and el.duration.type in BEAMABLE_TYPES:
+                beamable += 1
+                if el.beams.beamsList:
+                    beamed += 1
+            if check_tuplets and el.duration.tuplets:
+                tuplet_notes += 1
+                if any(t.type in ('start', 'startStop') for t in el.duration.tuplets):
+                    tuplet_starts += 1
+            if not check_accidentals or (el.tie is not None and el.tie.type != 'start'):
+                continue  # continuación de ligadura: no lleva alteración
+            for p in el.pitches:
+                accidental = p.accidental
+                position = (p.step, p.octave)
+                if accidental is not None:
+                    if accidental.displayStatus is None:
+                        needs.add('accidentals')
+                    state[position] = accidental.alter
+                elif state.get(position, key_alters.get(p.step, 0)):
+                    needs.add('accidentals')  # falta el becuadro
+                    state[position] = 0
+        if beamable >= 2 and beamed < beamable:
+            needs.add('beams')  # sin barras o solo en parte: makeBeams decide el compás entero
+        if tuplet_notes and not tuplet_starts:
+            needs.add('tuplets')
+    return needs
+
+def part_notation_needs(part):
+    """Tareas pendientes por compás de una parte: [(compás, needs)]. None si no tiene compases"""
+    measures = list(part.getElementsByClass(stream.Measure))
+    if not measures:
+        return None
+    status = part.streamStatus
+    bar_ql = 4.0
+    key_alters = {}
+    result = []
+    for m in measures:
+        # Compás y armadura vigentes sin búsquedas de contexto (getContextByClass es caro)
+        if m.timeSignature is not None:
+            bar_ql = m.timeSignature.barDuration.quarterLength
+        if m.keySignature is not None:
+            key_alters = {p.step: p.alter for p in m.keySignature.alteredPitches}
+        result.append((m, measure_notation_needs(
+            m, bar_ql, key_alters, check_beams=not status.beams,
+            check_accidentals=not status.accidentals, check_tuplets=not status.tuplets)))
+    return result
+
+def finalize_notation(score: stream.Score, report=None) -> stream.Score:
     """
     Finaliza notación sin destruir barlines personalizados.
     Solo llama makeMeasures si no hay compases ya definidos.
+    Vía rápida: makeNotation solo se ejecuta en las partes con duraciones que
+    desbordan el compás; las alteraciones se rehacen por parte y las barras y
+    grupos de valoración especial compás a compás. Los compases completos no se tocan.
     IMPORTANTE: Maneja BeamException y otros errores de notación.
+    Si se pasa report (dict), recibe measures, skipped, local y full.
     """
     # Solo hacer makeMeasures si no existen Measure
     has_measures = any(isinstance(el, stream.Measure) for part in score.parts for el in part)
@@ -352,22 +459,62 @@ def finalize_notation(score: stream.Score) -> stream.Score:
             score.makeMeasures(inPlace=True)
         except Exception as e:
             app.logger.warning(f"[Finalize] Error en makeMeasures: {e}")
-    
-    # makeNotation puede fallar con BeamException - manejar gracefully
-    try:
-        score.makeNotation(inPlace=True)
-    except Exception as e:
-        app.logger.warning(f"[Finalize] Error en makeNotation (ignorado): {e}")
-        # Intentar makeBeams individual para cada parte
-        for part in score.parts:
+
+    stats = {'measures': 0, 'skipped': 0, 'local': 0, 'full': 0}
+    parts = list(score.parts) or [score]
+    for part in parts:
+        needs = part_notation_needs(part)
+        if needs is None or any('ties' in n for _, n in needs):
+            # Las ligaduras parten notas entre compases vecinos: parte completa
+            count = len(needs) if needs is not None else len(part.getElementsByClass(stream.Measure))
+            stats['measures'] += count
+            stats['full'] += count
+            # makeNotation puede fallar con BeamException - manejar gracefully
             try:
+                part.makeNotation(inPlace=True)
+            except Exception as e:
+                app.logger.warning(f"[Finalize] Error en makeNotation (ignorado): {e}")
+                # Intentar makeBeams individual para cada compás
                 for measure in part.getElementsByClass(stream.Measure):
                     try:
                         measure.makeBeams(inPlace=True)
                     except Exception:
                         pass  # Ignorar errores de beams individuales
-            except Exception:
-                pass
+            continue
+
+        if any('accidentals' in n for _, n in needs):
+            # Las alteraciones arrastran estado entre compases: una pasada por la parte
+            try:
+                stream.makeNotation.makeAccidentalsInMeasureStream(part)
+            except Exception as e:
+                app.logger.warning(f"[Finalize] Error en makeAccidentals (ignorado): {e}")
+
+        for measure, measure_needs in needs:
+            stats['measures'] += 1
+            if not measure_needs:
+                stats['skipped'] += 1
+                continue
+            stats['local'] += 1
+            try:
+                if 'beams' in measure_needs:
+                    measure.makeBeams(inPlace=True)
+                if 'tuplets' in measure_needs:
+                    for container in [measure, *measure.voices]:
+                        stream.makeNotation.makeTupletBrackets(container, inPlace=True)
+            except Exception as e:
+                app.logger.warning(f"[Finalize] Error en compás {measure.number} (ignorado): {e}")
+        # Todo verificado o rehecho: el exportador no tiene que repetirlo
+        part.streamStatus.beams = True
+        part.streamStatus.accidentals = True
+        part.streamStatus.tuplets = True
+
+    if stats['full'] or stats['local']:
+        score.coreElementsChanged()
+    app.logger.info(
+        f"[Finalize] 📐 {stats['skipped']}/{stats['measures']} compases ya notados, "
+        f"{stats['local']} retocados, {stats['full']} con makeNotation completo")
+    if report is not None:
+        report.update(stats)
     return score
 
 def separate_fused_texts(xml_text: str) -> str:
@@ -378,11 +525,13 @@ def separate_fused_texts(xml_text: str) -> str:
     app.logger.info("[Separate Texts] Función desactivada - confiar en IDs del usuario")
     return xml_text
 
-def deduplicate_words_in_xml(xml_text: str) -> str:
+def deduplicate_words_in_xml(xml_text: str, layout_stats=None) -> str:
     """
     Elimina <direction-type><words> duplicados dentro del mismo compás.
     Mantiene solo el primero cuando coincidan texto y placement.
     AGRESIVO: Elimina TODO duplicado encontrado, sin importar estructura.
+    Si se pasa layout_stats (dict), lo rellena en esta misma pasada
+    (ver collect_measure_layout_stats).
     """
     try:
         # Extraer declaración XML y DOCTYPE si existen
@@ -426,6 +575,15 @@ def deduplicate_words_in_xml(xml_text: str) -> str:
                 # Eliminar duplicados
                 for direction in to_remove:
                     measure.remove(direction)
+                
+                if layout_stats is not None:
+                    collect_measure_layout_stats(measure, layout_stats)
+            
+            if layout_stats is not None:
+                layout_stats['parts'] = layout_stats.get('parts', 0) + 1
+        
+        if layout_stats is not None:
+            finish_layout_stats(layout_stats)
         
         if total_removed > 0:
             app.logger.info(f"[Dedup XML] Total eliminados: {total_removed}")
@@ -437,8 +595,48 @@ def deduplicate_words_in_xml(xml_text: str) -> str:
         return xml_declaration + doctype + xml_body
     except Exception as e:
         app.logger.warning(f"No se pudo deduplicar words: {e}")
+        if layout_stats is not None:
+            layout_stats.clear()
         return xml_text
 
+def collect_measure_layout_stats(measure, stats):
+    """
+    Acumula en stats la densidad de un <measure> (una sola pasada por sus nodos).
+    Misma heurística de ancho que analyzeMusicXML en main.js:
+    100 + 15·notas + 20·acordes + 10·alteraciones + 15·textos.
+    """
+    notes = harmonies = accidentals = words = 0
+    for el in measure.iter():
+        tag = el.tag
+        if tag == 'note':
+            notes += 1
+        elif tag == 'harmony':
+            harmonies += 1
+        elif tag == 'accidental':
+            accidentals += 1
+        elif tag == 'words':
+            words += 1
+    
+    stats['measure_elements'] = stats.get('measure_elements', 0) + 1
+    stats['notes'] = stats.get('notes', 0) + notes
+    stats['harmonies'] = stats.get('harmonies', 0) + harmonies
+    stats['accidentals'] = stats.get('accidentals', 0) + accidentals
+    stats['words'] = stats.get('words', 0) + words
+    stats['max_notes_per_measure'] = max(stats.get('max_notes_per_measure', 0), notes)
+    stats['total_complexity'] = stats.get('total_complexity', 0) + (
+        100 + notes * 15 + harmonies * 20 + accidentals * 10 + words * 15
+    )
+
+def finish_layout_stats(stats):
+    """Completa los valores derivados (medias y densidades por compás)"""
+    count = stats.get('measure_elements', 0)
+    parts = stats.get('parts', 0) or 1
+    stats['measures'] = count // parts
+    stats['avg_measure_width'] = round(stats.get('total_complexity', 0) / count, 1) if count else 150
+    stats['chord_density'] = round(stats.get('harmonies', 0) / count, 2) if count else 0
+    stats['text_density'] = round(stats.get('words', 0) / count, 2) if count else 0
+    return stats
+
 def adjust_text_offsets(score: stream.Score, warnings_list=None) -> stream.Score:
     """
     Ajusta offsets de TextExpression para evitar fusión.
@@ -546,32 +744,50 @@ def deduplicate_in_memory(score: stream.Score, warnings_list=None) -> stream.Sco
     
     return score
 
-def to_musicxml_string(obj, warnings_list=None) -> str:
+def to_musicxml_string(obj, warnings_list=None, layout_stats=None, score_out=None) -> str:
     """
     Normaliza a Score, aplica defaults, deduplica EN MEMORIA, exporta a MusicXML.
+    Si se pasa layout_stats (dict), se rellena con las pistas de layout
+    calculadas durante la deduplicación XML (sin parseo adicional).
+    Si se pasa score_out (dict), recibe en 'score' el Score normalizado,
+    para derivar otros formatos sin volver a parsear el XML, y en 'notation'
+    el informe de finalize_notation (compases ya notados que se saltaron).
     """
     if warnings_list is None:
         warnings_list = []
+    warnings_before = len(warnings_list)
     
-    s = normalize_to_score(obj, warnings_list)
-    s = add_defaults_to_score(s, warnings_list)
-    s = finalize_notation(s)
+    notation_report = {}
+    with pipeline_stage('normalize'):
+        s = normalize_to_score(obj, warnings_list)
+        s = add_defaults_to_score(s, warnings_list)
+    with pipeline_stage('notation'):
+        s = finalize_notation(s, notation_report)
     
-    # Ajustar offsets para evitar fusión de TextExpression
-    s = adjust_text_offsets(s, warnings_list)
+    with pipeline_stage('cleanup'):
+        # Ajustar offsets para evitar fusión de TextExpression
+        s = adjust_text_offsets(s, warnings_list)
+        
+        # Deduplicar en memoria ANTES de exportar
+        s = deduplicate_in_memory(s, warnings_list)
     
-    # Deduplicar en memoria ANTES de exportar
-    s = deduplicate_in_memory(s, warnings_list)
+    with pipeline_stage('export'):
+        exporter = m21ToXml.GeneralObjectExporter(s)
+        xml_bytes = exporter.parse()
+        xml_text = xml_bytes.decode('utf-8')
     
-    exporter = m21ToXml.GeneralObjectExporter(s)
-    xml_bytes = exporter.parse()
-    xml_text = xml_bytes.decode('utf-8')
+    with pipeline_stage('xml_postprocess'):
+        # Separar textos fusionados (ej: "Imaj7 Jónico" → separados)
+        xml_text = separate_fused_texts(xml_text)
+        
+        # Mantener deduplicación XML como red de seguridad
+        xml_text = deduplicate_words_in_xml(xml_text, layout_stats)
     
-    # Separar textos fusionados (ej: "Imaj7 Jónico" → separados)
-    xml_text = separate_fused_texts(xml_text)
+    metrics.inc('score_viewer_normalization_warnings_total', value=len(warnings_list) - warnings_before)
     
-    # Mantener deduplicación XML como red de seguridad
-    xml_text = deduplicate_words_in_xml(xml_text)
+    if score_out is not None:
+        score_out['score'] = s
+        score_out['notation'] = notation_report
     
     return xml_text
 
@@ -647,12 +863,127 @@ def SafeChordSymbol(figure, **kwargs):
         element = expressions.TextExpression(figure)
         element.placement = kwargs.get('placement', 'above')
         app.logger.warning(f"[SafeChordSymbol] ⚠️ Cifrado '{figure}' no reconocido, fallback a TextExpression: {str(e)}")
+        metrics.inc('score_viewer_chord_fallbacks_total')
         return element
 
-def run_music21_snippet_any(code: str):
+# ============================================================
+# ======== PRE-PROCESADO AST DEL SNIPPET (CON CACHÉ) =========
+# ============================================================
+
+SNIPPET_CACHE_MAX_ENTRIES = 64
+_snippet_cache = OrderedDict()  # sha256(código) → resultado de compile_snippet
+_snippet_cache_lock = threading.Lock()
+
+def _is_call_to(node, module_name, attr):
+    """True si node es una llamada module_name.attr(...)"""
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+            and node.func.attr == attr and isinstance(node.func.value, ast.Name)
+            and node.func.value.id == module_name)
+
+def preprocess_snippet(code: str):
+    """
+    Una sola pasada AST sobre el snippet:
+      1. Quita 'harmony' de 'from music21 import ...' (se usa SafeHarmony del namespace)
+      2. Auto-inicializa metadata tras 'x = stream.Score()' si el código usa
+         x.metadata.title/composer sin crear nunca un Metadata
+      3. Extrae las asignaciones simples (línea 0-based → nombres de variable)
+    Devuelve (tree, assignments, warnings). Las líneas son las del código original.
+    """
+    tree = ast.parse(code, filename='<snippet>')
+    
+    harmony_imports = []   # (lista contenedora, sentencia)
+    score_assigns = []     # (lista contenedora, sentencia)
+    assignments = {}
+    has_metadata_use = False
+    has_metadata_init = False
+    
+    for node in ast.walk(tree):
+        # Sentencias dentro de bloques (para poder quitar/insertar después)
+        for field in ('body', 'orelse', 'finalbody'):
+            block = getattr(node, field, None)
+            if not isinstance(block, list):
+                continue
+            for stmt in block:
+                if (isinstance(stmt, ast.ImportFrom) and stmt.module == 'music21' and not stmt.level
+                        and any(alias.name == 'harmony' and alias.asname is None for alias in stmt.names)):
+                    harmony_imports.append((block, stmt))
+                elif (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1
+                        and _is_call_to(stmt.value, 'stream', 'Score')
+                        and not stmt.value.args and not stmt.value.keywords):
+                    score_assigns.append((block, stmt))
+        
+        if isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            names = [t.id for t in targets if isinstance(t, ast.Name)]
+            if names:
+                assignments.setdefault(node.lineno - 1, []).extend(names)
+            if any(isinstance(t, ast.Attribute) and t.attr == 'metadata' for t in targets):
+                has_metadata_init = True
+        elif (isinstance(node, ast.Attribute) and node.attr in ('title', 'composer')
+                and isinstance(node.value, ast.Attribute) and node.value.attr == 'metadata'):
+            has_metadata_use = True
+        elif _is_call_to(node, 'metadata', 'Metadata'):
+            has_metadata_init = True
+    
+    warnings_list = []
+    
+    # 1. Filtrar harmony de los imports
+    for block, stmt in harmony_imports:
+        stmt.names = [alias for alias in stmt.names if not (alias.name == 'harmony' and alias.asname is None)]
+        if stmt.names:
+            app.logger.info(f"[SafeChordSymbol] Import modificado: {ast.unparse(stmt)}")
+        else:
+            app.logger.info(f"[SafeChordSymbol] Import vacío después de remover harmony, skipped")
+            position = block.index(stmt)
+            block[position] = ast.copy_location(ast.Pass(), stmt)
+    
+    # 2. Auto-inicializar metadata si falta
+    if has_metadata_use and not has_metadata_init:
+        for block, stmt in score_assigns:
+            var_name = ast.unparse(stmt.targets[0])
+            init = ast.parse(f'{var_name}.metadata = metadata.Metadata()').body[0]
+            for child in ast.walk(init):
+                ast.copy_location(child, stmt)
+            block.insert(block.index(stmt) + 1, init)
+            warnings_list.append(f"Metadata inicializada automáticamente para '{var_name}'")
+            app.logger.info(f"[Auto-init] Metadata agregada para '{var_name}'")
+    
+    return tree, sorted(assignments.items()), warnings_list
+
+def compile_snippet(code: str):
     """
-    Ejecuta el snippet y devuelve (xml_text:str, warnings:list, error:str|None).
+    Pre-procesa y compila el snippet, cacheando el code object por hash del código.
+    Devuelve dict {'code', 'assignments', 'warnings'} (compartido: no mutar).
+    """
+    code_hash = hashlib.sha256(code.encode('utf-8')).hexdigest()
+    with _snippet_cache_lock:
+        cached = _snippet_cache.get(code_hash)
+        if cached is not None:
+            _snippet_cache.move_to_end(code_hash)
+            app.logger.info(f"[Snippet Cache] HIT {code_hash[:8]}")
+            record_cache_lookup('snippet', True)
+            return cached
+    record_cache_lookup('snippet', False)
+    
+    tree, assignments, warnings_list = preprocess_snippet(code)
+    compiled = {
+        'code': compile(tree, '<snippet>', 'exec'),
+        'assignments': assignments,
+        'warnings': warnings_list
+    }
+    
+    with _snippet_cache_lock:
+        _snippet_cache[code_hash] = compiled
+        while len(_snippet_cache) > SNIPPET_CACHE_MAX_ENTRIES:
+            _snippet_cache.popitem(last=False)
+    return compiled
+
+def run_music21_snippet_any(code: str, layout_stats=None, score_out=None):
+    """
+    Ejecuta el snippet y devuelve (xml_text:str, warnings:list, error:str|None, line_map:dict).
     Acepta score/obj/xml/mxl/path en el namespace del usuario.
+    layout_stats (dict opcional) recibe las pistas de layout del export.
+    score_out (dict opcional) recibe el Score normalizado (no con 'xml' crudo).
     """
     # IMPORTANTE: Crear clase SafeHarmony que envuelve harmony
     class SafeHarmony:
@@ -687,72 +1018,24 @@ def run_music21_snippet_any(code: str):
     warnings_list = []
     
     try:
-        # NUEVO: Pre-procesar código
-        lines = code.split('\n')
-        modified_lines = []
-        
-        for line in lines:
-            # 1. Si importa harmony, NO agregarlo (usaremos SafeHarmony del namespace)
-            if 'from music21 import' in line and 'harmony' in line:
-                # Enfoque robusto: split por import, parsear lista, filtrar harmony, reconstruir
-                match = re.match(r'^(\s*from\s+music21\s+import\s+)(.+)$', line)
-                if match:
-                    prefix = match.group(1)
-                    imports_str = match.group(2)
-                    
-                    # Dividir imports por coma
-                    imports = [imp.strip() for imp in imports_str.split(',')]
-                    # Filtrar harmony
-                    imports_filtered = [imp for imp in imports if imp != 'harmony']
-                    
-                    if imports_filtered:
-                        # Reconstruir línea
-                        line = prefix + ', '.join(imports_filtered)
-                        app.logger.info(f"[SafeChordSymbol] Import modificado: {line.strip()}")
-                    else:
-                        # Si no queda nada, skip línea
-                        app.logger.info(f"[SafeChordSymbol] Import vacío después de remover harmony, skipped")
-                        continue
-            
-            modified_lines.append(line)
-            
-            # 2. Auto-inicializar metadata si falta
-            if 'stream.Score()' in line and '=' in line:
-                var_name = line.split('=')[0].strip()
-                # Verificar si hay metadata.title más adelante
-                has_metadata_use = any('.metadata.title' in l or '.metadata.composer' in l for l in lines)
-                has_metadata_init = any('metadata.Metadata()' in l or '.metadata =' in l for l in lines)
-                
-                if has_metadata_use and not has_metadata_init:
-                    indent = len(line) - len(line.lstrip())
-                    modified_lines.append(' ' * indent + f'{var_name}.metadata = metadata.Metadata()')
-                    warnings_list.append(f"Metadata inicializada automáticamente para '{var_name}'")
-                    app.logger.info(f"[Auto-init] Metadata agregada para '{var_name}'")
+        # Pre-procesar con AST (cacheado por hash del código) y ejecutar
+        with pipeline_stage('compile'):
+            compiled = compile_snippet(code)
+        warnings_list.extend(compiled['warnings'])
         
-        code = '\n'.join(modified_lines)
+        with pipeline_stage('exec'):
+            exec(compiled['code'], ns, ns)
         
-        exec(code, ns, ns)
-        
-        # ✅ CREAR MAPEO: ID del elemento → número de línea
+        # ✅ CREAR MAPEO: ID del elemento → número de línea (0-based, del código original)
         element_line_map = {}
-        lines = code.split('\n')
-        
-        for line_num, line in enumerate(lines):
-            line_stripped = line.strip()
-            
-            # Detectar asignaciones (c1 =, tx1 =, n =, etc.)
-            if '=' in line and not line_stripped.startswith('#'):
-                match = re.match(r'^(\s*)(\w+)\s*=\s*', line)
-                if match:
-                    var_name = match.group(2)
-                    
-                    if var_name in ns:
-                        obj = ns[var_name]
-                        
-                        # Si tiene ID (.id property)
-                        if isinstance(obj, M21_TYPES) and hasattr(obj, 'id') and obj.id:
-                            element_line_map[obj.id] = line_num
-                            app.logger.info(f"[Line Map] {obj.id} → línea {line_num}")
+        for line_num, var_names in compiled['assignments']:
+            for var_name in var_names:
+                obj = ns.get(var_name)
+                
+                # Si tiene ID (.id property)
+                if isinstance(obj, M21_TYPES) and hasattr(obj, 'id') and obj.id:
+                    element_line_map[obj.id] = line_num
+                    app.logger.info(f"[Line Map] {obj.id} → línea {line_num}")
         
         # Guardar mapeo en namespace global (para devolver luego)
         ns['__element_line_map__'] = element_line_map
@@ -760,11 +1043,11 @@ def run_music21_snippet_any(code: str):
         kind, value = find_first_music21_object(ns)
 
         if kind == "score":
-            xml_text = to_musicxml_string(value, warnings_list)
+            xml_text = to_musicxml_string(value, warnings_list, layout_stats, score_out)
             return xml_text, warnings_list, None, element_line_map
 
         if kind == "obj":
-            xml_text = to_musicxml_string(value, warnings_list)
+            xml_text = to_musicxml_string(value, warnings_list, layout_stats, score_out)
             return xml_text, warnings_list, None, element_line_map
 
         if kind == "xml":
@@ -772,19 +1055,986 @@ def run_music21_snippet_any(code: str):
             return value, [], None, element_line_map
 
         if kind == "path":
-            xml_text = to_musicxml_string(value, warnings_list)
+            xml_text = to_musicxml_string(value, warnings_list, layout_stats, score_out)
             return xml_text, warnings_list, None, element_line_map
 
         if kind == "mxl":
-            from io import BytesIO
-            sc = converter.parse(BytesIO(value))
-            xml_text = to_musicxml_string(sc, warnings_list)
+            sc = converter.parse(read_mxl(value), format='musicxml')
+            xml_text = to_musicxml_string(sc, warnings_list, layout_stats, score_out)
             return xml_text, warnings_list, None, element_line_map
 
         return None, warnings_list, "No se encontró ningún objeto de music21, 'xml' o 'path' en el código.", {}
     except Exception:
         return None, warnings_list, traceback.format_exc(), {}
 
+# ============================================================
+# ========= CONTROL DE ADMISIÓN Y BACKPRESSURE (RENDER) ======
+# ============================================================
+
+# Configurables vía app.config o variables de entorno SCORE_VIEWER_<CLAVE>
+app.config.setdefault('ADMISSION_MAX_IN_FLIGHT', 2)       # pipelines music21 simultáneos
+app.config.setdefault('ADMISSION_MAX_QUEUE', 8)           # peticiones en espera (todas las prioridades)
+app.config.setdefault('ADMISSION_QUEUE_TIMEOUT', 30.0)    # segundos máximos en cola
+app.config.setdefault('ADMISSION_CPU_LIMIT', 60.0)        # segundos de CPU por petición (None = sin límite)
+app.config.setdefault('ADMISSION_RSS_LIMIT_MB', 2048)     # techo de RSS del PROCESO (None = sin límite)
+app.config.from_prefixed_env('SCORE_VIEWER')
+
+# Menor número = mayor prioridad
+ADMISSION_PRIORITIES = {'interactive': 0, 'export': 1, 'batch': 2}
+
+class AdmissionRejected(Exception):
+    """Servidor saturado: la petición no se admite (→ 429 + Retry-After)"""
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class RequestLimitExceeded(BaseException):
+    """
+    Se lanza de forma asíncrona en el hilo de la petición al superar el techo de
+    CPU o memoria. Hereda de BaseException para atravesar los 'except Exception'
+    del pipeline (y de music21) y cortar el trabajo de verdad.
+    """
+
+# ---------- Medidas por plataforma: RSS actual y CPU por hilo ----------
+# Linux: /proc y pthread_getcpuclockid. macOS: task_info/thread_info de Mach.
+# Windows: GetProcessMemoryInfo/GetThreadTimes. Todo vía ctypes (sin psutil).
+
+class _MachTimeValue(ctypes.Structure):
+    _fields_ = [('seconds', ctypes.c_int), ('microseconds', ctypes.c_int)]
+
+class _MachTaskBasicInfo(ctypes.Structure):
+    _pack_ = 4
+    _fields_ = [('virtual_size', ctypes.c_uint64), ('resident_size', ctypes.c_uint64),
+                ('resident_size_max', ctypes.c_uint64), ('user_time', _MachTimeValue),
+                ('system_time', _MachTimeValue), ('policy', ctypes.c_int), ('suspend_count', ctypes.c_int)]
+
+class _MachThreadBasicInfo(ctypes.Structure):
+    _fields_ = [('user_time', _MachTimeValue), ('system_time', _MachTimeValue), ('cpu_usage', ctypes.c_int),
+                ('policy', ctypes.c_int), ('run_state', ctypes.c_int), ('flags', ctypes.c_int),
+                ('suspend_count', ctypes.c_int), ('sleep_time', ctypes.c_int)]
+
+class _ProcessMemoryCounters(ctypes.Structure):
+    _fields_ = [('cb', ctypes.c_uint32), ('PageFaultCount', ctypes.c_uint32)] + [
+        (name, ctypes.c_size_t) for name in (
+            'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+            'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+
+MACH_TASK_BASIC_INFO = 20
+MACH_THREAD_BASIC_INFO = 3
+WINDOWS_THREAD_QUERY_LIMITED_INFORMATION = 0x0800
+
+@functools.lru_cache(maxsize=1)
+def _platform_api():
+    """Bibliotecas del sistema para las medidas sin /proc (None si no están)"""
+    try:
+        if sys.platform == 'darwin':
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'))
+            libc.pthread_mach_thread_np.restype = ctypes.c_uint
+            libc.pthread_mach_thread_np.argtypes = [ctypes.c_void_p]
+            return {'libc': libc, 'task': ctypes.c_uint.in_dll(libc, 'mach_task_self_').value}
+        if sys.platform == 'win32':
+            kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+            kernel32.GetCurrentProcess.restype = ctypes.c_void_p
+            kernel32.OpenThread.restype = ctypes.c_void_p
+            kernel32.OpenThread.argtypes = [ctypes.c_uint32, ctypes.c_int, ctypes.c_uint32]
+            kernel32.GetThreadTimes.argtypes = [ctypes.c_void_p] + [ctypes.POINTER(ctypes.c_uint64)] * 4
+            kernel32.CloseHandle.argtypes = [ctypes.c_void_p]
+            kernel32.K32GetProcessMemoryInfo.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint32]
+            return {'kernel32': kernel32}
+    except (OSError, AttributeError, ValueError):
+        app.logger.warning("[Admisión] ⚠️ No se pudieron cargar las APIs del sistema para medir RSS/CPU")
+    return None
+
+_cpu_fallback_warned = False
+
+def _thread_cpu_time(thread_ident, native_id=None):
+    """
+    Tiempo de CPU consumido por un hilo (None si la plataforma no lo permite).
+    thread_ident: threading.get_ident(); native_id: threading.get_native_id() (Windows).
+    """
+    global _cpu_fallback_warned
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread_ident))
+    except (AttributeError, OSError):
+        pass
+    api = _platform_api()
+    try:
+        if api and 'libc' in api:
+            info = _MachThreadBasicInfo()
+            count = ctypes.c_uint(ctypes.sizeof(info) // ctypes.sizeof(ctypes.c_int))
+            port = api['libc'].pthread_mach_thread_np(thread_ident)
+            if port and api['libc'].thread_info(port, MACH_THREAD_BASIC_INFO, ctypes.byref(info), ctypes.byref(count)) == 0:
+                return (info.user_time.seconds + info.system_time.seconds
+                        + (info.user_time.microseconds + info.system_time.microseconds) / 1e6)
+        elif api and native_id is not None:
+            kernel32 = api['kernel32']
+            handle = kernel32.OpenThread(WINDOWS_THREAD_QUERY_LIMITED_INFORMATION, False, native_id)
+            if handle:
+                try:
+                    times = [ctypes.c_uint64() for _ in range(4)]  # creación, fin, kernel, usuario
+                    if kernel32.GetThreadTimes(handle, *[ctypes.byref(t) for t in times]):
+                        return (times[2].value + times[3].value) / 1e7  # unidades de 100 ns
+                finally:
+                    kernel32.CloseHandle(handle)
+    except (OSError, AttributeError, ctypes.ArgumentError):
+        pass
+    if not _cpu_fallback_warned:
+        _cpu_fallback_warned = True
+        app.logger.warning("[Admisión] ⚠️ Sin tiempo de CPU por hilo en esta plataforma: "
+                           "ADMISSION_CPU_LIMIT se aplica sobre tiempo real")
+    return None
+
+def _current_rss_bytes():
+    """RSS ACTUAL del proceso (no el pico) en Linux, macOS y Windows; None si no se puede medir"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    api = _platform_api()
+    try:
+        if api and 'libc' in api:
+            info = _MachTaskBasicInfo()
+            count = ctypes.c_uint(ctypes.sizeof(info) // ctypes.sizeof(ctypes.c_int))
+            if api['libc'].task_info(api['task'], MACH_TASK_BASIC_INFO, ctypes.byref(info), ctypes.byref(count)) == 0:
+                return info.resident_size
+        elif api:
+            counters = _ProcessMemoryCounters()
+            counters.cb = ctypes.sizeof(counters)
+            kernel32 = api['kernel32']
+            if kernel32.K32GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+                return counters.WorkingSetSize
+    except (OSError, AttributeError, ctypes.ArgumentError):
+        pass
+    return None
+
+class AdmissionController:
+    """
+    Limita los pipelines de render concurrentes.
+    - Máximo de peticiones en curso; el resto espera en una cola acotada
+      ordenada por prioridad (interactive > export > batch) y por llegada.
+    - Cola llena o espera demasiado larga → AdmissionRejected (429 rápido).
+    - Un watchdog aborta las peticiones que superan el techo de CPU (por hilo).
+    - ADMISSION_RSS_LIMIT_MB es una guarda del PROCESO, no por petición: el RSS es
+      global y no se puede atribuir a un hilo. Por encima del techo no se admite
+      nada nuevo mientras haya peticiones en curso (se espera a que liberen), y solo
+      se aborta una petición si es la única en curso y fue ella quien cruzó el
+      techo: así una petición pesada nunca provoca que se mate a otra concurrente.
+    """
+    def __init__(self, config):
+        self.config = config
+        self._cond = threading.Condition()
+        self._waiting = []          # heap de (prioridad, secuencia)
+        self._seq = 0
+        self._active = {}           # ticket → info de la petición en curso
+        self._watchdog = None
+        self.stats = {
+            'admitted': 0, 'rejected': 0, 'timeouts': 0, 'aborted': 0,
+            'wait_ms_avg': 0.0, 'wait_ms_max': 0.0, 'service_ms_avg': 0.0
+        }
+
+    def _retry_after(self):
+        """Estimación (s) de cuándo habrá hueco, a partir del tiempo medio de servicio"""
+        max_in_flight = max(1, int(self.config['ADMISSION_MAX_IN_FLIGHT']))
+        pending = len(self._waiting) + 1
+        return max(1, math.ceil(self.stats['service_ms_avg'] / 1000.0 * pending / max_in_flight))
+
+    def acquire(self, priority='interactive'):
+        """Bloquea hasta obtener hueco. Devuelve (ticket, info) para release()"""
+        level = ADMISSION_PRIORITIES.get(priority, ADMISSION_PRIORITIES['batch'])
+        enqueued_at = time.perf_counter()
+        with self._cond:
+            max_in_flight = max(1, int(self.config['ADMISSION_MAX_IN_FLIGHT']))
+            if len(self._active) >= max_in_flight or self._waiting:
+                if len(self._waiting) >= int(self.config['ADMISSION_MAX_QUEUE']):
+                    self.stats['rejected'] += 1
+                    raise AdmissionRejected("Servidor saturado, reintentar más tarde.", self._retry_after())
+
+            self._seq += 1
+            entry = (level, self._seq)
+            heapq.heappush(self._waiting, entry)
+            deadline = enqueued_at + float(self.config['ADMISSION_QUEUE_TIMEOUT'])
+
+            while (self._waiting[0] != entry
+                   or len(self._active) >= max(1, int(self.config['ADMISSION_MAX_IN_FLIGHT']))
+                   or self._memory_blocked()):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    self.stats['timeouts'] += 1
+                    self._cond.notify_all()
+                    raise AdmissionRejected("Tiempo de espera en cola agotado.", self._retry_after())
+                self._cond.wait(remaining)
+
+            heapq.heappop(self._waiting)
+            wait_ms = (time.perf_counter() - enqueued_at) * 1000
+            ticket = entry[1]
+            info = self._active[ticket] = {
+                'thread': threading.get_ident(),
+                'native_id': threading.get_native_id(),
+                'priority': priority,
+                'started': time.perf_counter(),
+                'cpu_start': _thread_cpu_time(threading.get_ident(), threading.get_native_id()),
+                'rss_start': _current_rss_bytes(),
+                'wait_ms': wait_ms,
+                'aborted': None
+            }
+            self.stats['admitted'] += 1
+            self.stats['wait_ms_avg'] += (wait_ms - self.stats['wait_ms_avg']) * 0.1
+            self.stats['wait_ms_max'] = max(self.stats['wait_ms_max'], wait_ms)
+            self._cond.notify_all()
+            self._ensure_watchdog()
+            return ticket, info
+
+    def try_acquire(self, priority='batch'):
+        """
+        Hueco adicional sin esperar, o None si no lo hay (ni adelanta a nadie en cola).
+        Para el trabajo que una petición ya admitida reparte en procesos hijos: cada
+        proceso ocupado cuenta como una petición más en curso. El watchdog no lo
+        vigila (no hay hilo propio); el límite de CPU se aplica dentro del hijo.
+        """
+        with self._cond:
+            if (self._waiting or self._memory_blocked()
+                    or len(self._active) >= max(1, int(self.config['ADMISSION_MAX_IN_FLIGHT']))):
+                return None
+            self._seq += 1
+            ticket = self._seq
+            self._active[ticket] = {
+                'thread': None,
+                'native_id': None,
+                'priority': priority,
+                'started': time.perf_counter(),
+                'cpu_start': None,
+                'rss_start': None,
+                'wait_ms': 0.0,
+                'aborted': None
+            }
+            self.stats['admitted'] += 1
+            return ticket
+
+    def _rss_limit_bytes(self):
+        limit_mb = self.config.get('ADMISSION_RSS_LIMIT_MB')
+        return float(limit_mb) * 1024 * 1024 if limit_mb else None
+
+    def _memory_blocked(self):
+        """
+        RSS del proceso por encima del techo con peticiones en curso: esperar a que
+        terminen. Sin nada en curso se admite igualmente (el allocator rara vez
+        devuelve memoria al sistema y el servidor quedaría bloqueado para siempre).
+        """
+        limit = self._rss_limit_bytes()
+        if not limit or not self._active:
+            return False
+        rss = _current_rss_bytes()
+        return rss is not None and rss >= limit
+
+    def release(self, ticket):
+        """
+        Libera el hueco (idempotente). Una vez fuera de _active el watchdog ya no
+        puede apuntar a este hilo, así que se cancela cualquier aborto pendiente.
+        """
+        with self._cond:
+            info = self._active.pop(ticket, None)
+            if info is not None:
+                service_ms = (time.perf_counter() - info['started']) * 1000
+                self.stats['service_ms_avg'] += (service_ms - self.stats['service_ms_avg']) * 0.1
+                if info['aborted']:
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(info['thread']), None)
+            self._cond.notify_all()
+
+    def snapshot(self):
+        """Estado actual: peticiones en curso, profundidad de cola por prioridad y tiempos"""
+        with self._cond:
+            names = {level: name for name, level in ADMISSION_PRIORITIES.items()}
+            depth = {name: 0 for name in ADMISSION_PRIORITIES}
+            for level, _ in self._waiting:
+                depth[names[level]] += 1
+            return {
+                'in_flight': len(self._active),
+                'max_in_flight': int(self.config['ADMISSION_MAX_IN_FLIGHT']),
+                'queue_depth': len(self._waiting),
+                'queue_depth_by_priority': depth,
+                'max_queue': int(self.config['ADMISSION_MAX_QUEUE']),
+                **{k: round(v, 2) if isinstance(v, float) else v for k, v in self.stats.items()}
+            }
+
+    # ---------- Watchdog de CPU / memoria ----------
+    def _ensure_watchdog(self):
+        if self._watchdog is None or not self._watchdog.is_alive():
+            self._watchdog = threading.Thread(target=self._watch, name='admission-watchdog', daemon=True)
+            self._watchdog.start()
+
+    def _watch(self):
+        while True:
+            with self._cond:
+                while not self._active:
+                    self._cond.wait()
+                cpu_limit = self.config.get('ADMISSION_CPU_LIMIT')
+                rss_limit = self._rss_limit_bytes()
+                # Guarda de proceso: solo es atribuible con una única petición en curso
+                rss_now = _current_rss_bytes() if rss_limit and len(self._active) == 1 else None
+
+                for ticket, info in self._active.items():
+                    if info['aborted'] or info['thread'] is None:
+                        continue
+                    reason = None
+                    if cpu_limit:
+                        cpu_now = _thread_cpu_time(info['thread'], info['native_id'])
+                        if cpu_now is None or info['cpu_start'] is None:
+                            used = time.perf_counter() - info['started']  # sin CPU por hilo: tiempo real
+                        else:
+                            used = cpu_now - info['cpu_start']
+                        if used > float(cpu_limit):
+                            reason = f"Límite de CPU superado ({used:.1f}s > {cpu_limit}s)"
+                    if (reason is None and rss_now is not None and info['rss_start'] is not None
+                            and info['rss_start'] < rss_limit <= rss_now):
+                        reason = (f"Límite de memoria del proceso superado "
+                                  f"({rss_now / 1048576:.0f}MB > {rss_limit / 1048576:.0f}MB)")
+                    if reason:
+                        info['aborted'] = reason
+                        self.stats['aborted'] += 1
+                        app.logger.warning(f"[Admisión] Abortando petición {ticket}: {reason}")
+                        ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                            ctypes.c_ulong(info['thread']), ctypes.py_object(RequestLimitExceeded))
+            time.sleep(0.1)
+
+admission = AdmissionController(app.config)
+
+def _release_admission(ticket):
+    """Libera el hueco; el aborto asíncrono puede llegar mientras se libera: reintentar"""
+    while True:
+        try:
+            admission.release(ticket)
+            return
+        except RequestLimitExceeded:
+            pass
+
+def admission_controlled(priority):
+    """
+    Decorador de rutas de render/export: pasa por el control de admisión.
+    Saturado → 429 con Retry-After. Techo de CPU/memoria → 503.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                ticket, info = admission.acquire(priority)
+            except AdmissionRejected as e:
+                app.logger.warning(f"[Admisión] {request.path} rechazada: {e} (Retry-After {e.retry_after}s)")
+                response = jsonify({"error": str(e), "retry_after": e.retry_after})
+                response.status_code = 429
+                response.headers['Retry-After'] = str(e.retry_after)
+                return response
+
+            response = None
+            deferred = False
+            path = request.path
+            memory_token = None
+            profile = None
+            try:
+                # Ya con el hueco tomado: cualquier excepción (también el aborto asíncrono
+                # del watchdog) debe pasar por el finally que lo libera
+                memory_token = memory_diagnostics.begin()
+                profile_mode = requested_profile_mode()
+                if profile_mode:
+                    result, profile = run_profiled(profile_mode, view, args, kwargs)
+                    response = app.make_response(result)
+                else:
+                    response = app.make_response(view(*args, **kwargs))
+                # Respuestas en streaming: el hueco se libera al cerrar el stream
+                if response.is_streamed and not info['aborted']:
+                    def on_close():
+                        _release_admission(ticket)
+                        memory_diagnostics.end(memory_token, path)
+                    response.call_on_close(on_close)
+                    deferred = True
+            except RequestLimitExceeded:
+                pass
+            finally:
+                if not deferred:
+                    _release_admission(ticket)
+
+            if info['aborted'] and not deferred:
+                return jsonify({"error": info['aborted']}), 503
+
+            response.headers['X-Queue-Wait-Ms'] = f"{info['wait_ms']:.1f}"
+            if profile is not None:
+                profile_id = store_profile(profile)
+                response.headers['X-Profile-Id'] = profile_id
+                response.headers['X-Profile-Url'] = f"/debug/profile/{profile_id}"
+            if not deferred:
+                memory = memory_diagnostics.end(memory_token, path)
+                if memory:
+                    response.headers['X-Memory-Peak-Mb'] = str(memory['peak_mb'])
+                    if memory['rss_delta_mb'] is not None:
+                        response.headers['X-Memory-Rss-Delta-Mb'] = str(memory['rss_delta_mb'])
+            return response
+        return wrapper
+    return decorator
+
+# ============================================================
+# ======== DIAGNÓSTICO DE MEMORIA (PROCESO DE LARGA VIDA) ====
+# ============================================================
+
+# Opt-in: SCORE_VIEWER_MEMORY_DIAGNOSTICS=true (tracemalloc tiene un coste apreciable)
+app.config.setdefault('MEMORY_DIAGNOSTICS', False)
+app.config.setdefault('MEMORY_TRACE_FRAMES', 8)          # profundidad de pila por asignación
+app.config.setdefault('MEMORY_GROWTH_WINDOW', 20)        # renders en la ventana de crecimiento
+app.config.setdefault('MEMORY_GROWTH_WARN_MB', 64)       # crecimiento de RSS que dispara el aviso
+app.config.setdefault('MEMORY_TOP_SITES', 15)            # sitios de asignación en el volcado
+
+def count_live_scores(collect=True):
+    """Objetos stream.Score vivos (tras un gc.collect para no contar ciclos ya muertos)"""
+    if collect:
+        gc.collect()
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, stream.Score))
+
+def format_allocation_sites(stats, limit):
+    """Top de estadísticas de tracemalloc (Statistic o StatisticDiff) serializable"""
+    sites = []
+    for stat in stats[:limit]:
+        frame = stat.traceback[0]
+        site = {
+            "site": f"{frame.filename}:{frame.lineno}",
+            "size_kb": round(stat.size / 1024, 1),
+            "count": stat.count
+        }
+        if hasattr(stat, 'size_diff'):
+            site["size_diff_kb"] = round(stat.size_diff / 1024, 1)
+            site["count_diff"] = stat.count_diff
+        sites.append(site)
+    return sites
+
+class MemoryDiagnostics:
+    """
+    Diagnóstico de memoria para el proceso del launcher (vive horas).
+    - RSS antes/después y pico de memoria trazada por petición de render.
+    - Snapshot de tracemalloc tras cada render, comparado con el anterior.
+    - Aviso si el RSS crece más de MEMORY_GROWTH_WARN_MB en MEMORY_GROWTH_WINDOW renders.
+      La petición solo lo encola: el recuento de Score vivos (gc.collect, caro) y el
+      log los hace el hilo muestreador en segundo plano.
+    El pico de tracemalloc es global: con renders concurrentes se solapa entre peticiones.
+    """
+    def __init__(self, config):
+        self.config = config
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._sampler = None
+        self._baseline = None       # primer snapshot (crecimiento total)
+        self._previous = None       # snapshot del render anterior
+        self._last_diff = []        # top de diferencias entre los dos últimos renders
+        self._pending = None        # aviso de crecimiento a completar por el muestreador
+        self.renders = []           # historial acotado de mediciones por petición
+        self.warnings = 0
+        self.last_warning = None    # último aviso completo (con Score vivos)
+
+    @property
+    def enabled(self):
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(max(1, int(self.config['MEMORY_TRACE_FRAMES'])))
+            app.logger.info("[Memoria] 🔬 tracemalloc activado")
+        with self._lock:
+            self._baseline = self._previous = tracemalloc.take_snapshot()
+        if self._sampler is None or not self._sampler.is_alive():
+            self._sampler = threading.Thread(target=self._sample, name='memory-sampler', daemon=True)
+            self._sampler.start()
+
+    def _sample(self):
+        """Hilo muestreador: completa los avisos de crecimiento fuera de la petición"""
+        while True:
+            with self._wake:
+                while self._pending is None:
+                    self._wake.wait()
+                pending, self._pending = self._pending, None
+            pending['live_scores'] = count_live_scores()
+            top = ", ".join(f"{s['site']} ({s['size_diff_kb']:+.0f}KB)" for s in pending['top_sites'])
+            app.logger.warning(
+                f"[Memoria] ⚠️ RSS +{pending['growth_mb']:.0f}MB en {pending['window']} renders "
+                f"({pending['live_scores']} Score vivos). Mayor crecimiento: {top}")
+            with self._lock:
+                self.last_warning = pending
+
+    def stop(self):
+        with self._lock:
+            self._baseline = self._previous = None
+            self._last_diff = []
+            self.renders = []
+        tracemalloc.stop()
+
+    def begin(self):
+        """Medición inicial de una petición (None si está desactivado)"""
+        if not self.enabled:
+            return None
+        tracemalloc.reset_peak()
+        return {'rss': _current_rss_bytes(), 'traced': tracemalloc.get_traced_memory()[0]}
+
+    def end(self, token, path):
+        """Cierra la medición, compara con el render anterior y vigila el crecimiento"""
+        if token is None or not self.enabled:
+            return None
+        traced, peak = tracemalloc.get_traced_memory()
+        rss = _current_rss_bytes()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ))
+        mb = 1024 * 1024
+        record = {
+            "path": path,
+            "time": time.time(),
+            "rss_mb": round(rss / mb, 1) if rss is not None else None,
+            "rss_delta_mb": round((rss - token['rss']) / mb, 2) if rss is not None and token['rss'] is not None else None,
+            "traced_delta_mb": round((traced - token['traced']) / mb, 2),
+            "peak_mb": round(peak / mb, 2)
+        }
+
+        window = max(2, int(self.config['MEMORY_GROWTH_WINDOW']))
+        with self._lock:
+            if self._previous is not None:
+                diff = snapshot.compare_to(self._previous, 'lineno')
+                self._last_diff = format_allocation_sites(diff, int(self.config['MEMORY_TOP_SITES']))
+            self._previous = snapshot
+            self.renders.append(record)
+            del self.renders[:-max(window, 100)]
+            recent = [r['rss_mb'] for r in self.renders[-window:] if r['rss_mb'] is not None]
+
+            if len(recent) >= window and recent[-1] - recent[0] > float(self.config['MEMORY_GROWTH_WARN_MB']):
+                self.warnings += 1
+                self.renders = self.renders[-1:]  # nueva ventana: no repetir el aviso
+                self._pending = {
+                    "time": record["time"],
+                    "growth_mb": round(recent[-1] - recent[0], 1),
+                    "window": window,
+                    "top_sites": self._last_diff[:3]
+                }
+                self._wake.notify()
+        return record
+
+    def report(self, limit=None, key_type='lineno'):
+        """Volcado para /debug/memory: top de sitios de asignación y crecimiento"""
+        limit = limit or int(self.config['MEMORY_TOP_SITES'])
+        snapshot = tracemalloc.take_snapshot()
+        traced, peak = tracemalloc.get_traced_memory()
+        rss = _current_rss_bytes()
+        mb = 1024 * 1024
+        with self._lock:
+            baseline = self._baseline
+            last_diff = list(self._last_diff)
+            renders = list(self.renders[-20:])
+            warnings = self.warnings
+            last_warning = self.last_warning
+        return {
+            "enabled": True,
+            "rss_mb": round(rss / mb, 1) if rss is not None else None,
+            "traced_mb": round(traced / mb, 2),
+            "peak_mb": round(peak / mb, 2),
+            "live_scores": count_live_scores(),
+            "growth_warnings": warnings,
+            "last_growth_warning": last_warning,
+            "top_sites": format_allocation_sites(snapshot.statistics(key_type), limit),
+            "growth_since_start": format_allocation_sites(
+                snapshot.compare_to(baseline, key_type), limit) if baseline is not None else [],
+            "last_render_diff": last_diff[:limit],
+            "renders": renders
+        }
+
+memory_diagnostics = MemoryDiagnostics(app.config)
+if app.config['MEMORY_DIAGNOSTICS']:
+    memory_diagnostics.start()
+
+# ============================================================
+# ========= PERFILADO BAJO DEMANDA (POR PETICIÓN) ============
+# ============================================================
+
+# Se activa por petición con la cabecera X-Profile o ?profile=<modo>.
+# Sin la marca no se instala nada: coste cero en producción.
+app.config.setdefault('PROFILING_ALLOWED', True)
+app.config.setdefault('PROFILE_SAMPLE_INTERVAL', 0.002)   # segundos entre muestras
+app.config.setdefault('PROFILE_MAX_SAMPLES', 200000)      # techo de muestras por petición
+app.config.setdefault('PROFILE_STORE_MAX', 8)             # perfiles guardados (LRU)
+
+PROFILE_MODES = ('sample', 'cprofile')
+
+_profile_store = OrderedDict()  # id → perfil
+_profile_store_lock = threading.Lock()
+_cprofile_lock = threading.Lock()  # un único perfilador determinista activo a la vez
+
+def requested_profile_mode():
+    """Modo de perfilado pedido (None si no se pide o no está permitido)"""
+    flag = request.headers.get('X-Profile') or request.args.get('profile')
+    if not flag or not app.config['PROFILING_ALLOWED']:
+        return None
+    flag = flag.strip().lower()
+    if flag in PROFILE_MODES:
+        return flag
+    return 'sample' if flag in ('1', 'true', 'yes') else None
+
+def frame_label(code):
+    """Etiqueta de una función en la pila: nombre (fichero:línea)"""
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class StackSampler:
+    """
+    Perfilador por muestreo de un solo hilo: otro hilo lee su pila con
+    sys._current_frames() cada PROFILE_SAMPLE_INTERVAL y acumula pilas colapsadas
+    (formato de flamegraph.pl / speedscope). La pila se corta en root_frame.
+    """
+    def __init__(self, thread_id, root_frame, interval, max_samples):
+        self.thread_id = thread_id
+        self.root_frame = root_frame
+        self.interval = interval
+        self.max_samples = max_samples
+        self.stacks = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def _run(self):
+        labels = {}  # caché code → etiqueta
+        while not self._stop.wait(self.interval) and self.samples < self.max_samples:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and frame is not self.root_frame:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = frame_label(code)
+                stack.append(label)
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def collapsed_to_tree(stacks):
+    """Pilas colapsadas → árbol {name, value, children} (formato d3-flamegraph)"""
+    root = {"name": "root", "value": 0, "children": {}}
+    for stack, count in stacks.items():
+        root["value"] += count
+        node = root
+        for name in stack.split(";"):
+            child = node["children"].get(name)
+            if child is None:
+                child = node["children"][name] = {"name": name, "value": 0, "children": {}}
+            child["value"] += count
+            node = child
+
+    def finish(node):
+        node["children"] = sorted((finish(c) for c in node["children"].values()),
+                                  key=lambda c: -c["value"])
+        return node
+    return finish(root)
+
+def run_profiled(mode, view, args, kwargs):
+    """Ejecuta la vista bajo el perfilador pedido. Devuelve (respuesta, perfil)"""
+    started = time.perf_counter()
+    profile = {"mode": mode, "path": request.path, "created": time.time()}
+    if mode == 'cprofile' and not _cprofile_lock.acquire(blocking=False):
+        mode = profile["mode"] = 'sample'  # ya hay otro cProfile en curso: muestreo
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        try:
+            result = profiler.runcall(view, *args, **kwargs)
+        finally:
+            _cprofile_lock.release()
+            stats_text = io.StringIO()
+            stats = pstats.Stats(profiler, stream=stats_text)
+            stats.sort_stats('cumulative').print_stats(60)
+            profile["pstats"] = stats_text.getvalue()
+            profile["stats"] = stats.stats  # para exportar como .prof (snakeviz)
+    else:
+        interval = max(0.0005, float(app.config['PROFILE_SAMPLE_INTERVAL']))
+        with StackSampler(threading.get_ident(), sys._getframe(), interval,
+                          int(app.config['PROFILE_MAX_SAMPLES'])) as sampler:
+            result = view(*args, **kwargs)
+        profile["stacks"] = sampler.stacks
+        profile["samples"] = sampler.samples
+        profile["interval_ms"] = round(interval * 1000, 3)
+    profile["seconds"] = round(time.perf_counter() - started, 4)
+    return result, profile
+
+def store_profile(profile):
+    """Guarda un perfil (LRU acotado) y devuelve su id"""
+    profile_id = os.urandom(6).hex()
+    with _profile_store_lock:
+        _profile_store[profile_id] = profile
+        while len(_profile_store) > int(app.config['PROFILE_STORE_MAX']):
+            _profile_store.popitem(last=False)
+    app.logger.info(f"[Perfil] 🔍 {profile['path']} ({profile['mode']}, {profile['seconds']}s) → {profile_id}")
+    return profile_id
+
+# ============================================================
+# ============ MÉTRICAS ESTILO PROMETHEUS (/metrics) =========
+# ============================================================
+
+app.config.setdefault('METRICS_ENABLED', True)
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Cubos de latencia (s): de consultas al índice (ms) a renders largos (minutos)
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_STARTED = time.time()
+
+# nombre → (tipo, ayuda). Todas las familias salen en /metrics aunque no tengan muestras
+METRIC_FAMILIES = {
+    'score_viewer_http_requests_total':
+        ('counter', "Peticiones HTTP atendidas por ruta, método y estado"),
+    'score_viewer_http_request_duration_seconds':
+        ('histogram', "Latencia de las peticiones HTTP por ruta (hasta cerrar la respuesta)"),
+    'score_viewer_http_requests_in_flight':
+        ('gauge', "Peticiones HTTP en curso por ruta"),
+    'score_viewer_pipeline_stage_duration_seconds':
+        ('histogram', "Duración de cada etapa del pipeline snippet → MusicXML"),
+    'score_viewer_render_errors_total':
+        ('counter', "Renders de /render-xml fallidos por causa"),
+    'score_viewer_render_fallback_scores_total':
+        ('counter', "Partituras de fallback servidas por /render-xml (XML generado inválido)"),
+    'score_viewer_chord_fallbacks_total':
+        ('counter', "Cifrados no reconocidos que se muestran como texto"),
+    'score_viewer_normalization_warnings_total':
+        ('counter', "Warnings del adaptador universal (normalización a Score)"),
+    'score_viewer_cache_requests_total':
+        ('counter', "Consultas a las cachés internas por resultado (hit/miss)"),
+    'score_viewer_cache_hit_ratio':
+        ('gauge', "Proporción de aciertos de cada caché desde el arranque"),
+    'score_viewer_cache_entries':
+        ('gauge', "Entradas actuales de cada caché"),
+    'score_viewer_document_store_bytes':
+        ('gauge', "Tamaño aproximado del almacén de documentos (texto + árbol + índice)"),
+    'score_viewer_admission_in_flight':
+        ('gauge', "Pipelines de render admitidos en curso"),
+    'score_viewer_admission_queue_depth':
+        ('gauge', "Peticiones esperando admisión por prioridad"),
+    'score_viewer_admission_events_total':
+        ('counter', "Eventos del control de admisión (admitted/rejected/timeouts/aborted)"),
+    'score_viewer_process_resident_memory_bytes':
+        ('gauge', "RSS del proceso"),
+    'score_viewer_process_start_time_seconds':
+        ('gauge', "Arranque del proceso (segundos desde epoch)"),
+}
+
+def _metric_labels(labels):
+    """Etiquetas en sintaxis de exposición: {a="1",b="x"} (vacío si no hay)"""
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+def _metric_value(value):
+    """Valor numérico en sintaxis de exposición (+Inf para el último cubo)"""
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class MetricsRegistry:
+    """
+    Contadores, gauges e histogramas en memoria, volcados en formato de texto
+    Prometheus 0.0.4. Una observación son un par de operaciones sobre dicts bajo un
+    lock que nunca se sostiene durante el volcado (se copia antes): microsegundos
+    frente a renders de cientos de ms. Los colectores se llaman solo en cada scrape.
+    """
+    def __init__(self, config, families, buckets):
+        self.config = config
+        self.families = families
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}       # (nombre, etiquetas) → valor (counter / gauge)
+        self._histograms = {}   # (nombre, etiquetas) → [cuenta por cubo..., cuenta +Inf, suma]
+        self._collectors = []   # funciones → [(nombre, {etiquetas}, valor)] en cada scrape
+
+    @property
+    def enabled(self):
+        return bool(self.config.get('METRICS_ENABLED'))
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items())) if labels else ()
+
+    def inc(self, name, labels=None, value=1):
+        """Suma a un contador (o a un gauge, con value negativo)"""
+        if not self.enabled:
+            return
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        """Añade una observación a un histograma"""
+        if not self.enabled:
+            return
+        key = (name, self._labels(labels))
+        slot = bisect.bisect_left(self.buckets, value)  # primer cubo con le >= value
+        with self._lock:
+            counts = self._histograms.get(key)
+            if counts is None:
+                counts = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[slot] += 1
+            counts[-1] += value
+
+    def value(self, name, labels=None):
+        """Valor actual de un contador o gauge (0 si no tiene muestras)"""
+        with self._lock:
+            return self._values.get((name, self._labels(labels)), 0)
+
+    def collector(self, collect):
+        """Decorador: registra una función que aporta muestras calculadas al hacer scrape"""
+        self._collectors.append(collect)
+        return collect
+
+    def render(self) -> str:
+        with self._lock:
+            values = list(self._values.items())
+            histograms = [(key, list(counts)) for key, counts in self._histograms.items()]
+
+        samples = {}  # nombre → [(etiquetas, valor)]
+        for (name, labels), value in values:
+            samples.setdefault(name, []).append((labels, value))
+        for collect in self._collectors:
+            try:
+                for name, labels, value in collect():
+                    samples.setdefault(name, []).append((self._labels(labels), value))
+            except Exception:
+                app.logger.exception(f"[Métricas] Error en el colector {collect.__name__}")
+        by_histogram = {}
+        for (name, labels), counts in histograms:
+            by_histogram.setdefault(name, []).append((labels, counts))
+
+        lines = []
+        for name, (kind, help_text) in self.families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind != 'histogram':
+                for labels, value in sorted(samples.get(name, ()), key=lambda s: s[0]):
+                    lines.append(f"{name}{_metric_labels(labels)} {_metric_value(value)}")
+                continue
+            for labels, counts in sorted(by_histogram.get(name, ()), key=lambda s: s[0]):
+                cumulative = 0
+                for le, count in zip(self.buckets + (math.inf,), counts):
+                    cumulative += count
+                    bucket_labels = labels + (('le', _metric_value(float(le))),)
+                    lines.append(f"{name}_bucket{_metric_labels(bucket_labels)} {cumulative}")
+                lines.append(f"{name}_sum{_metric_labels(labels)} {_metric_value(counts[-1])}")
+                lines.append(f"{name}_count{_metric_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry(app.config, METRIC_FAMILIES, METRICS_LATENCY_BUCKETS)
+
+@contextlib.contextmanager
+def pipeline_stage(stage):
+    """Cronometra una etapa del pipeline (score_viewer_pipeline_stage_duration_seconds)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('score_viewer_pipeline_stage_duration_seconds',
+                        time.perf_counter() - started, {'stage': stage})
+
+def record_cache_lookup(cache, hit):
+    """Cuenta un acierto o fallo de una caché interna"""
+    metrics.inc('score_viewer_cache_requests_total', {'cache': cache, 'result': 'hit' if hit else 'miss'})
+
+# Cachés con contadores propios (la de soundfonts usa los de functools.lru_cache)
+METRIC_CACHES = ('snippet', 'document_store', 'document_index', 'analysis')
+
+@metrics.collector
+def collect_cache_metrics():
+    soundfont = _load_soundfont.cache_info()
+    lookups = {cache: (metrics.value('score_viewer_cache_requests_total', {'cache': cache, 'result': 'hit'}),
+                       metrics.value('score_viewer_cache_requests_total', {'cache': cache, 'result': 'miss'}))
+               for cache in METRIC_CACHES}
+    lookups['soundfont'] = (soundfont.hits, soundfont.misses)
+
+    samples = [
+        ('score_viewer_cache_requests_total', {'cache': 'soundfont', 'result': 'hit'}, soundfont.hits),
+        ('score_viewer_cache_requests_total', {'cache': 'soundfont', 'result': 'miss'}, soundfont.misses),
+        ('score_viewer_cache_entries', {'cache': 'snippet'}, len(_snippet_cache)),
+        ('score_viewer_cache_entries', {'cache': 'document_store'}, len(_xml_store)),
+        ('score_viewer_cache_entries', {'cache': 'analysis'}, len(_analysis_cache)),
+        ('score_viewer_cache_entries', {'cache': 'soundfont'}, soundfont.currsize),
+        ('score_viewer_document_store_bytes', None, _xml_store_bytes),
+    ]
+    for cache, (hits, misses) in lookups.items():
+        if hits + misses:
+            samples.append(('score_viewer_cache_hit_ratio', {'cache': cache}, round(hits / (hits + misses), 4)))
+    return samples
+
+@metrics.collector
+def collect_admission_metrics():
+    snapshot = admission.snapshot()
+    samples = [('score_viewer_admission_in_flight', None, snapshot['in_flight'])]
+    for priority, depth in snapshot['queue_depth_by_priority'].items():
+        samples.append(('score_viewer_admission_queue_depth', {'priority': priority}, depth))
+    for event in ('admitted', 'rejected', 'timeouts', 'aborted'):
+        samples.append(('score_viewer_admission_events_total', {'event': event}, snapshot[event]))
+    return samples
+
+@metrics.collector
+def collect_process_metrics():
+    samples = [('score_viewer_process_start_time_seconds', None, round(METRICS_STARTED, 3))]
+    rss = _current_rss_bytes()
+    if rss is not None:
+        samples.append(('score_viewer_process_resident_memory_bytes', None, rss))
+    return samples
+
+# ---------- Contadores por petición (todas las rutas salvo /metrics) ----------
+
+def _finish_request_metrics(state, method, status):
+    """Cierra las métricas de una petición (una sola vez, aunque lleguen dos avisos)"""
+    if state['done']:
+        return
+    state['done'] = True
+    route = state['route']
+    metrics.inc('score_viewer_http_requests_in_flight', {'route': route}, -1)
+    metrics.inc('score_viewer_http_requests_total', {'route': route, 'method': method, 'status': str(status)})
+    metrics.observe('score_viewer_http_request_duration_seconds',
+                    time.perf_counter() - state['started'], {'route': route})
+
+@app.before_request
+def start_request_metrics():
+    if not metrics.enabled or request.path == '/metrics':
+        return
+    # Plantilla de la ruta (/document/<doc_hash>), no la URL: cardinalidad acotada
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    g.request_metrics = {'route': route, 'started': time.perf_counter(), 'done': False, 'deferred': False}
+    metrics.inc('score_viewer_http_requests_in_flight', {'route': route})
+
+@app.after_request
+def finish_request_metrics(response):
+    state = g.get('request_metrics')
+    if state is not None:
+        method, status = request.method, response.status_code
+        if response.is_streamed:
+            # Streaming (/render-batch, .mxl): la latencia incluye el envío del cuerpo
+            state['deferred'] = True
+            response.call_on_close(lambda: _finish_request_metrics(state, method, status))
+        else:
+            _finish_request_metrics(state, method, status)
+    return response
+
+@app.teardown_request
+def teardown_request_metrics(error):
+    # Sin after_request (excepción no capturada): contarla como 500
+    state = g.get('request_metrics')
+    if state is not None and not state['deferred']:
+        _finish_request_metrics(state, request.method, 500)
+
 # ============================================================
 # ======================= RUTAS FLASK ========================
 # ============================================================
@@ -793,29 +2043,72 @@ def run_music21_snippet_any(code: str):
 def index():
     return render_template("index.html")
 
+@app.route("/service-worker.js")
+def service_worker():
+    """Service worker servido desde la raíz: su scope debe cubrir /render-xml"""
+    response = app.send_static_file('service-worker.js')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Service-Worker-Allowed'] = '/'
+    return response
+
 @app.route("/render-xml", methods=["POST"])
+@admission_controlled('interactive')
 def render_xml():
     """
     Recibe:
       - {"code": "...python..."}  -> ejecuta, normaliza y devuelve MusicXML
       - {"xml": "<score-partwise..."} -> lo devuelve tal cual
       - {"path": "/ruta/a/archivo.mid"} -> parsea y devuelve MusicXML
+      - fichero .mxl/.musicxml sin JSON: multipart (campo 'file') o cuerpo binario
+        con Content-Type application/vnd.recordare.musicxml -> lo devuelve descomprimido
+    Opcional (render paginado): measure_start + measure_count, o systems_per_page
+    (+ measures_per_system). Devuelve solo esa ventana como documento independiente;
+    el resto se pide a /document/<hash>/measures sin volver a ejecutar el snippet.
+    En las subidas de fichero, el rango va en la query string (o en el formulario).
     """
     data = request.get_json(silent=True) or {}
+    try:
+        uploaded_xml = read_uploaded_musicxml()
+    except ValueError as e:
+        return jsonify({"error": f"Archivo MusicXML inválido: {e}"}), 400
+    if uploaded_xml is not None:
+        # El fichero manda: un campo 'xml' en la query o el formulario no lo sustituye
+        data = {**request.values.to_dict(), "xml": uploaded_xml}
+    try:
+        window = parse_measure_window(data)
+    except ValueError as e:
+        return jsonify({"error": f"Rango de compases inválido: {e}"}), 400
 
-    # 1) si mandan XML directo
-    if isinstance(data.get("xml"), str) and data["xml"].lstrip().startswith("<?xml"):
+    # 1) si mandan XML directo (una subida ya viene validada: puede empezar por
+    #    <!DOCTYPE o un comentario)
+    if uploaded_xml is not None or (
+            isinstance(data.get("xml"), str) and data["xml"].lstrip('\ufeff').lstrip().startswith(("<?xml", "<score-partwise"))):
         xml_clean = data["xml"].lstrip('\ufeff').strip()  # Eliminar BOM
-        return Response(xml_clean, mimetype="application/vnd.recordare.musicxml+xml; charset=utf-8")
+        response = Response(xml_clean, mimetype="application/vnd.recordare.musicxml+xml; charset=utf-8")
+        response.headers['X-Content-Hash'] = doc_hash = store_xml_document(xml_clean)
+        if window:
+            measure_window_response(response, doc_hash, window)
+        return response
 
     # 2) si mandan ruta
     if isinstance(data.get("path"), str):
         try:
-            xml_payload = to_musicxml_string(data["path"])
+            layout_stats = {}
+            score_out = {}
+            xml_payload = to_musicxml_string(data["path"], layout_stats=layout_stats, score_out=score_out)
             xml_payload = xml_payload.lstrip('\ufeff').strip()  # Eliminar BOM
-            return Response(xml_payload, mimetype="application/vnd.recordare.musicxml+xml; charset=utf-8")
+            response = Response(xml_payload, mimetype="application/vnd.recordare.musicxml+xml; charset=utf-8")
+            response.headers['X-Content-Hash'] = doc_hash = store_xml_document(xml_payload)
+            if layout_stats:
+                response.headers['X-Layout-Hints'] = json.dumps(layout_stats, separators=(',', ':'))
+            if score_out.get('notation'):
+                response.headers['X-Notation-Report'] = json.dumps(score_out['notation'], separators=(',', ':'))
+            if window:
+                measure_window_response(response, doc_hash, window)
+            return response
         except Exception as e:
             app.logger.exception("Error al convertir ruta a MusicXML")
+            metrics.inc('score_viewer_render_errors_total', {'cause': 'path'})
             return Response(f"Error al convertir ruta a MusicXML: {e}", status=400, mimetype="text/plain")
 
     # 3) si mandan código python
@@ -823,11 +2116,15 @@ def render_xml():
     if not code:
         return jsonify({"error": "No se proporcionó 'code', 'xml' ni 'path'."}), 400
 
-    xml_payload, warnings_list, err, element_line_map = run_music21_snippet_any(code)
+    layout_stats = {}
+    score_out = {}
+    xml_payload, warnings_list, err, element_line_map = run_music21_snippet_any(code, layout_stats, score_out)
     if err:
+        metrics.inc('score_viewer_render_errors_total', {'cause': 'snippet'})
         return jsonify({"error": err}), 400
 
     if not xml_payload or not xml_payload.strip():
+        metrics.inc('score_viewer_render_errors_total', {'cause': 'empty_export'})
         return Response("Export MusicXML vacío.", status=500, mimetype="text/plain")
 
     # Garantizar XML puro: eliminar BOM y asegurar inicio correcto
@@ -856,13 +2153,21 @@ def render_xml():
             xml_payload = xml_bytes.decode('utf-8').lstrip('\ufeff').strip()
             
             warnings_list.append("XML inválido, se generó partitura de fallback")
+            metrics.inc('score_viewer_render_fallback_scores_total')
         except Exception as e:
             app.logger.exception("Fallo crítico en fallback de exportación")
+            metrics.inc('score_viewer_render_errors_total', {'cause': 'fallback'})
             return Response(f"Error crítico en exportación: {e}", status=500, mimetype="text/plain")
     
     # Preparar respuesta con header X-Warnings si hay warnings
     response = Response(xml_payload, mimetype="application/vnd.recordare.musicxml+xml; charset=utf-8")
     
+    # Registrar como documento base para el protocolo delta (/apply-patch),
+    # con el mapeo id → línea para el índice de elementos (/document/<hash>/index)
+    response.headers['X-Content-Hash'] = doc_hash = store_xml_document(xml_payload, element_line_map)
+    if window:
+        measure_window_response(response, doc_hash, window)
+    
     if warnings_list:
         # Log warnings
         for w in warnings_list:
@@ -880,9 +2185,16 @@ def render_xml():
         response.headers['X-Warnings'] = warnings_summary_safe
         response.headers['X-Warnings-Count'] = str(len(warnings_list))
     
+    # Pistas de layout calculadas durante el export (evita re-parsear en el cliente)
+    if layout_stats:
+        response.headers['X-Layout-Hints'] = json.dumps(layout_stats, separators=(',', ':'))
+    
+    # Compases que finalize_notation dio por notados (sin makeNotation)
+    if score_out.get('notation'):
+        response.headers['X-Notation-Report'] = json.dumps(score_out['notation'], separators=(',', ':'))
+    
     # ✅ NUEVO: Devolver mapeo ID→línea como header JSON
     if element_line_map:
-        import json
         element_line_map_json = json.dumps(element_line_map)
         response.headers['X-Element-Line-Map'] = element_line_map_json
         app.logger.info(f"[Line Map] Devolviendo mapeo de {len(element_line_map)} elemento(s)")
@@ -891,62 +2203,39 @@ def render_xml():
 
 @app.route("/apply-edits", methods=["POST"])
 def apply_edits():
+    """
+    Mueve y borra <harmony>/<work-title> (y cualquier elemento del índice).
+    Input: {xml_content | hash, edits: {id: {x, y}}, deletions: [id]}
+    """
     data = request.get_json()
     xml_content = data.get("xml_content")
     edits = data.get("edits", {})
     deletions = data.get("deletions", [])
     additions = data.get("additions", [])
 
-    if not xml_content:
+    if not xml_content and not data.get("hash"):
         return jsonify({"error": "No se proporcionó contenido MusicXML."}), 400
 
     try:
-        # Simplificación de namespace por comodidad
-        xml_content = xml_content.replace('xmlns="http://www.musicxml.org/xsd/musicxml.xsd"', '')
-        root = ET.fromstring(xml_content)
-
-        work_title_element = root.find(".//work-title")
-        harmony_elements = root.findall(".//harmony")
-
-        element_map = {}
-        if work_title_element is not None:
-            element_map[f"{work_title_element.text}-0"] = work_title_element
-
-        harmony_counts = {}
-        for harmony in harmony_elements:
-            kind_node = harmony.find('kind')
-            root_step_node = harmony.find('root-step')
-            if kind_node is not None and root_step_node is not None:
-                kind_text = kind_node.get('text', kind_node.text)
-                chord_text = root_step_node.text + kind_text
-                count = harmony_counts.get(chord_text, 0)
-                element_map[f"{chord_text}-{count}"] = harmony
-                harmony_counts[chord_text] = count + 1
+        # Ids resueltos en O(1) con el índice del documento (cacheado si ya se conoce)
+        document = EditableDocument.open(data.get("hash"), xml_content)
+        if document is None:
+            return jsonify({"error": "Documento desconocido, reenviar con xml_content.", "base_unknown": True}), 409
 
         for element_id, pos in edits.items():
-            target_element = element_map.get(element_id)
+            target_element = document.resolve(element_id, harmony_first=True)
             if target_element is not None:
                 target_element.set("default-x", str(pos["x"]))
                 target_element.set("default-y", str(pos["y"]))
                 app.logger.info(f"Moved element '{element_id}' to ({pos['x']}, {pos['y']})")
 
         for element_id in deletions:
-            target_element = element_map.get(element_id)
-            if target_element is not None:
-                for parent in root.iter():
-                    try:
-                        parent.remove(target_element)
-                        app.logger.info(f"Deleted element '{element_id}'")
-                        break
-                    except ValueError:
-                        pass
-
-        modified_xml_str = ET.tostring(root, encoding='unicode', method='xml')
-        final_xml = '<?xml version="1.0" encoding="UTF-8"?>\n'
-        final_xml += '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 4.0 Partwise//EN" "http://www.musicxml.org/dtds/partwise.dtd">\n'
-        final_xml += modified_xml_str
+            target_element = document.resolve(element_id, harmony_first=True)
+            if target_element is not None and document.parent(target_element) is not None:
+                document.remove(target_element)
+                app.logger.info(f"Deleted element '{element_id}'")
 
-        return Response(final_xml, mimetype="application/vnd.recordare.musicxml+xml; charset=utf-8")
+        return Response(musicxml_document(document.root), mimetype="application/vnd.recordare.musicxml+xml; charset=utf-8")
 
     except ET.ParseError as e:
         app.logger.error(f"Error al parsear MusicXML: {e}")
@@ -955,58 +2244,1225 @@ def apply_edits():
         app.logger.exception(f"Error inesperado en /apply-edits: {e}")
         return jsonify({"error": f"Error inesperado: {e}"}), 500
 
-@app.route("/apply-edits-xml", methods=["POST"])
-def apply_edits_xml():
+# ============================================================
+# ============== ÍNDICE DE ELEMENTOS POR ID EXACTO ============
+# ============================================================
+
+# IDs generados en el cliente a partir del texto del elemento:
+#   temp_<texto-con-guiones>_<timestamp>          (assignCorrectIDsFromCode)
+#   overlay-text-<texto-con-guiones>-<timestamp>  (convertTextToOverlay)
+CLIENT_TEXT_ID_RE = re.compile(r'^(?:overlay-)?(?:temp_|text-)(.+?)[_-]\d{10,}$')
+
+def _text_slug(text: str) -> str:
+    """Convierte un texto al formato usado en los IDs del cliente (espacios → guiones)"""
+    return re.sub(r'\s+', '-', text.strip())
+
+def build_element_index(root):
     """
-    Aplica ediciones en coordenadas de tenths (MusicXML) al XML.
-    Input: {xml_content, edits: {id: {xTenths, yTenths, scale}}}
-    Output: MusicXML modificado
+    Recorre el documento UNA vez y construye el índice de elementos editables.
+    Devuelve dict con:
+      - 'by_id':    ID exacto → elemento. Incluye cualquier atributo id y el ID
+                    sintético "texto-N" de cada <direction><words>
+                    (N = ocurrencia del texto en el documento).
+      - 'by_slug':  texto-con-guiones → lista de <direction> en orden de documento.
+      - 'harmony':  "raíz+tipo-N" → <harmony> y "título-0" → <work-title>
+                    (mismo formato que /apply-edits).
+      - 'measures': "partId/número" → <measure>.
+      - 'parents':  elemento → padre (ElementTree no guarda el padre).
+      - 'positions': elemento → posición en su padre (hasta el nivel de compás).
+      - 'offsets':  hijo de <measure> → offset en negras dentro del compás.
     """
-    data = request.get_json()
-    xml_content = data.get("xml_content")
-    edits = data.get("edits", {})
-    
-    if not xml_content:
-        return jsonify({"error": "No se proporcionó contenido MusicXML."}), 400
-    
-    try:
-        # Simplificar namespace
-        xml_content = xml_content.replace('xmlns="http://www.musicxml.org/xsd/musicxml.xsd"', '')
-        root = ET.fromstring(xml_content)
-        
-        # Aplicar ediciones a elementos <direction><words>
-        for part in root.findall('.//part'):
-            for measure in part.findall('.//measure'):
-                for direction in measure.findall('.//direction'):
-                    words = direction.find('.//words')
-                    if words is not None:
-                        text = (words.text or '').strip()
-                        placement = direction.get('placement', 'above')
-                        
-                        # Buscar edición por ID (formato: "texto-N")
-                        for edit_id, edit_data in edits.items():
-                            if text in edit_id:
-                                # Aplicar default-x y default-y en tenths
-                                if 'xTenths' in edit_data:
-                                    direction.set('default-x', str(edit_data['xTenths']))
-                                if 'yTenths' in edit_data:
-                                    direction.set('default-y', str(edit_data['yTenths']))
-                                app.logger.info(f"[apply-edits-xml] '{edit_id}' → x={edit_data.get('xTenths')}, y={edit_data.get('yTenths')}")
-                                break
-        
-        # Reconstruir XML
-        modified_xml = ET.tostring(root, encoding='unicode', method='xml')
-        final_xml = '<?xml version="1.0" encoding="UTF-8"?>\n'
-        final_xml += '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 4.0 Partwise//EN" "http://www.musicxml.org/dtds/partwise.dtd">\n'
-        final_xml += modified_xml
-        
-        return Response(final_xml, mimetype="application/vnd.recordare.musicxml+xml; charset=utf-8")
-    
-    except Exception as e:
-        app.logger.exception(f"Error en /apply-edits-xml: {e}")
-        return jsonify({"error": str(e)}), 500
+    by_id = {}
+    by_slug = {}
+    harmony_map = {}
+    measures = {}
+    parents = {}
+    positions = {}
+    offsets = {}
+    text_counts = {}
+    harmony_counts = {}
+    divisions = {}  # <part> → divisiones vigentes
 
-@app.route("/render-test")
+    for parent in root.iter():
+        in_measure = parent.tag == 'measure'
+        track_positions = in_measure or parent.tag in ('part', 'score-partwise')
+        if in_measure:
+            part = parents.get(parent)
+            part_divisions = divisions.get(part, 1.0)
+            cursor = last_onset = 0.0
+
+        for position, child in enumerate(parent):
+            parents[child] = parent
+            if track_positions:
+                positions[child] = position
+
+            # Offset dentro del compás (mismo cursor que el export: backup/forward/chord)
+            if in_measure:
+                tag = child.tag
+                if tag == 'note':
+                    if child.find('chord') is not None:
+                        offsets[child] = last_onset
+                    else:
+                        offsets[child] = last_onset = cursor
+                        cursor += float(child.findtext('duration') or 0) / part_divisions
+                elif tag == 'backup':
+                    cursor -= float(child.findtext('duration') or 0) / part_divisions
+                elif tag == 'forward':
+                    cursor += float(child.findtext('duration') or 0) / part_divisions
+                else:
+                    if tag == 'attributes' and child.findtext('divisions'):
+                        part_divisions = divisions[part] = float(child.findtext('divisions'))
+                    offsets[child] = cursor + float(child.findtext('offset') or 0) / part_divisions
+
+            explicit_id = child.get('id')
+            if explicit_id and child.tag not in ('part', 'score-part'):
+                by_id.setdefault(explicit_id, child)
+
+            if child.tag == 'measure' and parent.tag == 'part':
+                measures.setdefault(f"{parent.get('id')}/{child.get('number')}", child)
+
+            elif child.tag == 'direction':
+                words = child.find('.//words')
+                if words is None:
+                    continue
+                text = (words.text or '').strip()
+                if words.get('id'):
+                    by_id.setdefault(words.get('id'), child)
+
+                count = text_counts.get(text, 0)
+                by_id.setdefault(f"{text}-{count}", child)
+                text_counts[text] = count + 1
+
+                by_slug.setdefault(_text_slug(text), []).append(child)
+
+            elif child.tag == 'harmony':
+                kind_node = child.find('kind')
+                root_step_node = child.find('root/root-step')
+                if root_step_node is None:
+                    root_step_node = child.find('root-step')
+                if kind_node is not None and root_step_node is not None:
+                    chord_text = (root_step_node.text or '') + (kind_node.get('text', kind_node.text) or '')
+                    count = harmony_counts.get(chord_text, 0)
+                    harmony_map.setdefault(f"{chord_text}-{count}", child)
+                    harmony_counts[chord_text] = count + 1
+
+            elif child.tag == 'work-title':
+                harmony_map.setdefault(f"{child.text}-0", child)
+
+    return {
+        'by_id': by_id,
+        'by_slug': by_slug,
+        'harmony': harmony_map,
+        'measures': measures,
+        'parents': parents,
+        'positions': positions,
+        'offsets': offsets
+    }
+
+def indexed_element_path(index, element):
+    """Ruta de índices de hijos desde la raíz, en el árbol indexado"""
+    parents = index['parents']
+    positions = index['positions']
+    path = []
+    while element in parents:
+        parent = parents[element]
+        position = positions.get(element)
+        path.append(position if position is not None else list(parent).index(element))
+        element = parent
+    path.reverse()
+    return path
+
+def describe_element(index, element_id, element, line_map=None):
+    """Entrada del índice: id → parte, compás, offset, tipo, línea de código y ruta XML"""
+    parents = index['parents']
+    measure = part = None
+    node = element
+    while node is not None:
+        if node.tag == 'measure':
+            measure = node
+        elif node.tag == 'part':
+            part = node
+            break
+        node = parents.get(node)
+
+    offset = index['offsets'].get(element)
+    return {
+        "id": element_id,
+        "kind": element.tag,
+        "part": part.get('id') if part is not None else None,
+        "measure": measure.get('number') if measure is not None else None,
+        "offset": round(offset, 6) if offset is not None else None,
+        "line": (line_map or {}).get(element_id),
+        "path": indexed_element_path(index, element)
+    }
+
+def index_entries(index, line_map=None):
+    """Todas las entradas del índice (ids exactos, sintéticos, cifrados y compases)"""
+    entries = {}
+    for mapping in (index['by_id'], index['harmony'], index['measures']):
+        for element_id, element in mapping.items():
+            entries.setdefault(element_id, describe_element(index, element_id, element, line_map))
+    return entries
+
+def resolve_direction(index, edit_id, used=None):
+    """
+    Resuelve un ID de edición a su <direction> sin comparar subcadenas.
+    1) ID exacto en el índice
+    2) ID del cliente con texto embebido (temp_/overlay-) → primera
+       ocurrencia aún no usada de ese texto exacto
+    Devuelve el nodo o None.
+    """
+    direction = index['by_id'].get(edit_id)
+    if direction is not None:
+        return direction
+
+    match = CLIENT_TEXT_ID_RE.match(edit_id)
+    if not match:
+        return None
+
+    for candidate in index['by_slug'].get(match.group(1), []):
+        if used is None or id(candidate) not in used:
+            return candidate
+    return None
+
+def resolve_element(index, element_id, used=None):
+    """Como resolve_direction, pero también busca <harmony>, <work-title> y <measure>"""
+    element = resolve_direction(index, element_id, used)
+    if element is not None:
+        return element
+    element = index['harmony'].get(element_id)
+    if element is not None:
+        return element
+    return index['measures'].get(element_id)
+
+def resolve_edit_target(index, element_id, used=None):
+    """
+    Orden de /apply-edits: primero <harmony> y <work-title> (lo único que resolvía la
+    versión original), luego el resto. Los ids sintéticos salen del texto, así que una
+    <direction> con palabras "Cmaj7" no puede quedarse la edición del cifrado Cmaj7-0.
+    """
+    element = index['harmony'].get(element_id)
+    if element is not None:
+        return element
+    return resolve_element(index, element_id, used)
+
+def musicxml_document(root) -> str:
+    """Serializa un árbol ElementTree como documento MusicXML completo"""
+    body = ET.tostring(root, encoding='unicode', method='xml')
+    final_xml = '<?xml version="1.0" encoding="UTF-8"?>\n'
+    final_xml += '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 4.0 Partwise//EN" "http://www.musicxml.org/dtds/partwise.dtd">\n'
+    final_xml += body
+    return final_xml
+
+# Presupuesto de X-Edit-Report: muchos proxies y navegadores cortan en ~8 KB de cabeceras
+EDIT_REPORT_HEADER_MAX_BYTES = 4096
+
+def edit_report_header(report):
+    """
+    Resumen del informe por edición para la cabecera X-Edit-Report.
+    Devuelve (json, truncado). Si el informe completo no cabe, solo van las
+    ediciones no aplicadas (las que interesan al cliente) hasta agotar el presupuesto.
+    """
+    full = json.dumps(report, ensure_ascii=True)
+    if len(full) <= EDIT_REPORT_HEADER_MAX_BYTES:
+        return full, False
+    kept = []
+    size = 2  # corchetes
+    for entry in report:
+        if entry["status"] == "applied":
+            continue
+        item = json.dumps(entry, ensure_ascii=True)
+        if size + len(item) + 1 > EDIT_REPORT_HEADER_MAX_BYTES:
+            break
+        kept.append(item)
+        size += len(item) + 1
+    return '[' + ','.join(kept) + ']', True
+
+@app.route("/apply-edits-xml", methods=["POST"])
+def apply_edits_xml():
+    """
+    Aplica ediciones en coordenadas de tenths (MusicXML) al XML.
+    Input: {xml_content | hash, edits: {id: {xTenths, yTenths, scale}}, report?: "json"}
+    Output: MusicXML modificado + header X-Edit-Report con el resultado por edición
+    (acotado: en lotes grandes solo las no aplicadas y X-Edit-Report-Truncated: 1).
+    Con report="json": {xml, report, applied, missing} con el informe completo.
+    """
+    data = request.get_json()
+    xml_content = data.get("xml_content")
+    edits = data.get("edits", {})
+
+    if not xml_content and not data.get("hash"):
+        return jsonify({"error": "No se proporcionó contenido MusicXML."}), 400
+
+    try:
+        # Índice id → <direction> cacheado con el documento: O(1) por edición
+        document = EditableDocument.open(data.get("hash"), xml_content)
+        if document is None:
+            return jsonify({"error": "Documento desconocido, reenviar con xml_content.", "base_unknown": True}), 409
+        report = []
+
+        for edit_id, edit_data in edits.items():
+            direction = document.resolve(edit_id, directions_only=True)
+            if direction is None:
+                report.append({"id": edit_id, "status": "not_found"})
+                continue
+
+            # Aplicar default-x y default-y en tenths
+            if 'xTenths' in edit_data:
+                direction.set('default-x', str(edit_data['xTenths']))
+            if 'yTenths' in edit_data:
+                direction.set('default-y', str(edit_data['yTenths']))
+            report.append({
+                "id": edit_id,
+                "status": "applied",
+                "x": edit_data.get('xTenths'),
+                "y": edit_data.get('yTenths')
+            })
+            app.logger.info(f"[apply-edits-xml] '{edit_id}' → x={edit_data.get('xTenths')}, y={edit_data.get('yTenths')}")
+
+        # Reconstruir XML
+        final_xml = musicxml_document(document.root)
+
+        applied = sum(1 for r in report if r["status"] == "applied")
+        app.logger.info(f"[apply-edits-xml] {applied}/{len(report)} edición(es) aplicadas")
+
+        if data.get("report") == "json":
+            return jsonify({"xml": final_xml, "report": report,
+                            "applied": applied, "missing": len(report) - applied})
+
+        response = Response(final_xml, mimetype="application/vnd.recordare.musicxml+xml; charset=utf-8")
+        response.headers['X-Edit-Report'], truncated = edit_report_header(report)
+        if truncated:
+            response.headers['X-Edit-Report-Truncated'] = '1'
+        response.headers['X-Edits-Applied'] = str(applied)
+        response.headers['X-Edits-Missing'] = str(len(report) - applied)
+        return response
+
+    except Exception as e:
+        app.logger.exception(f"Error en /apply-edits-xml: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# ============================================================
+# ======= ALMACÉN DE DOCUMENTOS BASE Y PROTOCOLO DELTA =======
+# ============================================================
+
+# Documentos MusicXML recientes, direccionados por hash de contenido.
+# Cada entrada es inmutable: un parche crea una entrada nueva (que comparte con
+# su base los subárboles que no tocó, ver EditableDocument).
+# Acotado por número y por bytes aproximados: árbol parseado ≈ 10× el texto e
+# índice ≈ 2× (medido con tracemalloc), así que una entrada pesa ~13× su texto.
+XML_STORE_MAX_DOCUMENTS = 16
+XML_STORE_MAX_BYTES = 256 * 1024 * 1024
+XML_STORE_BYTES_PER_CHAR = 13
+_xml_store = OrderedDict()  # hash → {'xml': str|None, 'root': Element|None, 'bytes': int}
+_xml_store_bytes = 0
+_xml_store_lock = threading.Lock()
+
+def content_hash(xml_text: str) -> str:
+    """Hash de contenido de un documento MusicXML"""
+    return hashlib.sha1(xml_text.encode('utf-8')).hexdigest()
+
+def _store_put(doc_hash, entry):
+    """Inserta la entrada y expulsa las más antiguas (siempre queda al menos la nueva)"""
+    global _xml_store_bytes
+    entry['bytes'] = len(entry.get('xml') or '') * XML_STORE_BYTES_PER_CHAR
+    with _xml_store_lock:
+        previous = _xml_store.pop(doc_hash, None)
+        if previous is not None:
+            _xml_store_bytes -= previous['bytes']
+        _xml_store[doc_hash] = entry
+        _xml_store_bytes += entry['bytes']
+        while len(_xml_store) > 1 and (len(_xml_store) > XML_STORE_MAX_DOCUMENTS
+                                       or _xml_store_bytes > XML_STORE_MAX_BYTES):
+            _, evicted = _xml_store.popitem(last=False)
+            _xml_store_bytes -= evicted['bytes']
+
+def store_xml_document(xml_text: str, line_map=None) -> str:
+    """
+    Registra un documento como base para parches y devuelve su hash.
+    El parseo se hace en diferido (solo si llega un parche).
+    line_map: mapeo id → línea de código del snippet que generó el documento.
+    """
+    doc_hash = content_hash(xml_text)
+    with _xml_store_lock:
+        if doc_hash in _xml_store:
+            _xml_store.move_to_end(doc_hash)
+            if line_map:
+                _xml_store[doc_hash]['line_map'] = line_map
+            return doc_hash
+    _store_put(doc_hash, {'xml': xml_text, 'root': None, 'line_map': line_map or {}})
+    return doc_hash
+
+def get_stored_root(doc_hash):
+    """Devuelve el árbol (sin namespace) del documento base, o None si no se conoce"""
+    with _xml_store_lock:
+        entry = _xml_store.get(doc_hash)
+        if entry is not None:
+            _xml_store.move_to_end(doc_hash)
+    record_cache_lookup('document_store', entry is not None)
+    if entry is None:
+        return None
+
+    if entry['root'] is None:
+        xml_text = entry['xml'].replace('xmlns="http://www.musicxml.org/xsd/musicxml.xsd"', '')
+        entry['root'] = ET.fromstring(xml_text.lstrip('\ufeff').strip())
+    return entry['root']
+
+def _get_store_entry(doc_hash):
+    with _xml_store_lock:
+        entry = _xml_store.get(doc_hash)
+        if entry is not None:
+            _xml_store.move_to_end(doc_hash)
+        return entry
+
+def get_document_index(doc_hash):
+    """
+    Índice de elementos del documento (ver build_element_index), construido una
+    vez por documento y cacheado con él. None si el documento no se conoce.
+    """
+    entry = _get_store_entry(doc_hash)
+    if entry is None:
+        record_cache_lookup('document_store', False)
+        return None
+    record_cache_lookup('document_index', entry.get('index') is not None)
+    if entry.get('index') is None:
+        entry['index'] = build_element_index(get_stored_root(doc_hash))
+    return entry['index']
+
+def get_document_line_map(doc_hash):
+    """Mapeo id → línea de código guardado con el render (vacío si no hay)"""
+    entry = _get_store_entry(doc_hash)
+    return (entry.get('line_map') or {}) if entry is not None else {}
+
+class EditableDocument:
+    """
+    Árbol editable + resolución de ids a través del índice del documento.
+    Documento del almacén: copia en escritura. Cada elemento resuelto se clona
+    (atributos y lista de hijos propios) junto con sus antecesores, y el resto del
+    árbol se comparte con la base, que nunca se modifica. Editar cuesta O(profundidad)
+    por elemento, no O(documento). Los descendientes de un elemento resuelto siguen
+    siendo de la base hasta que se resuelven a su vez.
+    Documento nuevo: se parsea e indexa en privado y se edita directamente.
+    """
+    def __init__(self, root, index, shared=False):
+        self.root = root
+        self.index = index
+        self.shared = shared      # True: el árbol es del almacén (copia en escritura)
+        self.copies = {}          # id(elemento base) → clon editable
+        self.base_of = {}         # id(clon) → elemento base
+        self.local_parents = {}   # padres de elementos insertados o borrados en la edición
+        self.inserted = {}        # id → elemento insertado durante la edición
+        self.resolved = {}        # id → elemento (o None) ya resuelto en esta edición
+        self.used = set()         # ids (Python) de elementos base ya resueltos
+
+    @classmethod
+    def open(cls, doc_hash=None, xml_content=None):
+        """Por hash o por contenido (si ya está en el almacén usa su índice); None si no hay documento"""
+        if not doc_hash and xml_content:
+            doc_hash = content_hash(xml_content)
+        index = get_document_index(doc_hash) if doc_hash else None
+        if index is not None:
+            return cls(get_stored_root(doc_hash), index, shared=True)
+        if not xml_content:
+            return None
+        xml_content = xml_content.replace('xmlns="http://www.musicxml.org/xsd/musicxml.xsd"', '')
+        root = ET.fromstring(xml_content.lstrip('\ufeff').strip())
+        return cls(root, build_element_index(root))
+
+    def _writable(self, base):
+        """Clon editable de un elemento base, clonando antes la cadena de antecesores"""
+        if not self.shared:
+            return base
+        clone = self.copies.get(id(base))
+        if clone is not None:
+            return clone
+
+        clone = ET.Element(base.tag, base.attrib)
+        clone.text, clone.tail = base.text, base.tail
+        clone.extend(base)
+        self.copies[id(base)] = clone
+        self.base_of[id(clone)] = base
+
+        parent = self.index['parents'].get(base)
+        if parent is None:
+            self.root = clone
+            return clone
+        parent = self._writable(parent)
+        position = self.index['positions'].get(base)
+        if position is None or position >= len(parent) or parent[position] is not base:
+            position = list(parent).index(base)  # posición desplazada por otra edición
+        parent[position] = clone
+        return clone
+
+    def resolve(self, element_id, directions_only=False, harmony_first=False):
+        """
+        Elemento editable para un id (ver resolve_direction / resolve_element /
+        resolve_edit_target).
+        Cada id se resuelve una sola vez por edición: un temp_ que aparece en
+        edits y en deletions es siempre el mismo elemento, no la siguiente
+        ocurrencia libre de su texto.
+        """
+        element = self.inserted.get(element_id)
+        if element is not None:
+            return element
+        if element_id in self.resolved:
+            return self.resolved[element_id]
+        if directions_only:
+            resolver = resolve_direction
+        else:
+            resolver = resolve_edit_target if harmony_first else resolve_element
+        base = resolver(self.index, element_id, self.used)
+        if base is not None:
+            self.used.add(id(base))
+            element = self._writable(base)
+        self.resolved[element_id] = element
+        return element
+
+    def parent(self, element):
+        """Padre actual de un elemento (None si es la raíz o ya se borró)"""
+        if element in self.local_parents:
+            return self.local_parents[element]
+        base = self.base_of.get(id(element), element)
+        parent = self.index['parents'].get(base)
+        return self._writable(parent) if parent is not None else None
+
+    def path(self, element):
+        """Ruta de índices de hijos desde la raíz (válida en el momento de la operación)"""
+        path = []
+        parent = self.parent(element)
+        while parent is not None:
+            path.append(list(parent).index(element))
+            element, parent = parent, self.parent(parent)
+        path.reverse()
+        return path
+
+    def attached(self, element):
+        """¿Sigue el elemento en el documento? (no borrado, ni él ni ningún antecesor)"""
+        while element is not self.root:
+            element = self.parent(element)
+            if element is None:
+                return False
+        return True
+
+    def remove(self, element):
+        self.parent(element).remove(element)
+        self.local_parents[element] = None
+
+    def insert(self, parent, position, element):
+        parent.insert(position, element)
+        self.local_parents[element] = parent
+        if element.get('id'):
+            self.inserted[element.get('id')] = element
+
+def get_stored_xml(doc_hash):
+    """Devuelve el texto del documento base (serializando si solo hay árbol), o None"""
+    with _xml_store_lock:
+        entry = _xml_store.get(doc_hash)
+        if entry is not None:
+            _xml_store.move_to_end(doc_hash)
+    record_cache_lookup('document_store', entry is not None)
+    if entry is None:
+        return None
+
+    if entry['xml'] is None:
+        entry['xml'] = musicxml_document(entry['root'])
+    return entry['xml']
+
+# ---------- Ventanas de compases (render paginado) ----------
+
+MEASURE_WINDOW_MAX = 500  # tope de compases por ventana
+
+# Orden de los hijos de <attributes> según el esquema MusicXML
+ATTRIBUTE_ORDER = ('divisions', 'key', 'time', 'staves', 'part-symbol', 'instruments',
+                   'clef', 'staff-details', 'transpose', 'directive', 'measure-style')
+# Atributos que siguen vigentes hasta que otro compás los cambia
+CARRIED_ATTRIBUTES = frozenset(ATTRIBUTE_ORDER[:-2])
+
+def parse_measure_window(params):
+    """
+    Lee el rango pedido: {measure_start, measure_count} o bien
+    {measure_start, systems_per_page, measures_per_system}.
+    Devuelve (start, count) con start 1-based por posición, o None si no se pide rango.
+    Lanza ValueError si los valores no son enteros positivos.
+    """
+    start = params.get('measure_start')
+    count = params.get('measure_count')
+    systems = params.get('systems_per_page')
+    if start is None and count is None and systems is None:
+        return None
+
+    start = int(start or 1)
+    if count is not None:
+        count = int(count)
+    elif systems is not None:
+        count = int(systems) * int(params.get('measures_per_system') or 4)
+    else:
+        count = MEASURE_WINDOW_MAX
+    if start < 1 or count < 1:
+        raise ValueError("measure_start y measure_count deben ser >= 1")
+    return start, min(count, MEASURE_WINDOW_MAX)
+
+def _is_tempo_element(element):
+    if element.tag == 'sound':
+        return element.get('tempo') is not None
+    return (element.find('sound[@tempo]') is not None
+            or element.find('direction-type/metronome') is not None)
+
+def _carry_over_state(measure, carried, tempo):
+    """
+    Inserta en el primer compás de la ventana los atributos vigentes
+    (clave, armadura, compás, divisions...) y el último tempo, si el compás
+    no los redefine.
+    """
+    own = measure.find('attributes')
+    merged = dict(carried)
+    extra = []
+    if own is not None:
+        for child in own:
+            if child.tag in CARRIED_ATTRIBUTES:
+                merged[(child.tag, child.get('number'))] = child
+            else:
+                extra.append(child)
+
+    attributes = ET.Element('attributes')
+    for tag in ATTRIBUTE_ORDER:
+        keys = sorted((k for k in merged if k[0] == tag), key=lambda k: k[1] or '')
+        for key in keys:
+            attributes.append(copy.deepcopy(merged[key]))
+        attributes.extend(copy.deepcopy(c) for c in extra if c.tag == tag)
+
+    # Mismo sitio que los atributos originales, o tras los <print> iniciales
+    children = list(measure)
+    if own is not None:
+        index = children.index(own)
+        measure.remove(own)
+    else:
+        index = 0
+        while index < len(children) and children[index].tag == 'print':
+            index += 1
+    measure.insert(index, attributes)
+
+    has_own_tempo = any(_is_tempo_element(el) for el in measure if el.tag in ('direction', 'sound'))
+    if tempo is not None and not has_own_tempo:
+        tempo = copy.deepcopy(tempo)
+        offset = tempo.find('offset')
+        if offset is not None:
+            tempo.remove(offset)  # relativo a su posición original
+        measure.insert(index + 1, tempo)
+
+def slice_measure_window(root, start, count):
+    """
+    Construye un documento MusicXML independiente con los compases
+    [start, start+count) de cada parte (posición 1-based, no el atributo number).
+    Solo se copian los compases de la ventana; el resto del árbol se comparte.
+    Devuelve (window_root, {'start', 'end', 'total'}).
+    """
+    parts = root.findall('part')
+    total = max((len(part.findall('measure')) for part in parts), default=0)
+    start = max(1, min(start, total or 1))
+    end = min(total, start + count - 1)
+
+    window = ET.Element(root.tag, root.attrib)
+    for child in root:
+        if child.tag != 'part':
+            window.append(copy.deepcopy(child))
+            continue
+
+        new_part = ET.SubElement(window, 'part', child.attrib)
+        carried = {}
+        tempo = None
+        for position, measure in enumerate(child.findall('measure'), 1):
+            if position < start:
+                # Acumular el estado vigente sin copiar nada
+                for attributes in measure.findall('attributes'):
+                    for attr in attributes:
+                        if attr.tag in CARRIED_ATTRIBUTES:
+                            carried[(attr.tag, attr.get('number'))] = attr
+                for element in measure:
+                    if element.tag in ('direction', 'sound') and _is_tempo_element(element):
+                        tempo = element
+                continue
+            if position > end:
+                break
+            measure_copy = copy.deepcopy(measure)
+            if position == start and start > 1:
+                _carry_over_state(measure_copy, carried, tempo)
+            new_part.append(measure_copy)
+
+    return window, {'start': start, 'end': end, 'total': total}
+
+def measure_window_response(response, doc_hash, window):
+    """
+    Sustituye el cuerpo de una respuesta MusicXML por la ventana de compases pedida
+    (el documento completo sigue en el almacén bajo doc_hash para las páginas siguientes).
+    """
+    try:
+        root = get_stored_root(doc_hash)
+    except ET.ParseError as e:
+        app.logger.warning(f"[Paginado] No se pudo parsear el documento, se devuelve completo: {e}")
+        return response
+    if root is None:
+        return response
+    window_root, info = slice_measure_window(root, *window)
+    if info['start'] > 1 or info['end'] < info['total']:
+        response.set_data(musicxml_document(window_root))
+        app.logger.info(f"[Paginado] 📄 Compases {info['start']}-{info['end']} de {info['total']}")
+    response.headers['X-Measure-Start'] = str(info['start'])
+    response.headers['X-Measure-End'] = str(info['end'])
+    response.headers['X-Measure-Total'] = str(info['total'])
+    return response
+
+def apply_patch_ops(document, ops):
+    """
+    Aplica operaciones de parche sobre ids de elementos de un EditableDocument.
+      {"op": "set-attribute", "id", "attr", "value"}   (value None → borrar atributo)
+      {"op": "delete", "id"}
+      {"op": "insert", "parent": id | "after": id, "index"?: int, "xml": "<...>"}
+    Devuelve (changes, report): changes son los fragmentos modificados con la ruta
+    de índices de hijos, en orden de aplicación, para que el cliente los replique.
+    Un id borrado antes en el mismo lote (o dentro de un elemento borrado) ya no
+    existe: not_found, nunca un cambio con una ruta de nodo suelto.
+    """
+    changes = []
+    report = []
+
+    for op in ops:
+        kind = op.get('op')
+        try:
+            if kind == 'set-attribute':
+                element = document.resolve(op.get('id'))
+                if element is None or not document.attached(element):
+                    report.append({"op": kind, "id": op.get('id'), "status": "not_found"})
+                    continue
+                attr = op['attr']
+                value = op.get('value')
+                if value is None:
+                    element.attrib.pop(attr, None)
+                else:
+                    element.set(attr, str(value))
+                changes.append({
+                    "op": kind,
+                    "path": document.path(element),
+                    "attr": attr,
+                    "value": None if value is None else str(value)
+                })
+
+            elif kind == 'delete':
+                element = document.resolve(op.get('id'))
+                if element is None or element is document.root or not document.attached(element):
+                    report.append({"op": kind, "id": op.get('id'), "status": "not_found"})
+                    continue
+                changes.append({"op": kind, "path": document.path(element)})
+                document.remove(element)
+
+            elif kind == 'insert':
+                if op.get('after') is not None:
+                    sibling = document.resolve(op['after'])
+                    parent = document.parent(sibling) if sibling is not None else None
+                    position = list(parent).index(sibling) + 1 if parent is not None else None
+                else:
+                    parent = document.resolve(op.get('parent'))
+                    position = op.get('index')
+                if parent is None or not document.attached(parent):
+                    report.append({"op": kind, "id": op.get('after', op.get('parent')), "status": "not_found"})
+                    continue
+
+                element = ET.fromstring(op['xml'])
+                if position is None or position > len(parent):
+                    position = len(parent)
+                document.insert(parent, position, element)
+
+                changes.append({
+                    "op": kind,
+                    "path": document.path(parent),
+                    "index": position,
+                    "xml": ET.tostring(element, encoding='unicode', method='xml')
+                })
+
+            else:
+                report.append({"op": kind, "status": "unsupported"})
+                continue
+
+            report.append({"op": kind, "id": op.get('id'), "status": "applied"})
+        except (KeyError, ValueError, ET.ParseError) as e:
+            report.append({"op": kind, "id": op.get('id'), "status": "error", "error": str(e)})
+
+    return changes, report
+
+@app.route("/apply-patch", methods=["POST"])
+def apply_patch():
+    """
+    Protocolo delta para ediciones visuales.
+    Input:  {base_hash, ops: [...], xml_content?}
+            xml_content solo hace falta si el servidor no conoce base_hash.
+    Output: {hash, base_hash, changes, report}
+            409 {base_unknown: true} si no conoce la base y no se envió el XML.
+    """
+    data = request.get_json(silent=True) or {}
+    base_hash = data.get("base_hash")
+    ops = data.get("ops", [])
+    xml_content = data.get("xml_content")
+
+    try:
+        base_root = get_stored_root(base_hash) if base_hash else None
+        full_transfer = False
+
+        if base_root is None:
+            if not xml_content:
+                return jsonify({
+                    "error": "Documento base desconocido, reenviar con xml_content.",
+                    "base_unknown": True
+                }), 409
+            base_hash = store_xml_document(xml_content)
+            base_root = get_stored_root(base_hash)
+            full_transfer = True
+
+        # La base es inmutable: el parche clona solo lo que toca (copia en escritura),
+        # resolviendo los ids con el índice cacheado de la base
+        document = EditableDocument.open(base_hash)
+        changes, report = apply_patch_ops(document, ops)
+
+        # Direccionado por contenido, como cualquier otro documento del almacén: el mismo
+        # resultado (por otra secuencia de ops o subido como XML) comparte hash y entrada
+        new_xml = musicxml_document(document.root)
+        new_hash = content_hash(new_xml)
+        if _get_store_entry(new_hash) is None:
+            _store_put(new_hash, {'xml': new_xml, 'root': document.root,
+                                  'line_map': get_document_line_map(base_hash)})
+
+        applied = sum(1 for r in report if r["status"] == "applied")
+        app.logger.info(f"[apply-patch] {base_hash[:8]} → {new_hash[:8]}: {applied}/{len(ops)} operación(es), full_transfer={full_transfer}")
+
+        return jsonify({
+            "hash": new_hash,
+            "base_hash": base_hash,
+            "full_transfer": full_transfer,
+            "changes": changes,
+            "report": report
+        })
+
+    except ET.ParseError as e:
+        app.logger.error(f"Error al parsear MusicXML: {e}")
+        return jsonify({"error": f"Error al parsear MusicXML: {e}"}), 400
+    except Exception as e:
+        app.logger.exception(f"Error en /apply-patch: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/document/<doc_hash>")
+def get_document(doc_hash):
+    """
+    Transferencia completa de un documento del almacén (fallback del protocolo delta).
+    ?format=mxl lo devuelve comprimido.
+    """
+    root = get_stored_root(doc_hash)
+    if root is None:
+        return jsonify({"error": "Documento desconocido", "base_unknown": True}), 404
+    if request.args.get('format') == 'mxl':
+        return mxl_response(get_stored_xml(doc_hash), f"partitura_{doc_hash[:12]}")
+    return Response(musicxml_document(root), mimetype="application/vnd.recordare.musicxml+xml; charset=utf-8")
+
+@app.route("/document/<doc_hash>/index")
+def get_document_index_entries(doc_hash):
+    """
+    Índice de elementos del documento: id → {kind, part, measure, offset, line, path}.
+    Se construye una vez por documento y es el mismo que usan los endpoints de edición.
+    """
+    index = get_document_index(doc_hash)
+    if index is None:
+        return jsonify({"error": "Documento desconocido", "base_unknown": True}), 404
+    entries = index_entries(index, get_document_line_map(doc_hash))
+    return jsonify({"hash": doc_hash, "count": len(entries), "elements": entries})
+
+@app.route("/document/<doc_hash>/element/<path:element_id>")
+def get_document_element(doc_hash, element_id):
+    """Una entrada del índice (incluye ids con '/', como los de compás 'P1/3')"""
+    index = get_document_index(doc_hash)
+    if index is None:
+        return jsonify({"error": "Documento desconocido", "base_unknown": True}), 404
+    element = resolve_element(index, element_id)
+    if element is None:
+        return jsonify({"error": f"Elemento desconocido: {element_id}"}), 404
+    return jsonify(describe_element(index, element_id, element, get_document_line_map(doc_hash)))
+
+@app.route("/document/<doc_hash>/measures")
+def get_document_measures(doc_hash):
+    """
+    Ventana de compases de un documento del almacén (páginas siguientes del render paginado).
+    Query: ?start=N&count=M (posición 1-based)
+    """
+    if get_stored_root(doc_hash) is None:
+        return jsonify({"error": "Documento desconocido", "base_unknown": True}), 404
+    try:
+        window = parse_measure_window({
+            'measure_start': request.args.get('start', 1),
+            'measure_count': request.args.get('count'),
+            'systems_per_page': request.args.get('systems_per_page'),
+            'measures_per_system': request.args.get('measures_per_system'),
+        })
+    except ValueError as e:
+        return jsonify({"error": f"Rango de compases inválido: {e}"}), 400
+
+    window_root, info = slice_measure_window(get_stored_root(doc_hash), *window)
+    response = Response(musicxml_document(window_root), mimetype="application/vnd.recordare.musicxml+xml; charset=utf-8")
+    response.headers['X-Content-Hash'] = doc_hash
+    response.headers['X-Measure-Start'] = str(info['start'])
+    response.headers['X-Measure-End'] = str(info['end'])
+    response.headers['X-Measure-Total'] = str(info['total'])
+    return response
+
+# ============================================================
+# ========== TRANSPOSICIÓN DIRECTA SOBRE MUSICXML ============
+# ============================================================
+
+STEP_NAMES = ('C', 'D', 'E', 'F', 'G', 'A', 'B')
+STEP_SEMITONES = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}  # paso → semitono (transposición, soundfonts, análisis)
+STEP_FIFTHS = (0, 2, 4, -1, 1, 3, 5)   # posición en la línea de quintas (C = 0)
+ALTER_ACCIDENTALS = {-2: 'flat-flat', -1: 'flat', 0: 'natural', 1: 'sharp', 2: 'double-sharp'}
+INTERVAL_RE = re.compile(r'^(-?)(P|M|m|A+|d+)(-?)(\d+)$')
+
+def parse_interval(spec):
+    """
+    Intervalo → (diatonic, chromatic), como en <transpose> de MusicXML.
+    Acepta nombres de music21 ('M2', 'm-3', '-P5', 'A4', 'P8')
+    o un dict {'diatonic': d, 'chromatic': c}.
+    """
+    if isinstance(spec, dict):
+        return int(spec.get('diatonic', 0)), int(spec.get('chromatic', 0))
+    match = INTERVAL_RE.match(str(spec).strip())
+    if not match:
+        raise ValueError(f"Intervalo no reconocido: {spec}")
+    sign_a, quality, sign_b, number = match.groups()
+    number = int(number)
+    if number < 1:
+        raise ValueError(f"Intervalo no reconocido: {spec}")
+
+    diatonic = number - 1
+    simple = diatonic % 7
+    semitones = STEP_SEMITONES[STEP_NAMES[simple]] + 12 * (diatonic // 7)
+    perfect = simple in (0, 3, 4)
+    if quality == 'P':
+        if not perfect:
+            raise ValueError(f"{spec}: la {number}ª no es un intervalo justo")
+    elif quality in ('M', 'm'):
+        if perfect:
+            raise ValueError(f"{spec}: la {number}ª no es mayor/menor")
+        semitones -= 1 if quality == 'm' else 0
+    elif quality[0] == 'A':
+        semitones += len(quality)
+    else:  # disminuido
+        semitones -= len(quality) + (0 if perfect else 1)
+
+    if sign_a or sign_b:
+        return -diatonic, -semitones
+    return diatonic, semitones
+
+def transpose_step(step_index, alter, octave, interval):
+    """(paso, alteración, octava) transportado con la ortografía del intervalo"""
+    diatonic, chromatic = interval
+    target = step_index + diatonic
+    new_step = target % 7
+    new_octave = octave + target // 7
+    old_semitone = 12 * octave + STEP_SEMITONES[STEP_NAMES[step_index]] + alter
+    new_alter = old_semitone + chromatic - (12 * new_octave + STEP_SEMITONES[STEP_NAMES[new_step]])
+    return new_step, new_alter, new_octave
+
+def _format_alter(alter):
+    return str(int(alter)) if float(alter).is_integer() else str(alter)
+
+# Tokens que reescribe la pasada de transposición; el resto del texto se copia tal cual
+TRANSPOSE_TOKEN_RE = re.compile(
+    r'<(?:part\s[^>]*?\bid="(?P<part>[^"]*)"[^>]*>'
+    r'|(?P<measure>measure\b[^>]*>)'
+    r'|(?P<attributes>attributes\b[^>]*>.*?</attributes>)'
+    r'|(?P<pitch>pitch>.*?</pitch>)'
+    r'|(?P<accidental>accidental\b[^>]*>)[^<]*</accidental>'
+    r'|(?P<harmony_step>(?P<harmony_tag>root|bass)>.*?</(?P=harmony_tag)>))',
+    re.S
+)
+PITCH_PARTS_RE = re.compile(r'<step>\s*([A-G])\s*</step>(?:\s*<alter>\s*([-\d.]+)\s*</alter>)?\s*<octave>\s*(-?\d+)\s*</octave>')
+HARMONY_STEP_RE = re.compile(r'<(root|bass)-step(\s[^>]*)?>\s*([A-G])\s*</\1-step>(?:\s*<\1-alter>\s*([-\d.]+)\s*</\1-alter>)?')
+STEP_TEXT_RE = re.compile(r'\btext="[^"]*"')
+KEY_FIFTHS_RE = re.compile(r'(<key\b[^>]*>.*?<fifths>)\s*(-?\d+)\s*(</fifths>.*?</key>)', re.S)
+TRANSPOSE_ELEMENT_RE = re.compile(r'\s*<transpose\b[^>]*>.*?</transpose>', re.S)
+
+def _transpose_pitch_xml(text, interval):
+    """'<pitch>…</pitch>' → (texto transportado, nueva alteración)"""
+    match = PITCH_PARTS_RE.search(text)
+    if not match:
+        return text, None
+    step, alter, octave = match.groups()
+    new_step, new_alter, new_octave = transpose_step(
+        STEP_NAMES.index(step), float(alter or 0), int(octave), interval)
+    alter_xml = f"<alter>{_format_alter(new_alter)}</alter>" if new_alter else ""
+    return f"<pitch><step>{STEP_NAMES[new_step]}</step>{alter_xml}<octave>{new_octave}</octave></pitch>", new_alter
+
+def _transpose_harmony_xml(text, interval):
+    """'<root>…</root>' o '<bass>…</bass>' de un <harmony>, con su texto de display"""
+    match = HARMONY_STEP_RE.search(text)
+    if not match:
+        return text
+    tag, attrs, step, alter = match.groups()
+    new_step, new_alter, _ = transpose_step(STEP_NAMES.index(step), float(alter or 0), 4, interval)
+    attrs = attrs or ''
+    if 'text=' in attrs:
+        suffix = {-2: 'bb', -1: 'b', 0: '', 1: '#', 2: '##'}.get(int(new_alter), '')
+        attrs = STEP_TEXT_RE.sub(f'text="{STEP_NAMES[new_step]}{suffix}"', attrs)
+    alter_xml = f"<{tag}-alter>{_format_alter(new_alter)}</{tag}-alter>" if new_alter else ""
+    return text[:match.start()] + f"<{tag}-step{attrs}>{STEP_NAMES[new_step]}</{tag}-step>{alter_xml}" + text[match.end():]
+
+def transpose_fifths(fifths, interval):
+    """
+    Transporta una armadura moviendo su tónica mayor por el intervalo.
+    Devuelve (fifths, intervalo de ortografía). Más de 7 alteraciones se reescriben
+    enarmónicamente (G♯ → A♭: un paso de letra más, mismos semitonos) y el intervalo
+    devuelto es el enarmónico, para que notas y cifrados concuerden con la armadura.
+    """
+    tonic_step = (fifths * 4) % 7  # C movido 'fifths' quintas
+    tonic_alter = (fifths - STEP_FIFTHS[tonic_step]) // 7
+    new_step, new_alter, _ = transpose_step(tonic_step, tonic_alter, 4, interval)
+    new_fifths = int(STEP_FIFTHS[new_step] + 7 * new_alter)
+    if new_fifths > 7:
+        return new_fifths - 12, (interval[0] + 1, interval[1])
+    if new_fifths < -7:
+        return new_fifths + 12, (interval[0] - 1, interval[1])
+    return new_fifths, interval
+
+def _add_intervals(a, b):
+    return a[0] + b[0], a[1] + b[1]
+
+def _read_transpose(transpose_xml):
+    """<transpose> → (diatonic, chromatic) de escrito a sonido (incluye octave-change)"""
+    element = ET.fromstring(transpose_xml.strip())
+    octave_change = int(element.findtext('octave-change') or 0)
+    return (int(element.findtext('diatonic') or 0) + 7 * octave_change,
+            int(element.findtext('chromatic') or 0) + 12 * octave_change)
+
+def _transpose_xml(interval):
+    return f"<transpose><diatonic>{interval[0]}</diatonic><chromatic>{interval[1]}</chromatic></transpose>"
+
+def transpose_musicxml(xml_text, interval=(0, 0), parts=None, to_concert=False, to_written=None):
+    """
+    Transporta MusicXML en una sola pasada sobre el texto: <pitch>, <accidental>,
+    <key>/<fifths> y <harmony> root/bass; el resto se copia sin parsear.
+    - parts: ids de <part> a transportar por 'interval' (None = todas)
+    - to_concert: cada parte con <transpose> pasa a sonido real y se elimina el elemento
+    - to_written: {part_id: intervalo escrito→sonido}, pasa de sonido real a escrito
+      y escribe el <transpose> correspondiente
+    Devuelve (xml_text, informe).
+    """
+    to_written = to_written or {}
+    report = {'notes': 0, 'keys': 0, 'harmonies': 0, 'parts': 0, 'keys_respelled': 0}
+    memo = {}  # (intervalo, texto) → reescritura: las alturas distintas son pocas
+    # current: intervalo de la parte; spelling: el que se aplica a notas y cifrados
+    # (su enarmónico mientras rija una armadura reescrita, ver transpose_fifths)
+    state = {'base': interval, 'current': interval, 'spelling': interval, 'written': None,
+             'pending': False, 'alter': None, 'counted': False}
+
+    def transpose_attributes(text):
+        written = state['written']
+        if to_concert or written is not None:
+            for transpose_match in TRANSPOSE_ELEMENT_RE.finditer(text):
+                if to_concert:
+                    state['current'] = _add_intervals(state['base'], _read_transpose(transpose_match.group(0)))
+                    state['spelling'] = state['current']
+            text = TRANSPOSE_ELEMENT_RE.sub('', text)
+        if state['pending']:
+            text = text[:-len('</attributes>')] + _transpose_xml(written) + '</attributes>'
+            state['pending'] = False
+
+        current = state['current']
+        if current == (0, 0):
+            return text
+
+        def replace_key(match):
+            fifths, spelling = transpose_fifths(int(match.group(2)), current)
+            state['spelling'] = spelling
+            report['keys'] += 1
+            report['keys_respelled'] += spelling != current
+            return f"{match.group(1)}{fifths}{match.group(3)}"
+        return KEY_FIFTHS_RE.sub(replace_key, text)
+
+    def replace(match):
+        kind = match.lastgroup
+        text = match.group(0)
+
+        if kind == 'part':
+            part_id = match.group('part')
+            base = interval if parts is None or part_id in parts else (0, 0)
+            written = to_written.get(part_id)
+            if written is not None:
+                base = _add_intervals(base, (-written[0], -written[1]))
+            state.update(base=base, current=base, spelling=base, written=written,
+                         pending=written is not None, alter=None, counted=False)
+            return text
+
+        if kind == 'measure':
+            # Primer compás sin <attributes>: hace falta uno para el <transpose> nuevo
+            if state['pending']:
+                source = match.string
+                measure_end = source.find('</measure>', match.end())
+                if source.find('<attributes', match.end(), measure_end) < 0:
+                    state['pending'] = False
+                    return text + f"<attributes>{_transpose_xml(state['written'])}</attributes>"
+            return text
+
+        if kind == 'attributes':
+            return transpose_attributes(text)
+
+        if state['current'] == (0, 0):
+            return text
+        current = state['spelling']
+        if not state['counted']:
+            report['parts'] += 1
+            state['counted'] = True
+
+        if kind == 'pitch':
+            key = (current, text)
+            if key not in memo:
+                memo[key] = _transpose_pitch_xml(text, current)
+            text, state['alter'] = memo[key]
+            report['notes'] += 1
+            return text
+
+        if kind == 'accidental':
+            # El <accidental> sigue a su <pitch>: refleja la alteración nueva
+            alter = state['alter']
+            if alter is None or alter not in ALTER_ACCIDENTALS:
+                return text
+            return f"<{match.group('accidental')}{ALTER_ACCIDENTALS[int(alter)]}</accidental>"
+
+        # root/bass de <harmony>
+        key = (current, text)
+        if key not in memo:
+            memo[key] = _transpose_harmony_xml(text, current)
+        report['harmonies'] += match.group('harmony_tag') == 'root'
+        return memo[key]
+
+    return TRANSPOSE_TOKEN_RE.sub(replace, xml_text), report
+
+@app.route("/transpose", methods=["POST"])
+def transpose_document():
+    """
+    Transporta MusicXML ya renderizado sin pasar por music21.
+    Input: {hash | xml_content, interval?: 'M2' | {diatonic, chromatic},
+            parts?: [ids], to_concert?: bool, to_written?: {part_id: intervalo}}
+    Output: MusicXML transportado (nuevo documento del almacén, X-Content-Hash)
+            + X-Transpose-Report
+    Trabaja sobre el texto (ver transpose_musicxml): sin árbol, copia ni serialización.
+    """
+    data = request.get_json(silent=True) or {}
+    started = time.perf_counter()
+    try:
+        interval = parse_interval(data.get('interval', 'P1'))
+        to_written = {pid: parse_interval(spec) for pid, spec in (data.get('to_written') or {}).items()}
+        parts = data.get('parts')
+        if parts is not None and not isinstance(parts, list):
+            raise ValueError("'parts' debe ser una lista de ids de <part>")
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        base_hash = data.get('hash')
+        xml_text = get_stored_xml(base_hash) if base_hash else None
+        if xml_text is None:
+            xml_content = data.get('xml_content')
+            if not xml_content:
+                return jsonify({
+                    "error": "Documento desconocido, reenviar con xml_content.",
+                    "base_unknown": True
+                }), 409 if base_hash else 400
+            xml_text = xml_content.lstrip('\ufeff').strip()
+            base_hash = store_xml_document(xml_text)
+
+        final_xml, report = transpose_musicxml(
+            xml_text, interval, parts, bool(data.get('to_concert')), to_written)
+        new_hash = store_xml_document(final_xml)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        app.logger.info(f"[Transpose] 🎚️ {base_hash[:8]} → {new_hash[:8]}: {report['notes']} notas, "
+                        f"{report['keys']} armaduras, {report['harmonies']} cifrados en {elapsed_ms:.1f}ms")
+
+        response = Response(final_xml, mimetype="application/vnd.recordare.musicxml+xml; charset=utf-8")
+        response.headers['X-Content-Hash'] = new_hash
+        response.headers['X-Base-Hash'] = base_hash
+        response.headers['X-Transpose-Report'] = json.dumps(report, separators=(',', ':'))
+        return response
+
+    except Exception as e:
+        app.logger.exception(f"Error en /transpose: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/admission")
+def admission_status():
+    """Estado del control de admisión: en curso, profundidad de cola y tiempos de espera"""
+    return jsonify(admission.snapshot())
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Métricas del backend en formato de texto Prometheus (para scrape o curl)"""
+    if not metrics.enabled:
+        return jsonify({"error": "Métricas deshabilitadas (SCORE_VIEWER_METRICS_ENABLED)"}), 404
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route("/debug/memory", methods=["GET", "POST"])
+def debug_memory():
+    """
+    Volcado de memoria: top de sitios de asignación, crecimiento desde el arranque,
+    diferencia con el render anterior, RSS/pico por petición y Score vivos.
+    POST {enabled: bool} activa o desactiva tracemalloc en caliente.
+    """
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        if data.get("enabled"):
+            memory_diagnostics.start()
+        elif memory_diagnostics.enabled:
+            memory_diagnostics.stop()
+            app.logger.info("[Memoria] tracemalloc desactivado")
+
+    if not memory_diagnostics.enabled:
+        return jsonify({"enabled": False, "rss_mb": round((_current_rss_bytes() or 0) / (1024 * 1024), 1)})
+
+    key_type = request.args.get("group", "lineno")
+    if key_type not in ("lineno", "filename", "traceback"):
+        return jsonify({"error": "group debe ser lineno, filename o traceback"}), 400
+    try:
+        limit = int(request.args["limit"]) if "limit" in request.args else None
+    except ValueError:
+        return jsonify({"error": "limit debe ser un entero"}), 400
+    return jsonify(memory_diagnostics.report(limit, key_type))
+
+@app.route("/debug/profile/<profile_id>")
+def debug_profile(profile_id):
+    """
+    Perfil de una petición marcada con X-Profile / ?profile=sample|cprofile.
+    format=collapsed (flamegraph.pl, speedscope), json (árbol d3-flamegraph),
+    pstats (texto) o prof (binario para snakeviz; solo modo cprofile).
+    """
+    with _profile_store_lock:
+        profile = _profile_store.get(profile_id)
+    if profile is None:
+        return jsonify({"error": "Perfil desconocido"}), 404
+
+    fmt = request.args.get("format", "collapsed" if profile["mode"] == "sample" else "pstats")
+    summary = {k: profile[k] for k in ("mode", "path", "created", "seconds")}
+    if profile["mode"] == "sample":
+        if fmt == "collapsed":
+            lines = (f"{stack} {count}" for stack, count in
+                     sorted(profile["stacks"].items(), key=lambda item: -item[1]))
+            return Response("\n".join(lines) + "\n", mimetype="text/plain; charset=utf-8")
+        if fmt == "json":
+            return jsonify({**summary, "samples": profile["samples"], "interval_ms": profile["interval_ms"],
+                            "tree": collapsed_to_tree(profile["stacks"])})
+    else:
+        if fmt == "pstats":
+            return Response(profile["pstats"], mimetype="text/plain; charset=utf-8")
+        if fmt == "prof":
+            response = Response(marshal.dumps(profile["stats"]), mimetype="application/octet-stream")
+            response.headers['Content-Disposition'] = f'attachment; filename="{profile_id}.prof"'
+            return response
+    return jsonify({"error": f"Formato '{fmt}' no disponible para el modo {profile['mode']}"}), 400
+
+@app.route("/render-test")
 def render_test():
     return jsonify({
         "ok": True,
@@ -1156,7 +3612,50 @@ def generate_chord_accompaniment(score_obj, rhythm_type='auto', octave=3, veloci
     return accomp_part
 
 
+def xml_to_midi_bytes(xml_payload, include_chords=False, chord_rhythm='half', chord_octave=3, chord_velocity=0.5):
+    """
+    Convierte MusicXML a un Standard MIDI File (bytes), con acompañamiento
+    de cifrados opcional (ver generate_chord_accompaniment).
+    """
+    import tempfile
+    
+    # Parsear el XML generado de vuelta a Score
+    score_obj = converter.parse(xml_payload)
+    
+    # Si se solicita acompañamiento, generarlo
+    if include_chords:
+        app.logger.info("[MIDI Export] Generando acompañamiento de cifrados...")
+        accomp_part = generate_chord_accompaniment(
+            score_obj,
+            rhythm_type=chord_rhythm,
+            octave=chord_octave,
+            velocity=chord_velocity
+        )
+        
+        if accomp_part:
+            # Añadir Part de acompañamiento al Score
+            score_obj.insert(0, accomp_part)
+            app.logger.info("[MIDI Export] ✅ Pista de acompañamiento añadida")
+        else:
+            app.logger.info("[MIDI Export] ⚠️ No se generó acompañamiento (sin cifrados)")
+    
+    # Crear archivo temporal
+    fd, temp_path = tempfile.mkstemp(suffix='.mid')
+    os.close(fd)
+    
+    try:
+        score_obj.write('midi', fp=temp_path)
+        
+        # Leer contenido
+        with open(temp_path, 'rb') as f:
+            return f.read()
+    finally:
+        # Limpiar archivo temporal
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
 @app.route("/export-midi", methods=["POST"])
+@admission_controlled('export')
 def export_midi():
     """
     Recibe código Python con music21
@@ -1188,70 +3687,837 @@ def export_midi():
         if err:
             return jsonify({"error": err}), 400
 
-        # Parsear el XML generado de vuelta a Score
-        score_obj = converter.parse(xml_payload)
-        
-        # Si se solicita acompañamiento, generarlo
-        if include_chords:
-            app.logger.info("[MIDI Export] Generando acompañamiento de cifrados...")
-            accomp_part = generate_chord_accompaniment(
-                score_obj,
-                rhythm_type=chord_rhythm,
-                octave=chord_octave,
-                velocity=chord_velocity
-            )
-            
-            if accomp_part:
-                # Añadir Part de acompañamiento al Score
-                score_obj.insert(0, accomp_part)
-                app.logger.info("[MIDI Export] ✅ Pista de acompañamiento añadida")
-            else:
-                app.logger.info("[MIDI Export] ⚠️ No se generó acompañamiento (sin cifrados)")
-        
-        # Exportar a MIDI
-        import tempfile
-        import os
-        
-        # Crear archivo temporal
-        fd, temp_path = tempfile.mkstemp(suffix='.mid')
-        os.close(fd)
+        midi_content = xml_to_midi_bytes(
+            xml_payload,
+            include_chords=include_chords,
+            chord_rhythm=chord_rhythm,
+            chord_octave=chord_octave,
+            chord_velocity=chord_velocity
+        )
         
-        try:
-            score_obj.write('midi', fp=temp_path)
-            
-            # Leer contenido
-            with open(temp_path, 'rb') as f:
-                midi_content = f.read()
-            
-            # Limpiar archivo temporal
-            os.unlink(temp_path)
-            
-            # Devolver MIDI
-            return Response(
-                midi_content,
-                mimetype='audio/midi',
-                headers={
-                    'Content-Disposition': 'attachment; filename=score.mid'
-                }
-            )
-        except Exception as e:
-            # Limpiar en caso de error
-            if os.path.exists(temp_path):
-                os.unlink(temp_path)
-            raise e
+        # Devolver MIDI
+        return Response(
+            midi_content,
+            mimetype='audio/midi',
+            headers={
+                'Content-Disposition': 'attachment; filename=score.mid'
+            }
+        )
             
     except Exception as e:
         app.logger.exception(f"Error en /export-midi: {e}")
         return jsonify({"error": str(e)}), 500
 
+# ============================================================
+# ========= EVENTOS DE NOTA PARA REPRODUCCIÓN (BINARIO) ======
+# ============================================================
+
+# Cabecera little-endian: magic, nº de eventos, nº de pistas, duración total (s)
+PLAYBACK_EVENTS_MAGIC = b'SVEV'
+PLAYBACK_EVENTS_HEADER = struct.Struct('<4sIIf')
+
+def build_tempo_map(score_obj):
+    """
+    Devuelve (offsets, seconds, secs_per_quarter) para convertir offsets en
+    negras a segundos: tramos entre MetronomeMark con su inicio acumulado.
+    """
+    offsets, seconds, rates = [], [], []
+    elapsed = 0.0
+    for start, end, mm in score_obj.metronomeMarkBoundaries():
+        offsets.append(float(start))
+        seconds.append(elapsed)
+        rate = mm.secondsPerQuarter()
+        rates.append(rate)
+        elapsed += (float(end) - float(start)) * rate
+    return offsets, seconds, rates
+
+def offset_to_seconds(tempo_map, offset):
+    """Offset en negras → segundos según el mapa de tempo (búsqueda binaria)"""
+    offsets, seconds, rates = tempo_map
+    i = max(0, bisect.bisect_right(offsets, offset) - 1)
+    return seconds[i] + (offset - offsets[i]) * rates[i]
+
+def collect_part_events(part, track, tempo_map, events):
+    """
+    Añade a events (onset_s, dur_s, pitch, velocity, track) las notas de un Part.
+    Las ligaduras se funden en una sola nota, como en la exportación MIDI.
+    """
+    flat = part.flatten()
+    volume.realizeVolume(flat)
+    open_ties = {}  # pitch MIDI → índice del evento que sigue ligado
+
+    for n in flat.getElementsByClass(note.NotRest):
+        if isinstance(n, harmony.ChordSymbol) and not n.writeAsChord:
+            continue  # los cifrados solo suenan vía acompañamiento
+        ql = float(n.duration.quarterLength)
+        if ql <= 0:
+            continue  # notas de adorno
+        start = float(flat.elementOffset(n))
+        onset = offset_to_seconds(tempo_map, start)
+        end = offset_to_seconds(tempo_map, start + ql)
+        velocity = max(1, min(127, int(round(n.volume.cachedRealized * 127))))
+
+        components = n.notes if isinstance(n, chord.Chord) else (n,)
+        for component in components:
+            if not hasattr(component, 'pitch'):
+                continue  # Unpitched
+            midi = component.pitch.midi
+            tie = component.tie if component.tie is not None else n.tie
+            tie_type = tie.type if tie is not None else None
+
+            if tie_type in ('stop', 'continue') and midi in open_ties:
+                index = open_ties[midi]
+                ev = events[index]
+                events[index] = (ev[0], end - ev[0], ev[2], ev[3], ev[4])
+                if tie_type == 'stop':
+                    del open_ties[midi]
+                continue
+
+            if tie_type == 'start':
+                open_ties[midi] = len(events)
+            events.append((onset, end - onset, midi, velocity, track))
+
+def score_to_note_events(score_obj, include_chords=False, chord_rhythm='half',
+                         chord_octave=3, chord_velocity=0.5):
+    """
+    Deriva del Score los eventos de nota ordenados por onset, con el
+    acompañamiento de cifrados opcional como última pista.
+    Devuelve (events, track_count).
+    """
+    tempo_map = build_tempo_map(score_obj)
+    parts = list(score_obj.parts) or [score_obj]
+
+    if include_chords:
+        accomp_part = generate_chord_accompaniment(
+            score_obj,
+            rhythm_type=chord_rhythm,
+            octave=chord_octave,
+            velocity=chord_velocity
+        )
+        if accomp_part:
+            parts.append(accomp_part)
+
+    events = []
+    for track, part in enumerate(parts):
+        collect_part_events(part, track, tempo_map, events)
+    events.sort(key=lambda ev: (ev[0], ev[4], ev[2]))
+    return events, len(parts)
+
+def pack_note_events(events, track_count):
+    """
+    Serializa los eventos como arrays tipados (structure of arrays):
+    cabecera de 16 bytes, onset[f32], duration[f32], pitch[u8], velocity[u8], track[u8].
+    Los bloques f32 quedan alineados a 4 bytes para Float32Array en el cliente.
+    """
+    onsets = array.array('f', (ev[0] for ev in events))
+    durations = array.array('f', (ev[1] for ev in events))
+    if sys.byteorder == 'big':
+        onsets.byteswap()
+        durations.byteswap()
+    total = max((ev[0] + ev[1] for ev in events), default=0.0)
+
+    return b''.join((
+        PLAYBACK_EVENTS_HEADER.pack(PLAYBACK_EVENTS_MAGIC, len(events), track_count, total),
+        onsets.tobytes(),
+        durations.tobytes(),
+        bytes(ev[2] for ev in events),
+        bytes(ev[3] for ev in events),
+        bytes(min(ev[4], 255) for ev in events),
+    ))
+
+@app.route("/playback-events", methods=["POST"])
+@admission_controlled('export')
+def playback_events():
+    """
+    Recibe código Python con music21 y devuelve los eventos de nota en
+    binario (ver pack_note_events) para programarlos directamente en el
+    navegador, sin codificar/decodificar un fichero MIDI.
+    Acepta los mismos parámetros de acompañamiento que /export-midi.
+    """
+    try:
+        data = request.get_json()
+        code_str = data.get('code', '')
+
+        include_chords = data.get('include_chords', False)
+        chord_rhythm = data.get('chord_rhythm', 'half')
+        chord_octave = data.get('chord_octave', 3)
+        chord_velocity = data.get('chord_velocity', 0.5)
+
+        if not code_str.strip():
+            return "Error: código vacío", 400
+
+        score_out = {}
+        xml_payload, warnings_list, err, element_line_map = run_music21_snippet_any(
+            code_str, score_out=score_out)
+        if err:
+            return jsonify({"error": err}), 400
+
+        # XML crudo en el snippet: no hay Score en memoria
+        score_obj = score_out.get('score') or converter.parse(xml_payload)
+
+        events, track_count = score_to_note_events(
+            score_obj,
+            include_chords=include_chords,
+            chord_rhythm=chord_rhythm,
+            chord_octave=chord_octave,
+            chord_velocity=chord_velocity
+        )
+        payload = pack_note_events(events, track_count)
+        app.logger.info(f"[Playback] 🎵 {len(events)} eventos, {track_count} pista(s), {len(payload)} bytes")
+
+        return Response(payload, mimetype='application/octet-stream')
+
+    except Exception as e:
+        app.logger.exception(f"Error en /playback-events: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# ============================================================
+# ============ SOUNDFONTS LOCALES (REPRODUCCIÓN) =============
+# ============================================================
+
+# Ficheros de midi-js-soundfonts (formato de soundfont-player), p. ej.
+# static/soundfonts/acoustic_grand_piano-mp3.js; se prefiere mp3 (Safari)
+app.config.setdefault('SOUNDFONT_DIR', os.path.join(app.static_folder, 'soundfonts'))
+SOUNDFONT_FORMATS = ('mp3', 'ogg')
+SOUNDFONT_NOTE_RE = re.compile(r'"([A-G][b#]?-?\d)"\s*:\s*"data:([\w/.+-]+);base64,([^"]*)"')
+SOUNDFONT_INSTRUMENT_RE = re.compile(r'^[a-z0-9_]+$')
+
+def note_name_to_midi(name):
+    """'Bb1' / 'C#4' / 'A0' → número MIDI (notación de midi-js-soundfonts)"""
+    semitone = STEP_SEMITONES[name[0]]
+    rest = name[1:]
+    if rest[:1] == 'b':
+        semitone -= 1
+        rest = rest[1:]
+    elif rest[:1] == '#':
+        semitone += 1
+        rest = rest[1:]
+    return (int(rest) + 1) * 12 + semitone
+
+def find_soundfont_file(instrument):
+    """Ruta del fichero local del instrumento o None"""
+    if not SOUNDFONT_INSTRUMENT_RE.match(instrument):
+        return None
+    for fmt in SOUNDFONT_FORMATS:
+        path = os.path.join(app.config['SOUNDFONT_DIR'], f"{instrument}-{fmt}.js")
+        if os.path.isfile(path):
+            return path
+    return None
+
+@functools.lru_cache(maxsize=8)
+def _load_soundfont(path, mtime):
+    """{midi: (mimetype, bytes)} de un fichero de soundfont (cacheado por ruta y mtime)"""
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    samples = {}
+    for name, mimetype, data in SOUNDFONT_NOTE_RE.findall(text):
+        samples[note_name_to_midi(name)] = (mimetype, base64.b64decode(data))
+    app.logger.info(f"[Soundfont] 🎹 {os.path.basename(path)}: {len(samples)} muestras")
+    return samples
+
+def get_soundfont_samples(instrument):
+    """Muestras del instrumento local o None si no está instalado"""
+    path = find_soundfont_file(instrument)
+    if path is None:
+        return None
+    return _load_soundfont(path, os.path.getmtime(path))
+
+@app.route("/soundfont/<instrument>")
+def soundfont_manifest(instrument):
+    """
+    Notas disponibles de un instrumento local: el cliente pide y decodifica
+    solo las muestras del rango de alturas que usa la partitura.
+    """
+    samples = get_soundfont_samples(instrument)
+    if samples is None:
+        return jsonify({"error": f"Instrumento no instalado: {instrument}"}), 404
+    response = jsonify({
+        "instrument": instrument,
+        "notes": sorted(samples),
+        "version": int(os.path.getmtime(find_soundfont_file(instrument)))
+    })
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route("/soundfont/<instrument>/<int:midi>")
+def soundfont_sample(instrument, midi):
+    """Muestra codificada (mp3/ogg) de una nota; inmutable para una versión dada"""
+    samples = get_soundfont_samples(instrument)
+    if samples is None or midi not in samples:
+        return jsonify({"error": f"Muestra no disponible: {instrument}/{midi}"}), 404
+    mimetype, data = samples[midi]
+    response = Response(data, mimetype=mimetype)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+# ============================================================
+# ========= RENDER DE AUDIO OFFLINE (/export-audio) ==========
+# ============================================================
+
+AUDIO_SAMPLE_RATES = (22050, 32000, 44100, 48000)
+AUDIO_BLOCK_SECONDS = 2.0          # tamaño de bloque del streaming WAV
+AUDIO_VOICE_CACHE_MB = 64          # voces pre-sintetizadas por petición
+AUDIO_HOLD_QUANTUM = 0.01          # duraciones agrupadas a 10 ms para reutilizar voces
+
+# Voces aditivas: amplitud de cada parcial, amortiguación por parcial (1/s)
+# y envolvente ADSR (segundos / nivel de sustain)
+AUDIO_VOICES = {
+    'piano': {'partials': (1.0, 0.5, 0.3, 0.15, 0.1, 0.05), 'damping': 1.2,
+              'attack': 0.005, 'decay': 0.4, 'sustain': 0.35, 'release': 0.25},
+    'rhodes': {'partials': (1.0, 0.2, 0.08, 0.05), 'damping': 0.8,
+               'attack': 0.005, 'decay': 0.8, 'sustain': 0.4, 'release': 0.3},
+    'strings': {'partials': (1.0, 0.6, 0.45, 0.3, 0.2, 0.15, 0.1), 'damping': 0.0,
+                'attack': 0.12, 'decay': 0.2, 'sustain': 0.85, 'release': 0.35},
+    'horns': {'partials': (1.0, 0.8, 0.6, 0.4, 0.25, 0.15), 'damping': 0.0,
+              'attack': 0.06, 'decay': 0.15, 'sustain': 0.8, 'release': 0.2},
+    'pad': {'partials': (1.0, 0.3, 0.15, 0.08), 'damping': 0.0,
+            'attack': 0.4, 'decay': 0.5, 'sustain': 0.7, 'release': 0.8},
+}
+
+def synth_voice(pitch, hold_frames, preset, sample_rate):
+    """
+    Sintetiza una nota completa (mantenida + release) como float32:
+    suma de parciales amortiguados × envolvente ADSR, todo vectorizado.
+    """
+    release_frames = int(preset['release'] * sample_rate)
+    n = hold_frames + release_frames
+    t = np.arange(n, dtype=np.float32) / sample_rate
+
+    f0 = 440.0 * 2.0 ** ((pitch - 69) / 12.0)
+    partials = [(k, amp) for k, amp in enumerate(preset['partials'], 1) if k * f0 < sample_rate / 2]
+    ks = np.array([k for k, _ in partials], dtype=np.float32)[:, None]
+    amps = np.array([amp for _, amp in partials], dtype=np.float32)[:, None]
+    waves = amps * np.sin((2 * np.pi * f0) * ks * t)
+    if preset['damping']:
+        waves *= np.exp(-preset['damping'] * ks * t)
+    wave = waves.sum(axis=0) / amps.sum()
+
+    # ADSR: ataque lineal, caída exponencial al sustain, release desde el nivel alcanzado
+    attack = max(preset['attack'], 1.0 / sample_rate)
+    env = np.minimum(t / attack, 1.0)
+    decay_t = np.maximum(t - attack, 0.0)
+    sustain = preset['sustain']
+    env *= sustain + (1.0 - sustain) * np.exp(-decay_t / max(preset['decay'], 1e-3))
+    if release_frames:
+        level = env[hold_frames - 1] if hold_frames else 0.0
+        env[hold_frames:] = level * np.linspace(1.0, 0.0, release_frames, dtype=np.float32)
+    return (wave * env).astype(np.float32)
+
+def count_max_polyphony(onsets, ends):
+    """Máximo de notas simultáneas (barrido vectorizado de inicios y finales)"""
+    if len(onsets) == 0:
+        return 0
+    times = np.concatenate((onsets, ends))
+    deltas = np.concatenate((np.ones(len(onsets)), -np.ones(len(ends))))
+    order = np.lexsort((deltas, times))  # a igual tiempo, los finales primero
+    return int(np.cumsum(deltas[order]).max())
+
+def render_note_events_wav(events, sample_rate=44100, voice='piano'):
+    """
+    Generador de un WAV mono de 16 bits a partir de eventos de nota
+    (ver score_to_note_events). Se mezcla por bloques, así que la memoria
+    no depende de la duración; las voces se reutilizan por (altura, duración).
+    """
+    preset = AUDIO_VOICES[voice]
+    release_frames = int(preset['release'] * sample_rate)
+    quantum = max(1, int(AUDIO_HOLD_QUANTUM * sample_rate))
+
+    starts = np.array([int(round(ev[0] * sample_rate)) for ev in events], dtype=np.int64)
+    holds = np.array([max(1, int(round(ev[1] * sample_rate / quantum))) * quantum for ev in events], dtype=np.int64)
+    gains = np.array([ev[3] / 127.0 for ev in events], dtype=np.float32)
+    pitches = [ev[2] for ev in events]
+    ends = starts + holds + release_frames
+    total_frames = int(ends.max()) if len(events) else 0
+
+    # Ganancia fija según la polifonía máxima (no se puede normalizar al streamear)
+    polyphony = count_max_polyphony(starts, ends)
+    master = 0.7 / math.sqrt(max(1, polyphony))
+
+    data_bytes = total_frames * 2
+    yield (b'RIFF' + struct.pack('<I', 36 + data_bytes) + b'WAVE'
+           + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16)
+           + b'data' + struct.pack('<I', data_bytes))
+
+    voices = OrderedDict()
+    voices_bytes = 0
+    cache_limit = AUDIO_VOICE_CACHE_MB * 1024 * 1024
+    block = int(AUDIO_BLOCK_SECONDS * sample_rate)
+    active = []  # índices de notas que suenan en el bloque actual
+    next_note = 0
+
+    for block_start in range(0, total_frames, block):
+        block_end = min(block_start + block, total_frames)
+        mix = np.zeros(block_end - block_start, dtype=np.float32)
+
+        while next_note < len(events) and starts[next_note] < block_end:
+            active.append(next_note)
+            next_note += 1
+
+        still_active = []
+        for i in active:
+            key = (pitches[i], int(holds[i]))
+            wave = voices.get(key)
+            if wave is None:
+                wave = synth_voice(pitches[i], int(holds[i]), preset, sample_rate)
+                voices[key] = wave
+                voices_bytes += wave.nbytes
+                while voices_bytes > cache_limit and len(voices) > 1:
+                    voices_bytes -= voices.popitem(last=False)[1].nbytes
+            else:
+                voices.move_to_end(key)
+
+            lo = max(block_start, int(starts[i]))
+            hi = min(block_end, int(ends[i]))
+            mix[lo - block_start:hi - block_start] += gains[i] * wave[lo - starts[i]:hi - starts[i]]
+            if ends[i] > block_end:
+                still_active.append(i)
+        active = still_active
+
+        # Saturación suave en lugar de recorte duro
+        pcm = np.tanh(mix * master) * 32767.0
+        yield pcm.astype('<i2').tobytes()
+
+@app.route("/export-audio", methods=["POST"])
+@admission_controlled('export')
+def export_audio():
+    """
+    Recibe código Python con music21 y devuelve un WAV (streaming) sintetizado
+    con las voces de AUDIO_VOICES, incluido el acompañamiento de cifrados.
+    
+    Parámetros opcionales (además de los de /export-midi):
+    - instrument: str (default: 'piano') - clave de AUDIO_VOICES
+    - sample_rate: int (default: 44100) - uno de AUDIO_SAMPLE_RATES
+    """
+    try:
+        data = request.get_json()
+        code_str = data.get('code', '')
+
+        include_chords = data.get('include_chords', False)
+        chord_rhythm = data.get('chord_rhythm', 'half')
+        chord_octave = data.get('chord_octave', 3)
+        chord_velocity = data.get('chord_velocity', 0.5)
+        voice = data.get('instrument', 'piano')
+        sample_rate = data.get('sample_rate', 44100)
+
+        if not code_str.strip():
+            return "Error: código vacío", 400
+        if voice not in AUDIO_VOICES:
+            return jsonify({"error": f"Instrumento desconocido: {voice}"}), 400
+        if sample_rate not in AUDIO_SAMPLE_RATES:
+            return jsonify({"error": f"sample_rate debe ser uno de {list(AUDIO_SAMPLE_RATES)}"}), 400
+
+        score_out = {}
+        xml_payload, warnings_list, err, element_line_map = run_music21_snippet_any(
+            code_str, score_out=score_out)
+        if err:
+            return jsonify({"error": err}), 400
+
+        score_obj = score_out.get('score') or converter.parse(xml_payload)
+        events, track_count = score_to_note_events(
+            score_obj,
+            include_chords=include_chords,
+            chord_rhythm=chord_rhythm,
+            chord_octave=chord_octave,
+            chord_velocity=chord_velocity
+        )
+
+        def generate():
+            started = time.perf_counter()
+            yield from render_note_events_wav(events, sample_rate, voice)
+            elapsed = time.perf_counter() - started
+            duration_s = max((ev[0] + ev[1] for ev in events), default=0.0)
+            app.logger.info(f"[Audio] 🔊 {len(events)} notas, {duration_s:.1f}s de audio en {elapsed:.2f}s"
+                            f" ({duration_s / max(elapsed, 1e-6):.0f}x tiempo real)")
+
+        return Response(
+            generate(),
+            mimetype='audio/wav',
+            headers={'Content-Disposition': 'attachment; filename=score.wav'}
+        )
+
+    except Exception as e:
+        app.logger.exception(f"Error en /export-audio: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# ============================================================
+# ============ ANÁLISIS ARMÓNICO (/analyze) ==================
+# ============================================================
+
+ANALYSIS_CACHE_MAX_ENTRIES = 32
+_analysis_cache = OrderedDict()  # hash del documento → resultado de analyze_document
+_analysis_cache_lock = threading.Lock()
+
+SHARP_NAMES = ('C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B')
+FLAT_NAMES = ('C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B')
+
+# Perfiles de Krumhansl-Kessler (mayor, menor) con la tónica en la posición 0
+KEY_PROFILES = np.array([
+    [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88],
+    [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17],
+])
+KEY_MODES = ('major', 'minor')
+KEY_WINDOW_MEASURES = 5  # ventana centrada para la tonalidad local
+
+# Plantillas de acorde: (sufijo del cifrado, intervalos desde la fundamental)
+CHORD_QUALITIES = (
+    ('', (0, 4, 7)), ('m', (0, 3, 7)), ('dim', (0, 3, 6)), ('+', (0, 4, 8)),
+    ('7', (0, 4, 7, 10)), ('maj7', (0, 4, 7, 11)), ('m7', (0, 3, 7, 10)), ('m7b5', (0, 3, 6, 10)),
+)
+
+# [tónica, clase de altura] → grado relativo a la tónica
+_PC_ROTATIONS = (np.arange(12)[None, :] - np.arange(12)[:, None]) % 12
+# Fila = modo * 12 + tónica
+KEY_TEMPLATES = KEY_PROFILES[:, _PC_ROTATIONS].reshape(24, 12)
+
+def _build_chord_templates():
+    """Plantillas binarias normalizadas; fila = calidad * 12 + fundamental"""
+    templates = np.zeros((len(CHORD_QUALITIES) * 12, 12))
+    for q, (_, intervals) in enumerate(CHORD_QUALITIES):
+        for root in range(12):
+            templates[q * 12 + root, [(root + i) % 12 for i in intervals]] = 1.0
+    return templates / np.linalg.norm(templates, axis=1, keepdims=True)
+
+CHORD_TEMPLATES = _build_chord_templates()
+
+def extract_pitch_class_matrix(root):
+    """
+    Una sola pasada por el MusicXML: devuelve (onsets, matrix, onset_measures,
+    measure_numbers), con matrix[onset, pc] = negras que suenan desde ese onset.
+    Los onsets son globales (negras desde el inicio) y están ordenados.
+    """
+    onsets, durations, pitch_classes, measure_index = [], [], [], []
+    measure_numbers = []
+
+    for part_i, part in enumerate(root.iter('part')):
+        divisions = 1.0
+        part_offset = 0.0
+        for m_i, measure in enumerate(part.iter('measure')):
+            if part_i == 0:
+                measure_numbers.append(measure.get('number'))
+            cursor = 0.0
+            longest = 0.0
+            last_onset = 0.0
+            for el in measure:
+                tag = el.tag
+                if tag == 'note':
+                    dur = float(el.findtext('duration') or 0) / divisions
+                    if el.find('chord') is not None:
+                        onset = last_onset
+                    else:
+                        onset = last_onset = cursor
+                        cursor += dur
+                        longest = max(longest, cursor)
+                    pitch = el.find('pitch')
+                    if pitch is None or dur <= 0:
+                        continue  # silencios, percusión y notas de adorno
+                    pc = STEP_SEMITONES[pitch.findtext('step')] + int(round(float(pitch.findtext('alter') or 0)))
+                    onsets.append(part_offset + onset)
+                    durations.append(dur)
+                    pitch_classes.append(pc % 12)
+                    measure_index.append(m_i)
+                elif tag == 'backup':
+                    cursor -= float(el.findtext('duration') or 0) / divisions
+                elif tag == 'forward':
+                    cursor += float(el.findtext('duration') or 0) / divisions
+                    longest = max(longest, cursor)
+                elif tag == 'attributes' and el.findtext('divisions'):
+                    divisions = float(el.findtext('divisions'))
+            part_offset += longest
+
+    onsets = np.array(onsets)
+    unique_onsets, row = np.unique(onsets, return_inverse=True)
+    matrix = np.zeros((len(unique_onsets), 12))
+    np.add.at(matrix, (row, np.array(pitch_classes, dtype=np.intp)), np.array(durations))
+
+    onset_measures = np.zeros(len(unique_onsets), dtype=np.intp)
+    onset_measures[row] = np.array(measure_index, dtype=np.intp)
+    return unique_onsets, matrix, onset_measures, measure_numbers
+
+def _zscore_rows(x):
+    centered = x - x.mean(axis=1, keepdims=True)
+    std = centered.std(axis=1, keepdims=True)
+    return np.divide(centered, std, out=np.zeros_like(centered), where=std > 0)
+
+def correlate_keys(histograms):
+    """(n, 12) → (índice de tonalidad, correlación) por fila contra las 24 plantillas"""
+    corr = _zscore_rows(histograms) @ _zscore_rows(KEY_TEMPLATES).T / 12.0
+    best = corr.argmax(axis=1)
+    return best, corr[np.arange(len(best)), best]
+
+def match_chords(histograms):
+    """(n, 12) → (índice de plantilla, similitud coseno) por fila"""
+    norms = np.linalg.norm(histograms, axis=1, keepdims=True)
+    unit = np.divide(histograms, norms, out=np.zeros_like(histograms), where=norms > 0)
+    scores = unit @ CHORD_TEMPLATES.T
+    best = scores.argmax(axis=1)
+    return best, scores[np.arange(len(best)), best]
+
+def key_info(key_index, correlation):
+    mode = KEY_MODES[key_index // 12]
+    tonic_pc = key_index % 12
+    # Armadura de la tonalidad (relativa mayor) para elegir sostenidos o bemoles
+    fifths = ((tonic_pc + (3 if mode == 'minor' else 0)) * 7 + 6) % 12 - 6
+    tonic = (FLAT_NAMES if fifths < 0 else SHARP_NAMES)[tonic_pc]
+    return {
+        "tonic": tonic,
+        "mode": mode,
+        "name": f"{tonic} {mode}",
+        "fifths": fifths,
+        "correlation": round(float(correlation), 3)
+    }
+
+def _normalized(histogram):
+    total = histogram.sum()
+    return [round(float(v), 4) for v in (histogram / total if total > 0 else histogram)]
+
+def analyze_document(root):
+    """
+    Tonalidad global, tonalidad local (ventana de KEY_WINDOW_MEASURES compases),
+    cifrado por compás e histogramas de clases de altura, todo vectorizado
+    sobre la matriz onset × clase de altura.
+    """
+    onsets, matrix, onset_measures, measure_numbers = extract_pitch_class_matrix(root)
+    n_measures = max(len(measure_numbers), int(onset_measures.max()) + 1 if len(onsets) else 0)
+
+    measure_hist = np.zeros((n_measures, 12))
+    np.add.at(measure_hist, onset_measures, matrix)
+    total_hist = measure_hist.sum(axis=0)
+
+    # Ventana centrada de compases vía sumas acumuladas
+    half = KEY_WINDOW_MEASURES // 2
+    cumulative = np.vstack((np.zeros((1, 12)), np.cumsum(measure_hist, axis=0)))
+    idx = np.arange(n_measures)
+    window_hist = (cumulative[np.minimum(idx + half + 1, n_measures)]
+                   - cumulative[np.maximum(idx - half, 0)])
+
+    global_key, global_corr = correlate_keys(total_hist[None, :])
+    local_keys, local_corr = correlate_keys(window_hist)
+    chords, chord_scores = match_chords(measure_hist)
+
+    global_info = key_info(int(global_key[0]), global_corr[0]) if total_hist.any() else None
+    names = FLAT_NAMES if global_info and global_info['fifths'] < 0 else SHARP_NAMES
+
+    measure_offsets = {}
+    for onset, m in zip(onsets.tolist(), onset_measures.tolist()):
+        measure_offsets.setdefault(m, onset)
+
+    measures = []
+    for m in range(n_measures):
+        has_notes = bool(measure_hist[m].any())
+        chord_entry = None
+        if has_notes:
+            quality, root_pc = divmod(int(chords[m]), 12)
+            suffix = CHORD_QUALITIES[quality][0]
+            chord_entry = {
+                "label": names[root_pc] + suffix,
+                "root": names[root_pc],
+                "quality": suffix or 'maj',
+                "score": round(float(chord_scores[m]), 3)
+            }
+        measures.append({
+            "index": m,
+            "number": measure_numbers[m] if m < len(measure_numbers) else str(m + 1),
+            "first_onset": measure_offsets.get(m),
+            "histogram": _normalized(measure_hist[m]),
+            "key": key_info(int(local_keys[m]), local_corr[m]) if window_hist[m].any() else None,
+            "chord": chord_entry
+        })
+
+    return {
+        "key": global_info,
+        "histogram": _normalized(total_hist),
+        "onsets": len(onsets),
+        "measures": measures
+    }
+
+@app.route("/analyze", methods=["POST"])
+@admission_controlled('export')
+def analyze():
+    """
+    Análisis armónico de una partitura. Recibe uno de:
+      - {"hash": "..."} documento ya renderizado (almacén de documentos)
+      - {"xml": "<?xml ..."} MusicXML subido
+      - {"code": "...python..."} snippet de music21
+    Devuelve tonalidad global, y por compás: histograma, tonalidad local y cifrado.
+    El resultado se cachea por hash de contenido (header X-Analysis-Cache).
+    """
+    data = request.get_json(silent=True) or {}
+    started = time.perf_counter()
+    try:
+        if isinstance(data.get("hash"), str):
+            doc_hash = data["hash"]
+        elif isinstance(data.get("xml"), str) and data["xml"].lstrip().startswith("<?xml"):
+            doc_hash = store_xml_document(data["xml"].lstrip('\ufeff').strip())
+        elif data.get("code"):
+            xml_payload, warnings_list, err, element_line_map = run_music21_snippet_any(data["code"])
+            if err:
+                return jsonify({"error": err}), 400
+            doc_hash = store_xml_document(xml_payload.lstrip('\ufeff').strip())
+        else:
+            return jsonify({"error": "No se proporcionó 'hash', 'xml' ni 'code'."}), 400
+
+        with _analysis_cache_lock:
+            result = _analysis_cache.get(doc_hash)
+            if result is not None:
+                _analysis_cache.move_to_end(doc_hash)
+        cache_status = 'hit' if result is not None else 'miss'
+        record_cache_lookup('analysis', result is not None)
+
+        if result is None:
+            root = get_stored_root(doc_hash)
+            if root is None:
+                return jsonify({"error": "Documento desconocido", "base_unknown": True}), 404
+            result = analyze_document(root)
+            with _analysis_cache_lock:
+                _analysis_cache[doc_hash] = result
+                while len(_analysis_cache) > ANALYSIS_CACHE_MAX_ENTRIES:
+                    _analysis_cache.popitem(last=False)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        app.logger.info(f"[Analyze] 🎼 {doc_hash[:8]} {cache_status}: {len(result['measures'])} compases en {elapsed_ms:.1f}ms")
+        response = jsonify(dict(result, hash=doc_hash, elapsed_ms=round(elapsed_ms, 1)))
+        response.headers['X-Content-Hash'] = doc_hash
+        response.headers['X-Analysis-Cache'] = cache_status
+        return response
+
+    except Exception as e:
+        app.logger.exception(f"Error en /analyze: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# ============================================================
+# ============ MUSICXML COMPRIMIDO (.mxl) =====================
+# ============================================================
+
+MXL_MIMETYPE = 'application/vnd.recordare.musicxml'
+MUSICXML_MIMETYPE = 'application/vnd.recordare.musicxml+xml'
+MXL_CHUNK_SIZE = 1 << 20  # la partitura se comprime y se emite por bloques de 1 MB
+app.config.setdefault('MXL_MAX_UNCOMPRESSED_MB', 256)  # defensa frente a zip bombs
+
+MXL_CONTAINER_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<container>
+  <rootfiles>
+    <rootfile full-path="{name}" media-type="application/vnd.recordare.musicxml+xml"/>
+  </rootfiles>
+</container>
+"""
+
+def is_mxl_bytes(data) -> bool:
+    """Los .mxl son contenedores zip: empiezan por la firma local 'PK\\x03\\x04'"""
+    return bytes(data[:4]) == b'PK\x03\x04'
+
+def decode_musicxml_bytes(data: bytes) -> str:
+    """Bytes de un MusicXML sin comprimir → texto (UTF-8 o UTF-16 con BOM)"""
+    if data[:2] in (b'\xff\xfe', b'\xfe\xff'):
+        return data.decode('utf-16').strip()
+    return data.decode('utf-8-sig').strip()
+
+def read_mxl(source) -> str:
+    """
+    Extrae la partitura de un .mxl (bytes o fichero binario con seek).
+    Usa el rootfile de META-INF/container.xml; si falta, el primer .musicxml/.xml.
+    Lanza ValueError si el contenedor no es válido o descomprime demasiado.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    limit = int(app.config['MXL_MAX_UNCOMPRESSED_MB']) * 1024 * 1024
+    try:
+        with zipfile.ZipFile(source) as zf:
+            names = zf.namelist()
+            name = None
+            if 'META-INF/container.xml' in names:
+                rootfile = ET.fromstring(zf.read('META-INF/container.xml')).find('.//rootfile')
+                if rootfile is not None:
+                    name = rootfile.get('full-path')
+            if name not in names:
+                candidates = [n for n in names
+                              if not n.startswith('META-INF/') and n.lower().endswith(('.musicxml', '.xml'))]
+                if not candidates:
+                    raise ValueError("el contenedor no incluye ninguna partitura")
+                name = candidates[0]
+            # Leer con tope: el tamaño declarado en la cabecera del zip puede mentir
+            with zf.open(name) as entry:
+                data = entry.read(limit + 1)
+    except (zipfile.BadZipFile, ET.ParseError, KeyError) as e:
+        raise ValueError(f"contenedor .mxl inválido ({e})")
+    if len(data) > limit:
+        raise ValueError(f"la partitura descomprimida supera {limit // (1024 * 1024)} MB")
+    return decode_musicxml_bytes(data)
+
+def iter_mxl_chunks(xml_text: str, name: str = 'score.musicxml'):
+    """
+    Escribe un .mxl de forma incremental: 'mimetype' sin comprimir en primer lugar
+    (lo exige la especificación), container.xml y la partitura comprimida por bloques.
+    Cada bloque comprimido se emite en cuanto zipfile lo escribe.
+    """
+    stream_out = _ZipStream()
+    with zipfile.ZipFile(stream_out, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(zipfile.ZipInfo('mimetype'), MXL_MIMETYPE, compress_type=zipfile.ZIP_STORED)
+        zf.writestr('META-INF/container.xml', MXL_CONTAINER_XML.format(name=name))
+        with zf.open(name, 'w', force_zip64=len(xml_text) > 0x7fffffff) as entry:
+            for start in range(0, len(xml_text), MXL_CHUNK_SIZE):
+                entry.write(xml_text[start:start + MXL_CHUNK_SIZE].encode('utf-8'))
+                chunk = stream_out.drain()
+                if chunk:
+                    yield chunk
+    yield stream_out.drain()
+
+def write_mxl_file(path: str, xml_text: str):
+    """Guarda un .mxl en disco sin materializar el zip completo en memoria"""
+    tmp_path = path + '.part'
+    with open(tmp_path, 'wb') as f:
+        for chunk in iter_mxl_chunks(xml_text, os.path.splitext(os.path.basename(path))[0] + '.musicxml'):
+            f.write(chunk)
+    os.replace(tmp_path, path)  # escritura atómica
+
+def mxl_response(xml_text: str, filename: str):
+    """Descarga .mxl en streaming (sin base64 ni JSON de por medio)"""
+    stem = os.path.splitext(filename)[0]
+    return Response(
+        iter_mxl_chunks(xml_text, f"{stem}.musicxml"),
+        mimetype=MXL_MIMETYPE,
+        headers={'Content-Disposition': f'attachment; filename={stem}.mxl'}
+    )
+
+def read_uploaded_musicxml():
+    """
+    Partitura subida sin envoltorio JSON: multipart (campo 'file') o cuerpo binario
+    con Content-Type .mxl / zip / MusicXML. Devuelve el texto XML o None si no hay subida.
+    Lanza ValueError si el fichero no se puede leer.
+    """
+    upload = request.files.get('file')
+    if upload is not None:
+        head = upload.stream.read(4)
+        upload.stream.seek(0)
+        if is_mxl_bytes(head):
+            return read_mxl(upload.stream)
+        return _checked_upload_text(decode_musicxml_bytes(upload.stream.read()))
+
+    if request.mimetype in (MXL_MIMETYPE, 'application/zip', 'application/x-zip-compressed',
+                            'application/octet-stream', MUSICXML_MIMETYPE,
+                            'application/xml', 'text/xml'):
+        data = request.get_data(cache=False)
+        if is_mxl_bytes(data):
+            return read_mxl(data)
+        return _checked_upload_text(decode_musicxml_bytes(data))
+    return None
+
+def _checked_upload_text(text):
+    """Un MusicXML sin comprimir debe ser un documento XML (declaración, DOCTYPE o comentario incluidos)"""
+    if not text.startswith('<'):
+        raise ValueError("el fichero no es un documento XML" if text else "fichero vacío")
+    return text
+
 @app.route("/export-xml", methods=["POST"])
+@admission_controlled('export')
 def export_xml():
     """
     Endpoint para exportar XML con ediciones.
     Recibe código Python, lo ejecuta y devuelve el XML como descarga.
+    Con {"format": "mxl"} (o ?format=mxl) devuelve un .mxl comprimido en streaming.
     """
     try:
         data = request.get_json()
+        compressed = (data.get('format') or request.args.get('format')) == 'mxl'
         code_str = data.get('code', '')
         
         if not code_str.strip():
@@ -1272,6 +4538,8 @@ def export_xml():
         from datetime import datetime
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         filename = f'partitura_editada_{timestamp}.musicxml'
+        if compressed:
+            return mxl_response(xml_payload, filename)
         
         # Devolver como descarga
         return Response(
@@ -1287,6 +4555,284 @@ def export_xml():
         app.logger.exception(f"Error en /export-xml: {e}")
         return jsonify({"error": str(e)}), 500
 
+# ============================================================
+# ================ RENDER POR LOTES (/render-batch) ==========
+# ============================================================
+
+app.config.setdefault('BATCH_MAX_ITEMS', 200)
+app.config.setdefault('BATCH_MAX_WORKERS', os.cpu_count() or 1)
+
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+
+def _shutdown_batch_pool():
+    """Al salir: cerrar los procesos del pool sin esperar a lotes a medias"""
+    global _batch_pool
+    with _batch_pool_lock:
+        pool, _batch_pool = _batch_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _get_batch_pool():
+    """
+    Pool de procesos compartido (music21 es CPU-bound). Con 'spawn': este proceso ya
+    tiene hilos (watchdog de admisión, muestreadores) y un fork podría heredar un lock
+    tomado. Los procesos que trabajan a la vez los limita la admisión, no el pool.
+    """
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            _batch_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=int(app.config['BATCH_MAX_WORKERS']),
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            atexit.register(_shutdown_batch_pool)
+        return _batch_pool
+
+def render_batch_item(item, formats=('musicxml',), midi_options=None):
+    """
+    Renderiza un elemento del lote: {"code"} | {"xml"} | {"path"}.
+    Se ejecuta en un proceso del pool; nunca lanza, los errores van en el resultado.
+    Devuelve dict {ok, error, warnings, xml?, midi?}.
+    """
+    result = {'ok': False, 'error': None, 'warnings': []}
+    try:
+        if isinstance(item.get('code'), str):
+            xml_payload, warnings_list, err, _ = run_music21_snippet_any(item['code'])
+            result['warnings'] = warnings_list
+            if err:
+                result['error'] = err
+                return result
+        elif isinstance(item.get('xml'), str) and item['xml'].lstrip().startswith('<?xml'):
+            xml_payload = item['xml']
+        elif isinstance(item.get('path'), str):
+            xml_payload = to_musicxml_string(item['path'], result['warnings'])
+        else:
+            result['error'] = "Se esperaba 'code', 'xml' o 'path'."
+            return result
+
+        xml_payload = (xml_payload or '').lstrip('\ufeff').strip()
+        if not xml_payload:
+            result['error'] = "Export MusicXML vacío."
+            return result
+
+        if 'musicxml' in formats:
+            result['xml'] = xml_payload
+        if 'midi' in formats:
+            result['midi'] = xml_to_midi_bytes(xml_payload, **(midi_options or {}))
+        result['ok'] = True
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    return result
+
+def _cpu_limit_exceeded(signum, frame):
+    raise RequestLimitExceeded()
+
+def render_batch_item_limited(item, formats, midi_options, cpu_limit):
+    """
+    render_batch_item dentro de un proceso del pool, con el techo de CPU de la
+    admisión (ITIMER_PROF cuenta CPU del proceso; sin setitimer, p.ej. Windows, sin techo).
+    """
+    armed = False
+    if cpu_limit and hasattr(signal, 'setitimer'):
+        signal.signal(signal.SIGPROF, _cpu_limit_exceeded)
+        signal.setitimer(signal.ITIMER_PROF, float(cpu_limit))
+        armed = True
+    try:
+        return render_batch_item(item, formats, midi_options)
+    except RequestLimitExceeded:
+        return {'ok': False, 'error': f"Límite de CPU superado ({cpu_limit}s)", 'warnings': []}
+    finally:
+        if armed:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+
+def iter_batch_results(items, formats, midi_options):
+    """
+    Reparte el lote en el pool de procesos y devuelve (índice, resultado) según van
+    terminando. Cada proceso ocupado cuenta en el control de admisión: el primero usa
+    el hueco de la propia petición y los demás, huecos extra que solo se toman si
+    están libres (try_acquire). Un lote nunca pasa de ADMISSION_MAX_IN_FLIGHT.
+    Si el pool no está disponible, renderiza en serie con el hueco propio.
+    """
+    try:
+        pool = _get_batch_pool()
+    except Exception as e:
+        app.logger.warning(f"[Batch] Pool de procesos no disponible, render en serie: {e}")
+        for i, item in enumerate(items):
+            yield i, render_batch_item(item, formats, midi_options)
+        return
+
+    cpu_limit = app.config.get('ADMISSION_CPU_LIMIT')
+    pending = list(range(len(items)))[::-1]  # pila: pop() devuelve en orden
+    running = {}                             # future → (índice, ticket extra | None)
+    own_slot_free = True
+
+    def submit(ticket):
+        i = pending.pop()
+        future = pool.submit(render_batch_item_limited, items[i], formats, midi_options, cpu_limit)
+        running[future] = (i, ticket)
+
+    try:
+        while pending or running:
+            if pending and own_slot_free:
+                submit(None)
+                own_slot_free = False
+            while pending:
+                ticket = admission.try_acquire('batch')
+                if ticket is None:
+                    break
+                try:
+                    submit(ticket)
+                except BaseException:
+                    admission.release(ticket)
+                    raise
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i, ticket = running.pop(future)
+                if ticket is None:
+                    own_slot_free = True
+                else:
+                    admission.release(ticket)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # Proceso caído (p.ej. BrokenProcessPool): reintentar este elemento aquí
+                    app.logger.warning(f"[Batch] Elemento {i} falló en el pool ({e}), reintentando en serie")
+                    result = render_batch_item(items[i], formats, midi_options)
+                yield i, result
+    finally:
+        # Lote abortado o cliente desconectado: no dejar huecos extra tomados
+        for future, (i, ticket) in running.items():
+            future.cancel()
+            if ticket is not None:
+                admission.release(ticket)
+
+def _batch_item_names(items):
+    """Nombres de fichero únicos y seguros para cada elemento del lote"""
+    names = []
+    seen = set()
+    for i, item in enumerate(items):
+        base = re.sub(r'[^\w.-]+', '_', str(item.get('name') or '')).strip('._') or f"item_{i + 1:03d}"
+        name = base
+        suffix = 2
+        while name in seen:
+            name = f"{base}_{suffix}"
+            suffix += 1
+        seen.add(name)
+        names.append(name)
+    return names
+
+class _ZipStream:
+    """Destino no 'seekable' para zipfile: acumula los bytes escritos hasta drain()"""
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+@app.route("/render-batch", methods=["POST"])
+@admission_controlled('batch')
+def render_batch():
+    """
+    Renderiza muchos snippets/partituras en una sola petición, en paralelo.
+    Input: {
+      items: [{code|xml|path, name?}, ...],
+      formats: ["musicxml", "midi"]   (default: ["musicxml"]),
+      output: "json" | "zip"           (default: "json"),
+      include_chords, chord_rhythm, chord_octave, chord_velocity  (para MIDI)
+    }
+    Output:
+      - json: manifiesto {items: [{index, name, ok, error, warnings, xml?, midi (base64)?}], ok, failed}
+      - zip:  stream con <name>.musicxml / <name>.mid + manifest.json
+    Los errores de cada elemento se informan sin hacer fallar el lote.
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Se esperaba una lista 'items' no vacía."}), 400
+    if len(items) > int(app.config['BATCH_MAX_ITEMS']):
+        return jsonify({"error": f"Máximo {app.config['BATCH_MAX_ITEMS']} elementos por lote."}), 400
+    items = [item if isinstance(item, dict) else {} for item in items]
+
+    formats = tuple(f for f in data.get('formats', ['musicxml']) if f in ('musicxml', 'midi')) or ('musicxml',)
+    midi_options = {
+        'include_chords': data.get('include_chords', False),
+        'chord_rhythm': data.get('chord_rhythm', 'half'),
+        'chord_octave': data.get('chord_octave', 3),
+        'chord_velocity': data.get('chord_velocity', 0.5),
+    }
+    names = _batch_item_names(items)
+    started = time.perf_counter()
+
+    def manifest_entry(i, result):
+        entry = {
+            "index": i,
+            "name": names[i],
+            "ok": result['ok'],
+            "error": result['error'],
+            "warnings": result['warnings']
+        }
+        if not result['ok']:
+            app.logger.warning(f"[Batch] '{names[i]}' falló: {str(result['error']).strip().splitlines()[-1:]}")
+        return entry
+
+    if data.get('output') == 'zip':
+        def generate():
+            stream_out = _ZipStream()
+            manifest = []
+            with zipfile.ZipFile(stream_out, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+                for i, result in iter_batch_results(items, formats, midi_options):
+                    if result.get('xml') is not None:
+                        zf.writestr(f"{names[i]}.musicxml", result['xml'])
+                    if result.get('midi') is not None:
+                        zf.writestr(f"{names[i]}.mid", result['midi'])
+                    manifest.append(manifest_entry(i, result))
+                    yield stream_out.drain()
+                manifest.sort(key=lambda e: e['index'])
+                zf.writestr('manifest.json', json.dumps({
+                    "items": manifest,
+                    "ok": sum(1 for e in manifest if e['ok']),
+                    "failed": sum(1 for e in manifest if not e['ok']),
+                    "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+                }, ensure_ascii=False, indent=2))
+            yield stream_out.drain()
+            app.logger.info(f"[Batch] {len(items)} elemento(s) en ZIP en {time.perf_counter() - started:.2f}s")
+
+        return Response(
+            generate(),
+            mimetype='application/zip',
+            headers={'Content-Disposition': 'attachment; filename=partituras.zip'}
+        )
+
+    results = []
+    for i, result in iter_batch_results(items, formats, midi_options):
+        entry = manifest_entry(i, result)
+        if result.get('xml') is not None:
+            entry['xml'] = result['xml']
+        if result.get('midi') is not None:
+            entry['midi'] = base64.b64encode(result['midi']).decode('ascii')
+        results.append(entry)
+    results.sort(key=lambda e: e['index'])
+
+    elapsed = time.perf_counter() - started
+    app.logger.info(f"[Batch] {len(items)} elemento(s) en {elapsed:.2f}s")
+    return jsonify({
+        "items": results,
+        "ok": sum(1 for e in results if e['ok']),
+        "failed": sum(1 for e in results if not e['ok']),
+        "elapsed_ms": round(elapsed * 1000, 1)
+    })
+
 @app.route('/validate-chord', methods=['POST'])
 def validate_chord():
     """Valida si un texto es un acorde válido"""
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Conversor por lotes sin interfaz - usa el mismo pipeline que /render-xml
+
+Convierte directorios de snippets music21 (.py), MIDI o MusicXML a MusicXML
+(plano o comprimido .mxl), MIDI o MIDI con acompañamiento de cifrados, en paralelo
+con un pool de procesos.
+No arranca el servidor web ni importa pywebview: pensado para máquinas de build.
+
+Ejemplos:
+    python batch_convert.py ejercicios/ -o salida/
+    python batch_convert.py ejercicios/ midis/ -o salida/ --format midi-accomp --jobs 8
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+# Añadir el directorio del script al path para importar app
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, render_batch_item, write_mxl_file
+
+INPUT_EXTENSIONS = {
+    '.py': 'code',
+    '.mid': 'path', '.midi': 'path',
+    '.musicxml': 'path', '.xml': 'path', '.mxl': 'path',
+}
+
+OUTPUT_FORMATS = {
+    # formato → (extensión, formats de render_batch_item, acompañamiento)
+    'musicxml': ('.musicxml', ('musicxml',), False),
+    'mxl': ('.mxl', ('musicxml',), False),
+    'midi': ('.mid', ('midi',), False),
+    'midi-accomp': ('.mid', ('midi',), True),
+}
+
+JOURNAL_NAME = '.score_batch_journal.jsonl'
+
+def collect_inputs(paths):
+    """Devuelve [(ruta_fuente, ruta_relativa)] de todos los ficheros soportados"""
+    sources = []
+    for base in paths:
+        base = os.path.abspath(base)
+        if os.path.isfile(base):
+            sources.append((base, os.path.basename(base)))
+            continue
+        for dirpath, dirnames, filenames in os.walk(base):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1].lower() in INPUT_EXTENSIONS:
+                    full = os.path.join(dirpath, filename)
+                    sources.append((full, os.path.relpath(full, base)))
+    return [s for s in sources if os.path.splitext(s[0])[1].lower() in INPUT_EXTENSIONS]
+
+def plan_outputs(sources, output_dir, extension):
+    """
+    Asigna a cada fuente su fichero de salida sin colisiones: a.py → a.musicxml,
+    a.mid → a_mid.musicxml, y si también está ocupado, a_mid_2.musicxml, _3...
+    Sin distinguir mayúsculas (los volúmenes de macOS no las distinguen por defecto).
+    """
+    planned = []
+    used = set()
+    for source, relative in sources:
+        stem, source_ext = os.path.splitext(relative)
+        alternate = f"{stem}_{source_ext.lstrip('.')}"
+        target = os.path.join(output_dir, stem + extension)
+        n = 1
+        while target.lower() in used:
+            target = os.path.join(output_dir, (alternate if n == 1 else f"{alternate}_{n}") + extension)
+            n += 1
+        used.add(target.lower())
+        planned.append((source, target))
+    return planned
+
+def source_signature(source):
+    """Firma para reanudar: cambia si el fichero fuente cambia"""
+    stat = os.stat(source)
+    return f"{stat.st_size}-{int(stat.st_mtime)}"
+
+def load_journal(journal_path):
+    """Lee el diario de elementos ya convertidos: {(fuente, formato): firma}"""
+    done = {}
+    if not os.path.exists(journal_path):
+        return done
+    with open(journal_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                done[(entry['source'], entry['format'])] = entry['signature']
+            except (ValueError, KeyError):
+                continue  # línea truncada por una interrupción
+    return done
+
+def convert_one(source, target, output_format):
+    """Convierte un fichero (se ejecuta en un proceso del pool)"""
+    started = time.perf_counter()
+    extension, formats, include_chords = OUTPUT_FORMATS[output_format]
+
+    kind = INPUT_EXTENSIONS[os.path.splitext(source)[1].lower()]
+    if kind == 'code':
+        with open(source, encoding='utf-8') as f:
+            item = {'code': f.read()}
+    else:
+        item = {'path': source}
+
+    result = render_batch_item(item, formats, {'include_chords': include_chords})
+    if result['ok']:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_target = target + '.part'
+        if extension == '.mxl':
+            write_mxl_file(target, result['xml'])  # también atómica (vía .part)
+        else:
+            if 'midi' in formats:
+                with open(tmp_target, 'wb') as f:
+                    f.write(result['midi'])
+            else:
+                with open(tmp_target, 'w', encoding='utf-8') as f:
+                    f.write(result['xml'])
+            os.replace(tmp_target, target)  # escritura atómica: nunca queda un fichero a medias
+
+    error = result['error']
+    if error:
+        error = str(error).strip().splitlines()[-1]
+    return {
+        'ok': result['ok'],
+        'error': error,
+        'warnings': len(result['warnings']),
+        'seconds': time.perf_counter() - started
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Conversor por lotes de Score Viewer (snippets .py, MIDI, MusicXML)")
+    parser.add_argument('inputs', nargs='+', help="Directorios o ficheros de entrada")
+    parser.add_argument('-o', '--output', required=True, help="Directorio de salida")
+    parser.add_argument('-f', '--format', choices=sorted(OUTPUT_FORMATS), default='musicxml',
+                        help="Formato de salida (default: musicxml)")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="Procesos en paralelo (default: núcleos de la CPU)")
+    parser.add_argument('--no-resume', action='store_true',
+                        help="Reconvertir todo aunque ya esté en el diario")
+    parser.add_argument('--verbose', action='store_true', help="Mostrar logs del pipeline")
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        app.logger.setLevel('WARNING')
+
+    output_dir = os.path.abspath(args.output)
+    os.makedirs(output_dir, exist_ok=True)
+    extension = OUTPUT_FORMATS[args.format][0]
+
+    planned = plan_outputs(collect_inputs(args.inputs), output_dir, extension)
+    if not planned:
+        print("⚠️ No se encontraron ficheros .py, .mid, .musicxml, .xml ni .mxl")
+        return 1
+
+    # Reanudar: saltar lo ya convertido con la misma fuente y el mismo formato
+    journal_path = os.path.join(output_dir, JOURNAL_NAME)
+    done = {} if args.no_resume else load_journal(journal_path)
+    pending = []
+    skipped = 0
+    for source, target in planned:
+        signature = source_signature(source)
+        if done.get((source, args.format)) == signature and os.path.exists(target):
+            skipped += 1
+        else:
+            pending.append((source, target, signature))
+
+    total = len(pending)
+    print(f"🎵 {len(planned)} fichero(s): {total} pendiente(s), {skipped} ya convertido(s) → {output_dir}")
+
+    ok = failed = warnings = 0
+    busy_seconds = 0.0
+    started = time.perf_counter()
+
+    with open(journal_path, 'a', encoding='utf-8') as journal, \
+            concurrent.futures.ProcessPoolExecutor(
+                max_workers=max(1, args.jobs),
+                mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {
+            pool.submit(convert_one, source, target, args.format): (source, target, signature)
+            for source, target, signature in pending
+        }
+        try:
+            for n, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                source, target, signature = futures[future]
+                name = os.path.relpath(source)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {'ok': False, 'error': f"{type(e).__name__}: {e}", 'warnings': 0, 'seconds': 0.0}
+
+                busy_seconds += result['seconds']
+                warnings += result['warnings']
+                if result['ok']:
+                    ok += 1
+                    journal.write(json.dumps({
+                        'source': source, 'format': args.format,
+                        'signature': signature, 'target': target
+                    }) + '\n')
+                    journal.flush()
+                    print(f"[{n}/{total}] ✅ {name} ({result['seconds']:.2f}s)")
+                else:
+                    failed += 1
+                    print(f"[{n}/{total}] ❌ {name}: {result['error']}")
+        except KeyboardInterrupt:
+            print("\n⏸️ Interrumpido: se reanudará desde aquí en la próxima ejecución")
+            for future in futures:
+                future.cancel()
+            raise
+
+    elapsed = time.perf_counter() - started
+    done_count = ok + failed
+    print("\n" + "=" * 60)
+    print(f"RESUMEN: {ok} ok, {failed} con error, {skipped} saltado(s), {warnings} warning(s)")
+    print(f"Tiempo: {elapsed:.2f}s con {args.jobs} proceso(s)")
+    if done_count and elapsed > 0:
+        print(f"Rendimiento: {done_count / elapsed:.2f} ficheros/s, "
+              f"{busy_seconds / done_count:.2f}s de media por fichero, "
+              f"paralelismo efectivo {busy_seconds / elapsed:.1f}x")
+    print("=" * 60)
+    return 0 if failed == 0 else 2
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        sys.exit(130)
@@ -7,9 +7,10 @@ import os
 import time
 import threading
 import socket
+import multiprocessing
 import webview
 from datetime import datetime
-from app import app, run_music21_snippet_any
+from app import app, run_music21_snippet_any, write_mxl_file
 
 def find_free_port(start_port=5001, max_attempts=10):
     """Encuentra un puerto libre empezando desde start_port"""
@@ -56,15 +57,19 @@ class API:
             result = webview.windows[0].create_file_dialog(
                 webview.SAVE_DIALOG,
                 save_filename=filename,
-                file_types=('MusicXML (*.musicxml)', 'All files (*.*)')
+                file_types=('MusicXML (*.musicxml)', 'MusicXML comprimido (*.mxl)', 'All files (*.*)')
             )
             
             if result:
                 # Usuario seleccionó ubicación, guardar archivo
-                filepath = result[0] if isinstance(result, tuple) else result
+                filepath = result[0] if isinstance(result, (tuple, list)) else result
                 
-                with open(filepath, 'w', encoding='utf-8') as f:
-                    f.write(xml_payload)
+                if filepath.lower().endswith('.mxl'):
+                    # Comprimido (~10× menos), escrito por bloques
+                    write_mxl_file(filepath, xml_payload)
+                else:
+                    with open(filepath, 'w', encoding='utf-8') as f:
+                        f.write(xml_payload)
                 
                 return {'success': True, 'filepath': filepath}
             else:
@@ -75,6 +80,9 @@ class API:
             return {'success': False, 'error': str(e)}
 
 if __name__ == "__main__":
+    # Necesario para el pool de procesos de /render-batch en ejecutables PyInstaller
+    multiprocessing.freeze_support()
+    
     # Encontrar puerto libre
     port = find_free_port()
     
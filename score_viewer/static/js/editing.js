@@ -9,8 +9,8 @@ let selectedElement = null;
 let selectedElements = new Set(); // NUEVO: Selección múltiple
 let editPalette = null;
 let newElementCounter = 0;
-let history = [];
-let historyIndex = -1;
+let history = [];       // Entradas por diferencias (ver "Historial (Undo/Redo)")
+let historyIndex = -1;  // Última entrada aplicada (-1 = nada que deshacer)
 let originalTexts = {};
 let clipboard = null;
 
@@ -23,6 +23,14 @@ let multiSelectionBox = null; // Rectángulo que engloba todos los seleccionados
 let justCompletedSelection = false; // Flag para prevenir limpieza inmediata
 
 // ====== FUNCIONES DE RESALTADO DE CÓDIGO (DEFINIDAS PRIMERO) ======
+// Handles de CodeMirror de las líneas resaltadas: limpiar solo esas, no todo el documento
+const highlightedLineHandles = new Set();
+
+function addCodeLineClass(lineNumber, className) {
+    const handle = window.codeMirrorEditor.addLineClass(lineNumber, 'background', className);
+    if (handle) highlightedLineHandles.add(handle);
+}
+
 function highlightCodeLine(lineNumber, isEditing = false) {
     const codeEditor = document.getElementById('code-editor');
     if (!codeEditor) {
@@ -33,17 +41,14 @@ function highlightCodeLine(lineNumber, isEditing = false) {
     // Si usa CodeMirror
     if (window.codeMirrorEditor) {
         // ✅ CRÍTICO: Limpiar TODOS los resaltados anteriores (highlighted-line Y editing)
-        for (let i = 0; i < window.codeMirrorEditor.lineCount(); i++) {
-            window.codeMirrorEditor.removeLineClass(i, 'background', 'highlighted-line');
-            window.codeMirrorEditor.removeLineClass(i, 'background', 'editing');
-        }
+        clearCodeHighlight();
         
         // Añadir clase highlighted-line
-        window.codeMirrorEditor.addLineClass(lineNumber, 'background', 'highlighted-line');
+        addCodeLineClass(lineNumber, 'highlighted-line');
         
         // ✅ NUEVO: Añadir clase .editing si está en modo edición
         if (isEditing) {
-            window.codeMirrorEditor.addLineClass(lineNumber, 'background', 'editing');
+            addCodeLineClass(lineNumber, 'editing');
             console.log(`[Highlight] Línea ${lineNumber} resaltada en modo EDITING`);
         } else {
             console.log(`[Highlight] Línea ${lineNumber} resaltada normal`);
@@ -67,11 +72,12 @@ function highlightCodeLine(lineNumber, isEditing = false) {
 
 function clearCodeHighlight() {
     if (window.codeMirrorEditor) {
-        // Limpiar todas las líneas resaltadas
-        for (let i = 0; i < window.codeMirrorEditor.lineCount(); i++) {
-            window.codeMirrorEditor.removeLineClass(i, 'background', 'highlighted-line');
-            window.codeMirrorEditor.removeLineClass(i, 'background', 'editing');
-        }
+        // Limpiar solo las líneas resaltadas (los handles siguen a la línea si el código cambia)
+        highlightedLineHandles.forEach(handle => {
+            window.codeMirrorEditor.removeLineClass(handle, 'background', 'highlighted-line');
+            window.codeMirrorEditor.removeLineClass(handle, 'background', 'editing');
+        });
+        highlightedLineHandles.clear();
     }
 }
 
@@ -187,7 +193,12 @@ function initEditing() {
         if (!el.id || el.id.trim() === '') {
             const textContent = el.textContent.trim();
             const timestamp = Date.now();
-            el.id = `fallback_${textContent.replace(/\s+/g, '-')}_${timestamp}`;
+            const fallbackId = `fallback_${textContent.replace(/\s+/g, '-')}_${timestamp}`;
+            if (window.scoreIndex) {
+                window.scoreIndex.setId(el, fallbackId);
+            } else {
+                el.id = fallbackId;
+            }
             console.log(`[initEditing] ⚠️ ID fallback asignado (elemento no vinculado): "${el.id}"`);
         } else {
             console.log(`[initEditing] ✅ ID estable preservado: "${el.id}"`);
@@ -584,7 +595,7 @@ function editTextInPlace(existingElement, points) {
                     console.error('[Edit Text] updatePythonCode NO disponible');
                 }
                 
-                saveState();
+                saveState([id]);
 
             } else if (newTextContent.trim()) {
                 const newText = createSVGElement('text', {
@@ -696,7 +707,11 @@ function finalizeNewElement(el) {
     const baseId = textContent.replace(/\s+/g, '-').replace(/[^\w-]/g, '');
     const count = document.querySelectorAll(`[id^="${baseId}"]`).length;
     const id = `${baseId}-${count}`;
-    el.id = id;
+    if (window.scoreIndex) {
+        window.scoreIndex.setId(el, id);
+    } else {
+        el.id = id;
+    }
     
     // Estilos para el nuevo elemento
     el.style.transformOrigin = 'center';
@@ -729,7 +744,7 @@ function finalizeNewElement(el) {
     interact(el).draggable({ inertia: true, listeners: { move: dragMoveListener, end: handleDragEnd } });
 
     edits[id] = { x: 0, y: 0, scale: 1.0 };
-    saveState();
+    saveState([id]);
     selectElement(el);
     
     // NUEVO: Insertar código Python para el nuevo elemento
@@ -792,7 +807,11 @@ function insertPythonCodeForNewElement(el) {
     
     // Asignar data-codeLine al elemento para vinculación
     const newLineNumber = insertLine + 2; // Línea de TextExpression
-    el.dataset.codeLine = newLineNumber;
+    if (window.scoreIndex) {
+        window.scoreIndex.setLine(el, newLineNumber);
+    } else {
+        el.dataset.codeLine = newLineNumber;
+    }
     
     console.log(`[Python Insert] ✅ Elemento vinculado a línea ${newLineNumber}`);
 }
@@ -987,7 +1006,7 @@ function pasteFromClipboard() {
         // Mostrar paleta y bounding box
         showMultipleSelectionPalette();
         
-        saveState();
+        saveState(newElements.map(el => el.id));
         console.log(`[Paste] ${newElements.length} elemento(s) pegado(s) y auto-seleccionados para mover juntos`);
         return;
     }
@@ -1031,7 +1050,7 @@ function pasteFromClipboard() {
     edits[id].x = 20;
     edits[id].y = 20;
     applyTransform(newElement);
-    saveState();
+    saveState([id]);
     
     console.log('[Paste] 1 elemento pegado con offset de 20px');
 }
@@ -1045,7 +1064,7 @@ function deleteSelectedElement() {
     deletions.add(deletedId);
     selectedElement.style.display = 'none';
     deselectAll();
-    saveState();
+    saveState([deletedId]);
     
     // NUEVO: Actualizar código Python para comentar el elemento borrado
     const codeEditor = document.getElementById('code-editor');
@@ -1068,7 +1087,7 @@ function updateScale(factor) {
     edits[id] = edit;
     applyTransform(selectedElement);
     updateEditPalettePosition(); // Actualizar paleta tras escalar
-    saveState();
+    saveState([id]);
     
     // NUEVO: Actualizar código Python si es un texto OSMD
     if (selectedElement.tagName === 'text' && typeof window.updatePythonCode === 'function') {
@@ -1093,6 +1112,7 @@ function applyTransform(target) {
     const y = edit.y || 0;
     const scale = edit.scale || 1.0;
     target.style.transform = `translate(${x}px, ${y}px) scale(${scale})`;
+    if (window.spatialIndex) window.spatialIndex.update(target);
 }
 
 // Exponer applyTransform globalmente
@@ -1174,8 +1194,11 @@ function dragMoveListener(event) {
 }
 
 function handleDragEnd(event) {
-    saveState();
-    saveToLocalStorage();
+    // Arrastre de una multi-selección: dragMoveListener movió todos, se guardan todos
+    const moved = selectedElements.has(event.target) && selectedElements.size > 1
+        ? Array.from(selectedElements, el => el.id)
+        : [event.target.id];
+    saveState(moved, 'drag');
     
     // ✅ UNIVERSAL: Actualizar Python para CUALQUIER texto movido
     const target = event ? event.target : selectedElement;
@@ -1201,28 +1224,17 @@ function handleDragEnd(event) {
 async function saveAndDownload() {
   if (!lastLoadedXML) { alert('No se ha cargado ningún MusicXML.'); return; }
   const editsToSend = {};
-  const additions = [];
   for (const id in edits) {
     const el = document.getElementById(id);
     if (!el) continue;
-    if (id.startsWith('new-element-')) {
-      additions.push({
-        id: id, type: el.getAttribute('data-type') || 'text', content: el.textContent,
-        x: edits[id].x || 0, y: edits[id].y || 0, scale: edits[id].scale || 1.0,
-        fontFamily: el.style.fontFamily || 'Times New Roman'
-      });
-    } else { editsToSend[id] = edits[id]; }
+    // Los elementos nuevos (new-element-*) no existen en el XML base
+    if (!id.startsWith('new-element-')) editsToSend[id] = edits[id];
   }
-  const payload = {
-    xml_content: lastLoadedXML, edits: editsToSend,
-    deletions: Array.from(deletions), additions: additions
-  };
+  // Protocolo delta: solo se envían las operaciones, no el XML completo
+  const ops = editsToPatchOps(editsToSend, 'x', 'y');
+  deletions.forEach(id => ops.push({ op: 'delete', id }));
   try {
-    const resp = await fetch('/apply-edits', {
-      method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(payload)
-    });
-    if (!resp.ok) throw new Error(`El servidor respondió con: ${resp.status}`);
-    const modifiedXml = await resp.text();
+    const { xml: modifiedXml } = await patchScoreXML(ops);
     downloadXML('partitura_modificada.musicxml', modifiedXml);
   } catch (err) { console.error('Error al guardar:', err); alert(`Error: ${err.message}`); }
 }
@@ -1235,92 +1247,460 @@ function downloadXML(filename, xmlString) {
   a.click(); document.body.removeChild(a); URL.revokeObjectURL(url);
 }
 
-// --- Persistencia LocalStorage ---
-function saveToLocalStorage() {
-    const data = {
-        edits: edits,
-        deletions: Array.from(deletions),
-        timestamp: Date.now()
+// --- Persistencia de sesión (IndexedDB) ---
+// El estado (edits + deletions) se guarda por documento (hash del XML renderizado),
+// repartido en trozos estables según el hash de cada ID: solo se reescriben los
+// trozos que cambian. Cada trozo va comprimido con gzip (CompressionStream) si el
+// navegador lo soporta. Las escrituras se agrupan con debounce y se hacen en tiempo
+// ocioso. Cerca de la cuota, o con demasiados documentos, se descartan los más antiguos.
+const SESSION_DB_NAME = 'score-viewer';
+const SESSION_DB_VERSION = 1;
+const SESSION_CHUNKS = 16;
+const SESSION_SAVE_DEBOUNCE_MS = 800;
+const SESSION_MAX_DOCUMENTS = 20;
+const SESSION_QUOTA_RATIO = 0.8;
+const SESSION_EMPTY_CHUNK = JSON.stringify({ edits: {}, deletions: [] });
+
+let sessionDbPromise = null;
+let sessionDocKey = 'default';
+let sessionChunkJson = new Map();   // índice → JSON ya persistido (detección de cambios)
+let sessionChunkBytes = new Map();  // índice → bytes comprimidos
+let sessionSaveTimer = null;
+let sessionWriteQueue = Promise.resolve();
+
+function openSessionDb() {
+    if (!sessionDbPromise) {
+        sessionDbPromise = new Promise((resolve, reject) => {
+            if (!window.indexedDB) {
+                reject(new Error('IndexedDB no disponible'));
+                return;
+            }
+            const request = indexedDB.open(SESSION_DB_NAME, SESSION_DB_VERSION);
+            request.onupgradeneeded = () => {
+                const db = request.result;
+                db.createObjectStore('documents', { keyPath: 'key' });
+                db.createObjectStore('chunks', { keyPath: ['doc', 'index'] });
+            };
+            request.onsuccess = () => resolve(request.result);
+            request.onerror = () => reject(request.error);
+        });
+        // El formato anterior vivía en localStorage: ya no se usa
+        try { localStorage.removeItem('scoreEdits'); } catch (e) { /* sin acceso */ }
+    }
+    return sessionDbPromise;
+}
+
+function idbRequest(request) {
+    return new Promise((resolve, reject) => {
+        request.onsuccess = () => resolve(request.result);
+        request.onerror = () => reject(request.error);
+    });
+}
+
+function idbTransactionDone(tx) {
+    return new Promise((resolve, reject) => {
+        tx.oncomplete = () => resolve();
+        tx.onabort = tx.onerror = () => reject(tx.error);
+    });
+}
+
+function sessionChunkRange(docKey) {
+    return IDBKeyRange.bound([docKey, 0], [docKey, SESSION_CHUNKS]);
+}
+
+// Trozo estable de un ID (FNV-1a): mover un elemento solo ensucia su trozo
+function sessionChunkIndex(id) {
+    let hash = 0x811c9dc5;
+    for (let i = 0; i < id.length; i++) {
+        hash ^= id.charCodeAt(i);
+        hash = Math.imul(hash, 0x01000193);
+    }
+    return (hash >>> 0) % SESSION_CHUNKS;
+}
+
+async function compressText(text) {
+    if (typeof CompressionStream === 'undefined') return text;
+    const stream = new Blob([text]).stream().pipeThrough(new CompressionStream('gzip'));
+    return new Response(stream).arrayBuffer();
+}
+
+async function decompressData(data) {
+    if (typeof data === 'string') return data;
+    const stream = new Blob([data]).stream().pipeThrough(new DecompressionStream('gzip'));
+    return new Response(stream).text();
+}
+
+function resetSessionChunks() {
+    sessionChunkJson = new Map();
+    sessionChunkBytes = new Map();
+    for (let i = 0; i < SESSION_CHUNKS; i++) sessionChunkJson.set(i, SESSION_EMPTY_CHUNK);
+}
+resetSessionChunks();
+
+function buildSessionChunks() {
+    const chunks = Array.from({ length: SESSION_CHUNKS }, () => ({ edits: {}, deletions: [] }));
+    Object.keys(edits).forEach(id => {
+        chunks[sessionChunkIndex(id)].edits[id] = edits[id];
+    });
+    deletions.forEach(id => {
+        chunks[sessionChunkIndex(id)].deletions.push(id);
+    });
+    return chunks.map(chunk => JSON.stringify(chunk));
+}
+
+async function writeSession() {
+    const docKey = sessionDocKey;
+    const jsons = buildSessionChunks();
+    const changed = [];
+    jsons.forEach((json, index) => {
+        if (sessionChunkJson.get(index) !== json) changed.push(index);
+    });
+    if (changed.length === 0) return;
+
+    const payloads = await Promise.all(changed.map(index => compressText(jsons[index])));
+    if (docKey !== sessionDocKey) return; // Cambió el documento mientras se comprimía
+
+    const put = async () => {
+        const db = await openSessionDb();
+        const tx = db.transaction(['documents', 'chunks'], 'readwrite');
+        const chunkStore = tx.objectStore('chunks');
+        changed.forEach((index, n) => {
+            if (jsons[index] === SESSION_EMPTY_CHUNK) {
+                chunkStore.delete([docKey, index]);
+            } else {
+                chunkStore.put({ doc: docKey, index, data: payloads[n] });
+            }
+        });
+        const sizes = new Map(sessionChunkBytes);
+        changed.forEach((index, n) => {
+            const payload = payloads[n];
+            sizes.set(index, jsons[index] === SESSION_EMPTY_CHUNK ? 0 : (payload.byteLength || payload.length * 2));
+        });
+        const bytes = Array.from(sizes.values()).reduce((a, b) => a + b, 0);
+        tx.objectStore('documents').put({ key: docKey, updatedAt: Date.now(), bytes });
+        await idbTransactionDone(tx);
+        return sizes;
     };
+
+    let sizes;
     try {
-        localStorage.setItem('scoreEdits', JSON.stringify(data));
-        console.log('[Persistencia] Ediciones guardadas en LocalStorage');
+        sizes = await put();
     } catch (e) {
-        console.warn('[Persistencia] Error guardando en LocalStorage:', e);
+        if (e && e.name !== 'QuotaExceededError') throw e;
+        console.warn('[Persistencia] Cuota excedida: descartando documentos antiguos y reintentando');
+        await enforceSessionQuota(true);
+        sizes = await put();
+    }
+
+    if (docKey === sessionDocKey) {
+        changed.forEach(index => sessionChunkJson.set(index, jsons[index]));
+        sessionChunkBytes = sizes;
+    }
+    const kb = (Array.from(sizes.values()).reduce((a, b) => a + b, 0) / 1024).toFixed(1);
+    console.log(`[Persistencia] ${changed.length}/${SESSION_CHUNKS} trozo(s) guardado(s) en IndexedDB (${kb} KB comprimidos)`);
+
+    enforceSessionQuota(false).catch(e => console.warn('[Persistencia] Error aplicando cuota:', e));
+}
+
+// Descarta los documentos menos recientes si hay demasiados o el origen se acerca a la cuota
+async function enforceSessionQuota(force) {
+    const db = await openSessionDb();
+    const docs = await idbRequest(db.transaction('documents').objectStore('documents').getAll());
+    docs.sort((a, b) => a.updatedAt - b.updatedAt);
+
+    let usage = 0;
+    let limit = Infinity;
+    if (navigator.storage && navigator.storage.estimate) {
+        const estimate = await navigator.storage.estimate();
+        if (estimate.quota) {
+            usage = estimate.usage || 0;
+            limit = estimate.quota * SESSION_QUOTA_RATIO;
+        }
+    }
+
+    let excess = docs.length - SESSION_MAX_DOCUMENTS;
+    let mustFree = force;
+    const victims = [];
+    for (const doc of docs) {
+        if (doc.key === sessionDocKey) continue;
+        if (excess <= 0 && usage <= limit && !mustFree) break;
+        victims.push(doc.key);
+        excess--;
+        usage -= doc.bytes || 0;
+        mustFree = false;
     }
+    if (victims.length === 0) return;
+
+    const tx = db.transaction(['documents', 'chunks'], 'readwrite');
+    victims.forEach(key => {
+        tx.objectStore('documents').delete(key);
+        tx.objectStore('chunks').delete(sessionChunkRange(key));
+    });
+    await idbTransactionDone(tx);
+    console.log(`[Persistencia] ${victims.length} documento(s) antiguo(s) descartado(s)`);
+}
+
+function runSessionWrite() {
+    sessionWriteQueue = sessionWriteQueue
+        .then(writeSession)
+        .catch(e => console.warn('[Persistencia] Error guardando en IndexedDB:', e));
+    return sessionWriteQueue;
+}
+
+// Guardado con debounce, fuera del camino crítico (tiempo ocioso)
+function saveSession() {
+    clearTimeout(sessionSaveTimer);
+    sessionSaveTimer = setTimeout(() => {
+        sessionSaveTimer = null;
+        if (window.requestIdleCallback) {
+            requestIdleCallback(runSessionWrite, { timeout: 2000 });
+        } else {
+            runSessionWrite();
+        }
+    }, SESSION_SAVE_DEBOUNCE_MS);
 }
 
-function loadFromLocalStorage() {
+// Escribe ya lo pendiente (al ocultar o cerrar la página, o al cambiar de documento)
+function flushSession() {
+    if (sessionSaveTimer === null) return sessionWriteQueue;
+    clearTimeout(sessionSaveTimer);
+    sessionSaveTimer = null;
+    return runSessionWrite();
+}
+
+function setSessionDocument(docKey) {
+    if (!docKey || docKey === sessionDocKey) return;
+    flushSession();
+    sessionDocKey = docKey;
+    resetSessionChunks();
+}
+
+async function loadSession() {
     try {
-        const data = JSON.parse(localStorage.getItem('scoreEdits'));
-        if (data) {
-            edits = data.edits || {};
-            window.edits = edits; // Sincronizar con window
-            deletions = new Set(data.deletions || []);
-            console.log('[Persistencia] Ediciones cargadas desde LocalStorage');
-            return true;
+        await sessionWriteQueue; // Un clearSession pendiente debe ir antes que la lectura
+        const docKey = sessionDocKey;
+        const db = await openSessionDb();
+        const tx = db.transaction(['documents', 'chunks'], 'readonly');
+        const records = await idbRequest(tx.objectStore('chunks').getAll(sessionChunkRange(docKey)));
+        if (records.length === 0 || docKey !== sessionDocKey) return false;
+
+        const loadedEdits = {};
+        const loadedDeletions = new Set();
+        for (const record of records) {
+            const json = await decompressData(record.data);
+            const chunk = JSON.parse(json);
+            Object.assign(loadedEdits, chunk.edits);
+            chunk.deletions.forEach(id => loadedDeletions.add(id));
+            sessionChunkJson.set(record.index, json);
+            sessionChunkBytes.set(record.index, record.data.byteLength || record.data.length * 2);
+        }
+
+        edits = loadedEdits;
+        window.edits = edits; // Sincronizar con window
+        deletions = loadedDeletions;
+        resetHistory(); // El estado cargado es la base del historial
+
+        // Marcar como usado recientemente (orden de descarte)
+        const touch = db.transaction('documents', 'readwrite');
+        const doc = await idbRequest(touch.objectStore('documents').get(docKey));
+        if (doc) {
+            doc.updatedAt = Date.now();
+            touch.objectStore('documents').put(doc);
         }
+        console.log(`[Persistencia] Ediciones cargadas desde IndexedDB (${records.length} trozo(s))`);
+        return true;
     } catch (e) {
-        console.warn('[Persistencia] Error cargando desde LocalStorage:', e);
+        console.warn('[Persistencia] Error cargando desde IndexedDB:', e);
     }
     return false;
 }
 
-function clearLocalStorage() {
-    localStorage.removeItem('scoreEdits');
-    console.log('[Persistencia] LocalStorage limpiado');
-}
+// Borra lo persistido del documento actual (nuevo render o reset)
+function clearSession() {
+    clearTimeout(sessionSaveTimer);
+    sessionSaveTimer = null;
+    const docKey = sessionDocKey;
+    resetSessionChunks();
+    sessionWriteQueue = sessionWriteQueue
+        .then(async () => {
+            const db = await openSessionDb();
+            const tx = db.transaction(['documents', 'chunks'], 'readwrite');
+            tx.objectStore('documents').delete(docKey);
+            tx.objectStore('chunks').delete(sessionChunkRange(docKey));
+            await idbTransactionDone(tx);
+            console.log('[Persistencia] Sesión del documento limpiada');
+        })
+        .catch(e => console.warn('[Persistencia] Error limpiando IndexedDB:', e));
+    return sessionWriteQueue;
+}
+
+document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'hidden') flushSession();
+});
+window.addEventListener('pagehide', flushSession);
 
 // --- Historial (Undo/Redo) ---
-function saveState() {
-  if (historyIndex < history.length - 1) history = history.slice(0, historyIndex + 1);
-  const currentState = {
-    edits: JSON.parse(JSON.stringify(edits)),
-    deletions: new Set(Array.from(deletions))
-    // Nota: La recreación de elementos nuevos en undo/redo no está implementada.
-  };
-  history.push(currentState);
-  historyIndex++;
+// Cada entrada guarda solo los elementos que cambiaron: {id → {before, after}} de edits
+// (serializados) y de deletions. Deshacer/rehacer toca solo esos elementos.
+// Los arrastres seguidos de los mismos elementos se fusionan en una entrada y el
+// historial respeta un presupuesto de memoria descartando las entradas más antiguas.
+const HISTORY_COALESCE_MS = 1500;
+let historyMaxBytes = window.HISTORY_MAX_BYTES || 2 * 1024 * 1024;
+let historyBytes = 0;
+let historyBaseline = { edits: new Map(), deletions: new Set() }; // Estado ya registrado
+
+function serializeEdit(id) {
+  return edits[id] ? JSON.stringify(edits[id]) : null;
+}
+
+function resetHistory() {
+  history = [];
+  historyIndex = -1;
+  historyBytes = 0;
+  historyBaseline = { edits: new Map(), deletions: new Set(deletions) };
+  Object.keys(edits).forEach(id => historyBaseline.edits.set(id, serializeEdit(id)));
   updateUndoRedoButtons();
 }
-function restoreState(state) {
-  edits = JSON.parse(JSON.stringify(state.edits));
-  window.edits = edits; // Sincronizar con window
-  deletions = new Set(Array.from(state.deletions));
-  
-  // ✅ CORREGIDO: Incluir elementos de OSMD Y anotaciones
-  const allElements = document.querySelectorAll('#osmd-container text, #annotation-svg text, #sheet-music-svg');
-  
-  allElements.forEach(el => {
-    if (deletions.has(el.id)) {
-        el.style.display = 'none';
-    } else {
-        el.style.display = '';
-        applyTransform(el);
 
-        // Restaurar contenido de texto si es un elemento de texto
-        if (el.tagName === 'text') {
-            const edit = edits[el.id];
-            if (edit && typeof edit.textContent !== 'undefined') {
-                el.textContent = edit.textContent;
-            } else if (originalTexts.hasOwnProperty(el.id)) {
-                // Si no hay edición de texto en este estado, volver al original
-                el.textContent = originalTexts[el.id];
-            }
-        }
+function entrySize(changes) {
+  let bytes = 64;
+  changes.forEach((change, id) => {
+    bytes += 48 + id.length * 2 + (change.before || '').length * 2 + (change.after || '').length * 2;
+  });
+  return bytes;
+}
+
+// changedIds: IDs afectados (O(tamaño del cambio)); sin ellos se compara todo el estado.
+// kind: 'drag' permite fusionar arrastres consecutivos de los mismos elementos.
+function saveState(changedIds = null, kind = 'edit') {
+  const ids = changedIds
+    ? new Set(changedIds)
+    : new Set([...Object.keys(edits), ...historyBaseline.edits.keys(), ...deletions, ...historyBaseline.deletions]);
+
+  const changes = new Map();
+  ids.forEach(id => {
+    if (!id) return;
+    const after = serializeEdit(id);
+    const before = historyBaseline.edits.has(id) ? historyBaseline.edits.get(id) : null;
+    const deletedAfter = deletions.has(id);
+    const deletedBefore = historyBaseline.deletions.has(id);
+    if (after === before && deletedAfter === deletedBefore) return;
+
+    changes.set(id, { before, after, deletedBefore, deletedAfter });
+    historyBaseline.edits.set(id, after);
+    if (deletedAfter) historyBaseline.deletions.add(id);
+    else historyBaseline.deletions.delete(id);
+  });
+  if (changes.size === 0) return;
+
+  // Descartar la rama de rehacer
+  while (history.length - 1 > historyIndex) {
+    historyBytes -= history.pop().bytes;
+  }
+
+  const key = Array.from(changes.keys()).sort().join('|');
+  const now = Date.now();
+  const last = history[historyIndex];
+  if (kind === 'drag' && last && last.kind === 'drag' && last.key === key && now - last.time < HISTORY_COALESCE_MS) {
+    // Fusionar con el arrastre anterior: se conserva su "before"
+    changes.forEach((change, id) => {
+      const merged = last.changes.get(id);
+      merged.after = change.after;
+      merged.deletedAfter = change.deletedAfter;
+    });
+    historyBytes -= last.bytes;
+    last.bytes = entrySize(last.changes);
+    last.time = now;
+    historyBytes += last.bytes;
+  } else {
+    const entry = { changes, kind, key, time: now, bytes: entrySize(changes) };
+    history.push(entry);
+    historyIndex++;
+    historyBytes += entry.bytes;
+  }
+
+  evictHistory();
+  updateUndoRedoButtons();
+  saveSession();
+}
+
+// Presupuesto de memoria: descartar las entradas aplicadas más antiguas
+// (se conserva siempre la última aplicada y la rama de rehacer)
+function evictHistory() {
+  while (historyBytes > historyMaxBytes && historyIndex > 0) {
+    historyBytes -= history.shift().bytes;
+    historyIndex--;
+  }
+}
+
+function setHistoryMaxBytes(bytes) {
+  historyMaxBytes = bytes;
+  evictHistory();
+  updateUndoRedoButtons();
+}
+window.setHistoryMaxBytes = setHistoryMaxBytes;
+
+function refreshHistoryElement(id) {
+  const el = window.scoreIndex ? window.scoreIndex.get(id) : document.getElementById(id);
+  if (!el) return;
+
+  if (deletions.has(id)) {
+    el.style.display = 'none';
+    return;
+  }
+  el.style.display = '';
+  applyTransform(el);
+
+  // Restaurar contenido de texto si es un elemento de texto
+  if (el.tagName === 'text') {
+    const edit = edits[id];
+    if (edit && typeof edit.textContent !== 'undefined') {
+      el.textContent = edit.textContent;
+    } else if (originalTexts.hasOwnProperty(id)) {
+      // Si no hay edición de texto en este estado, volver al original
+      el.textContent = originalTexts[id];
     }
+  }
+}
+
+// Aplica una entrada en una dirección ('before' = deshacer, 'after' = rehacer)
+function applyHistoryEntry(entry, side) {
+  const deletedKey = side === 'before' ? 'deletedBefore' : 'deletedAfter';
+  entry.changes.forEach((change, id) => {
+    const value = change[side];
+    if (value === null) delete edits[id];
+    else edits[id] = JSON.parse(value);
+    if (change[deletedKey]) deletions.add(id);
+    else deletions.delete(id);
+
+    historyBaseline.edits.set(id, value);
+    if (change[deletedKey]) historyBaseline.deletions.add(id);
+    else historyBaseline.deletions.delete(id);
+
+    refreshHistoryElement(id);
   });
-  
+  window.edits = edits; // Sincronizar con window
+
   // ✅ Limpiar selección múltiple si existe
   clearMultipleSelection();
-  
+  saveSession();
+  console.log(`[Undo/Redo] ${entry.changes.size} elemento(s) restaurado(s)`);
+}
+
+function undo() {
+  if (historyIndex < 0) return;
+  applyHistoryEntry(history[historyIndex], 'before');
+  historyIndex--;
+  updateUndoRedoButtons();
+}
+function redo() {
+  if (historyIndex >= history.length - 1) return;
+  historyIndex++;
+  applyHistoryEntry(history[historyIndex], 'after');
   updateUndoRedoButtons();
-  console.log('[Undo/Redo] Estado restaurado correctamente');
 }
-function undo() { if (historyIndex > 0) { historyIndex--; restoreState(history[historyIndex]); } }
-function redo() { if (historyIndex < history.length - 1) { historyIndex++; restoreState(history[historyIndex]); } }
 function updateUndoRedoButtons() {
-    document.getElementById('undo-btn').disabled = historyIndex <= 0;
+    document.getElementById('undo-btn').disabled = historyIndex < 0;
     document.getElementById('redo-btn').disabled = historyIndex >= history.length - 1;
 }
 function resetAndSaveInitialState() {
@@ -1333,10 +1713,8 @@ function resetAndSaveInitialState() {
     edits = {}; 
     window.edits = edits; // Sincronizar con window
     deletions.clear(); 
-    history = []; 
-    historyIndex = -1;
     newElementCounter = 0; 
-    saveState();
+    resetHistory();
 }
 
 // --- Utilidades ---
@@ -1421,43 +1799,327 @@ document.getElementById('save-btn')?.addEventListener('click', async () => {
 });
 
 // ====== EXPORTACIÓN DE IMÁGENES (PNG/SVG) ======
-async function exportAsPNG() {
-  const svg = document.querySelector('#osmd-container svg');
-  if (!svg) {
+// El PNG se genera por tiles: cada página renderizada (#osmd-container y las páginas
+// del render paginado) se corta en hojas por los huecos entre sistemas y cada hoja se
+// rasteriza y codifica por separado. Ningún canvas pasa de los límites del navegador
+// y en memoria solo hay unos pocos tiles a la vez; la codificación PNG va a un worker
+// con OffscreenCanvas si hay soporte. Una hoja se descarga como PNG; varias, en un ZIP.
+const PNG_EXPORT = {
+  screenScale: 2,             // opción "PNG": 2x para calidad en pantalla
+  printScale: 300 / 96,       // opción "PNG 300 ppp": px CSS (96 ppp) → 300 ppp
+  maxCanvasSide: 16384,       // lado máximo de canvas seguro en Chrome/Firefox/Safari
+  maxCanvasPixels: 16777216,  // 4096²: área máxima de canvas en Safari/iOS
+  pageAspect: Math.SQRT2,     // hojas A4 en vertical (alto = ancho · √2)
+  maxInFlight: 2,             // tiles rasterizados esperando al codificador
+  workerUrl: '/static/js/png-export-worker.js'
+};
+let pngExportRunning = false;
+
+// Bandas verticales ocupadas por compases y textos, en px CSS relativos al SVG
+function pngContentBands(svg, svgRect) {
+  const intervals = [];
+  svg.querySelectorAll('g.vf-measure, text').forEach(el => {
+    const r = el.getBoundingClientRect();
+    if (r.height > 0) intervals.push([r.top - svgRect.top, r.bottom - svgRect.top]);
+  });
+  intervals.sort((a, b) => a[0] - b[0]);
+  const bands = [];
+  for (const [top, bottom] of intervals) {
+    const last = bands[bands.length - 1];
+    if (last && top <= last[1]) last[1] = Math.max(last[1], bottom);
+    else bands.push([top, bottom]);
+  }
+  return bands;
+}
+
+// Hojas de un SVG: [{ top, bottom }] en px CSS, cortando entre sistemas siempre que se pueda
+function planPngTiles(svg, scale) {
+  const rect = svg.getBoundingClientRect();
+  const maxHeight = Math.min(
+    PNG_EXPORT.maxCanvasSide / scale,
+    PNG_EXPORT.maxCanvasPixels / (rect.width * scale * scale)
+  );
+  const pageHeight = Math.max(1, Math.min(rect.width * PNG_EXPORT.pageAspect, maxHeight));
+
+  const bands = pngContentBands(svg, rect);
+  const gaps = [];
+  for (let i = 1; i < bands.length; i++) {
+    gaps.push({ at: (bands[i - 1][1] + bands[i][0]) / 2, size: bands[i][0] - bands[i - 1][1] });
+  }
+
+  const tiles = [];
+  let top = 0;
+  while (rect.height - top > 0.5) {
+    const limit = top + pageHeight;
+    let bottom = rect.height;
+    if (limit < rect.height) {
+      // El hueco más ancho de la segunda mitad de la hoja (entre sistemas suele ser mayor
+      // que entre pentagramas); si no hay, el último que quepa; si tampoco, corte duro
+      const fitting = gaps.filter(g => g.at > top && g.at <= limit);
+      const late = fitting.filter(g => g.at >= top + pageHeight / 2);
+      const pool = late.length ? late : fitting;
+      bottom = pool.length ? pool.reduce((a, b) => (b.size > a.size ? b : a)).at : limit;
+    }
+    tiles.push({ top, bottom });
+    top = bottom;
+  }
+  return tiles;
+}
+
+// SVG independiente con solo la franja [top, bottom] del original, ya al tamaño final en px
+function pngTileMarkup(svg, body, tile, scale) {
+  const rect = svg.getBoundingClientRect();
+  const base = svg.viewBox && svg.viewBox.baseVal;
+  const vb = base && base.width ? base : { x: 0, y: 0, width: rect.width, height: rect.height };
+  const unitsPerPx = vb.height / rect.height;
+  const width = Math.round(rect.width * scale);
+  const height = Math.max(1, Math.round((tile.bottom - tile.top) * scale));
+  return `<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" ` +
+    `width="${width}" height="${height}" preserveAspectRatio="none" ` +
+    `viewBox="${vb.x} ${vb.y + tile.top * unitsPerPx} ${vb.width} ${(tile.bottom - tile.top) * unitsPerPx}">` +
+    `${body}</svg>`;
+}
+
+// Codificación en el hilo principal (sin Worker/OffscreenCanvas, o si createImageBitmap falla)
+async function encodePngOnMainThread(img) {
+  const canvas = document.createElement('canvas');
+  canvas.width = img.naturalWidth;
+  canvas.height = img.naturalHeight;
+  const ctx = canvas.getContext('2d');
+  ctx.fillStyle = 'white';
+  ctx.fillRect(0, 0, canvas.width, canvas.height);
+  ctx.drawImage(img, 0, 0);
+  const blob = await new Promise((resolve, reject) => {
+    canvas.toBlob(b => (b ? resolve(b) : reject(new Error('canvas.toBlob no devolvió imagen'))), 'image/png');
+  });
+  canvas.width = canvas.height = 0;
+  return new Uint8Array(await blob.arrayBuffer());
+}
+
+function createPngEncoder() {
+  if (typeof Worker !== 'undefined' && typeof OffscreenCanvas !== 'undefined' &&
+      typeof createImageBitmap === 'function') {
+    try {
+      const worker = new Worker(PNG_EXPORT.workerUrl);
+      const pending = new Map();
+      let nextId = 0;
+      worker.onmessage = (e) => {
+        const { id, bytes, error } = e.data;
+        const job = pending.get(id);
+        pending.delete(id);
+        if (!job) return;
+        if (error) job.reject(new Error(error));
+        else job.resolve(bytes);
+      };
+      worker.onerror = (e) => {
+        pending.forEach(job => job.reject(new Error(e.message || 'El worker PNG falló')));
+        pending.clear();
+      };
+      return {
+        inWorker: true,
+        async encode(img) {
+          let bitmap;
+          try {
+            bitmap = await createImageBitmap(img);
+          } catch (e) {
+            return encodePngOnMainThread(img); // algunos navegadores no aceptan SVG aquí
+          }
+          return new Promise((resolve, reject) => {
+            const id = nextId++;
+            pending.set(id, { resolve, reject });
+            worker.postMessage({ id, bitmap }, [bitmap]);
+          });
+        },
+        close() { worker.terminate(); }
+      };
+    } catch (e) {
+      console.warn('[Export PNG] Worker no disponible, se codifica en el hilo principal:', e);
+    }
+  }
+  return { inWorker: false, encode: encodePngOnMainThread, close() {} };
+}
+
+// ZIP sin compresión (los PNG ya van comprimidos): cabeceras locales + directorio central
+const CRC32_TABLE = (() => {
+  const table = new Uint32Array(256);
+  for (let n = 0; n < 256; n++) {
+    let c = n;
+    for (let k = 0; k < 8; k++) c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+    table[n] = c >>> 0;
+  }
+  return table;
+})();
+
+function crc32(bytes) {
+  let crc = 0xFFFFFFFF;
+  for (let i = 0; i < bytes.length; i++) crc = CRC32_TABLE[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+  return (crc ^ 0xFFFFFFFF) >>> 0;
+}
+
+function buildStoredZip(files) {
+  const encoder = new TextEncoder();
+  const DOS_DATE = (1 << 5) | 1;  // 1980-01-01: sin fecha real, salida reproducible
+  const parts = [];
+  const central = [];
+  let offset = 0;
+  for (const file of files) {
+    const name = encoder.encode(file.name);
+    const crc = crc32(file.bytes);
+    const size = file.bytes.length;
+
+    const local = new DataView(new ArrayBuffer(30));
+    local.setUint32(0, 0x04034b50, true);
+    local.setUint16(4, 20, true);       // versión necesaria
+    local.setUint16(6, 0x0800, true);   // nombres en UTF-8
+    local.setUint16(12, DOS_DATE, true);
+    local.setUint32(14, crc, true);
+    local.setUint32(18, size, true);
+    local.setUint32(22, size, true);
+    local.setUint16(26, name.length, true);
+    parts.push(local, name, file.bytes);
+
+    const entry = new DataView(new ArrayBuffer(46));
+    entry.setUint32(0, 0x02014b50, true);
+    entry.setUint16(4, 20, true);
+    entry.setUint16(6, 20, true);
+    entry.setUint16(8, 0x0800, true);
+    entry.setUint16(14, DOS_DATE, true);
+    entry.setUint32(16, crc, true);
+    entry.setUint32(20, size, true);
+    entry.setUint32(24, size, true);
+    entry.setUint16(28, name.length, true);
+    entry.setUint32(42, offset, true);
+    central.push(entry, name);
+
+    offset += 30 + name.length + size;
+  }
+  const centralSize = central.reduce((n, part) => n + part.byteLength, 0);
+  const end = new DataView(new ArrayBuffer(22));
+  end.setUint32(0, 0x06054b50, true);
+  end.setUint16(8, files.length, true);
+  end.setUint16(10, files.length, true);
+  end.setUint32(12, centralSize, true);
+  end.setUint32(16, offset, true);
+  return new Blob([...parts, ...central, end], { type: 'application/zip' });
+}
+
+function showPngExportProgress(done, total) {
+  let box = document.getElementById('png-export-progress');
+  if (!box) {
+    box = document.createElement('div');
+    box.id = 'png-export-progress';
+    box.style.cssText = `
+      position: fixed;
+      right: 16px;
+      bottom: 16px;
+      padding: 8px 12px;
+      border-radius: 6px;
+      background: rgba(30, 30, 40, 0.9);
+      color: white;
+      font-size: 13px;
+      z-index: 2000;
+      box-shadow: 0 2px 8px rgba(0, 0, 0, 0.3);
+    `;
+    box.innerHTML = '<span></span><div style="margin-top:6px;height:4px;background:rgba(255,255,255,0.2)">' +
+      '<div style="height:100%;width:0;background:linear-gradient(90deg, #667eea 0%, #764ba2 100%)"></div></div>';
+    document.body.appendChild(box);
+  }
+  box.querySelector('span').textContent = total ? `🖼️ Exportando PNG: hoja ${done}/${total}` : '🖼️ Cargando páginas…';
+  box.querySelector('div > div').style.width = total ? `${(100 * done / total).toFixed(1)}%` : '0';
+}
+
+function hidePngExportProgress() {
+  document.getElementById('png-export-progress')?.remove();
+}
+
+function downloadBlob(blob, filename) {
+  const a = document.createElement('a');
+  a.href = URL.createObjectURL(blob);
+  a.download = filename;
+  a.click();
+  setTimeout(() => URL.revokeObjectURL(a.href), 10000);
+}
+
+async function exportAsPNG(scale = PNG_EXPORT.screenScale) {
+  if (pngExportRunning) {
+    console.warn('[Export PNG] Ya hay una exportación en curso');
+    return;
+  }
+  if (!document.querySelector('#osmd-container svg')) {
     alert('No hay partitura para exportar');
     return;
   }
-  
-  // Clonar SVG y serializarlo
-  const svgClone = svg.cloneNode(true);
-  const svgData = new XMLSerializer().serializeToString(svgClone);
-  const svgBlob = new Blob([svgData], {type: 'image/svg+xml;charset=utf-8'});
-  
-  // Crear imagen desde SVG
-  const img = new Image();
-  const url = URL.createObjectURL(svgBlob);
-  
-  img.onload = () => {
-    const canvas = document.createElement('canvas');
-    canvas.width = svg.getBoundingClientRect().width * 2; // 2x para calidad
-    canvas.height = svg.getBoundingClientRect().height * 2;
-    
-    const ctx = canvas.getContext('2d');
-    ctx.fillStyle = 'white';
-    ctx.fillRect(0, 0, canvas.width, canvas.height);
-    ctx.drawImage(img, 0, 0, canvas.width, canvas.height);
-    
-    canvas.toBlob(blob => {
-      const a = document.createElement('a');
-      a.href = URL.createObjectURL(blob);
-      a.download = 'partitura.png';
-      a.click();
-      URL.revokeObjectURL(url);
-      console.log('[Export PNG] Imagen descargada');
+
+  pngExportRunning = true;
+  const t0 = performance.now();
+  let encoder = null;
+  try {
+    // Render paginado: incluir también las páginas que aún no ha cargado el scroll
+    showPngExportProgress(0, 0);
+    if (typeof window.loadAllScorePages === 'function') await window.loadAllScorePages();
+
+    const plan = [];
+    document.querySelectorAll('#osmd-container svg, .osmd-page svg').forEach(svg => {
+      const width = svg.getBoundingClientRect().width;
+      if (!width) return;
+      const svgScale = Math.min(scale, PNG_EXPORT.maxCanvasSide / width);
+      plan.push({ svg, scale: svgScale, tiles: planPngTiles(svg, svgScale) });
     });
-  };
-  
-  img.src = url;
+    const total = plan.reduce((n, page) => n + page.tiles.length, 0);
+    console.log(`[Export PNG] ${plan.length} página(s) → ${total} hoja(s) a ${scale.toFixed(2)}x`);
+
+    encoder = createPngEncoder();
+    const serializer = new XMLSerializer();
+    const files = [];
+    const inFlight = new Set();
+    let done = 0;
+    showPngExportProgress(0, total);
+
+    for (const page of plan) {
+      // El contenido de la página se serializa una vez y se reutiliza en todas sus hojas
+      const body = Array.from(page.svg.childNodes, node => serializer.serializeToString(node)).join('');
+      for (const tile of page.tiles) {
+        const index = files.length;
+        files.push(null);
+        const markup = pngTileMarkup(page.svg, body, tile, page.scale);
+        const job = (async () => {
+          const url = URL.createObjectURL(new Blob([markup], { type: 'image/svg+xml;charset=utf-8' }));
+          try {
+            const img = new Image();
+            img.src = url;
+            await img.decode();
+            const bytes = await encoder.encode(img);
+            files[index] = { name: `partitura-${String(index + 1).padStart(3, '0')}.png`, bytes };
+          } finally {
+            URL.revokeObjectURL(url);
+          }
+          showPngExportProgress(++done, total);
+        })();
+        const forget = () => inFlight.delete(job);
+        job.then(forget, forget);
+        inFlight.add(job);
+        // Memoria acotada: no rasterizar más hojas mientras el codificador va atrasado
+        if (inFlight.size >= PNG_EXPORT.maxInFlight) await Promise.race(inFlight);
+      }
+    }
+    await Promise.all(inFlight);
+
+    if (files.length === 1) {
+      downloadBlob(new Blob([files[0].bytes], { type: 'image/png' }), 'partitura.png');
+    } else {
+      downloadBlob(buildStoredZip(files), 'partitura.zip');
+    }
+    const bytes = files.reduce((n, file) => n + file.bytes.length, 0);
+    console.log(`[Export PNG] ✅ ${files.length} hoja(s), ${(bytes / 1048576).toFixed(1)} MB en ` +
+      `${(performance.now() - t0).toFixed(0)}ms (${encoder.inWorker ? 'worker' : 'hilo principal'})`);
+  } catch (e) {
+    console.error('[Export PNG] ❌ Error:', e);
+    alert(`Error al exportar PNG:\n${e.message}`);
+  } finally {
+    if (encoder) encoder.close();
+    hidePngExportProgress();
+    pngExportRunning = false;
+  }
 }
 
 function exportAsSVG() {
@@ -1482,6 +2144,7 @@ function exportAsSVG() {
 document.getElementById('export-image-select')?.addEventListener('change', (e) => {
   const format = e.target.value;
   if (format === 'png') exportAsPNG();
+  else if (format === 'png-print') exportAsPNG(PNG_EXPORT.printScale);
   else if (format === 'svg') exportAsSVG();
   e.target.value = ''; // Reset select
 });
@@ -1895,6 +2558,11 @@ function findNoteHeadFromLyric(lyric) {
     const lyricX = lyricRect.left + lyricRect.width / 2;
     const lyricY = lyricRect.top;
     
+    // Vía rápida: rejilla espacial (ver spatialIndex en main.js)
+    if (window.spatialIndex) {
+      return window.spatialIndex.nearest(lyricX, lyricY, 'note', { side: 'above' });
+    }
+    
     // Buscar ellipses (cabezas de nota) ARRIBA del lyric
     const noteHeads = svg.querySelectorAll('ellipse, path[d*="M"]');
     let closestNote = null;
@@ -1936,6 +2604,15 @@ function findClosestLyricToNote(noteHead) {
     const noteY = noteRect.top + noteRect.height / 2;
     const noteX = noteRect.left + noteRect.width / 2;
     
+    // Vía rápida: rejilla espacial, solo lyrics del código debajo de la nota
+    if (window.spatialIndex) {
+      return window.spatialIndex.nearest(noteX, noteY, 'text', {
+        anchor: 'top',
+        side: 'below',
+        accept: el => !!el.dataset.codeLine
+      });
+    }
+    
     const lyrics = svg.querySelectorAll('text');
     let closestLyric = null;
     let minDistance = Infinity;
@@ -2112,8 +2789,14 @@ function endSelection(e) {
     selectionBox.style.display = 'none';
     
     // ✅ MEJORADO: Incluir elementos de OSMD Y elementos de anotación
-    const elements = document.querySelectorAll('#osmd-container text, #annotation-svg text');
-    console.log(`[Multi-Select] ${elements.length} elemento(s) de texto encontrado(s) (OSMD + anotaciones)`);
+    // Los textos de OSMD salen de la rejilla espacial (solo las celdas que toca el
+    // rectángulo); las anotaciones, pocas y cambiantes, se recorren siempre
+    const t0 = performance.now();
+    const elements = window.spatialIndex && window.spatialIndex.ensure()
+        ? [...window.spatialIndex.query(boxRect, 'text'),
+           ...document.querySelectorAll('#annotation-svg text')]
+        : document.querySelectorAll('#osmd-container text, #annotation-svg text');
+    console.log(`[Multi-Select] ${elements.length} candidato(s) de texto (OSMD + anotaciones) en ${(performance.now() - t0).toFixed(2)}ms`);
     
     let selectionCount = 0;
     elements.forEach(el => {
@@ -2208,8 +2891,7 @@ function createMultiSelectionBox() {
             listeners: {
                 move: dragMultiSelectionBox,
                 end: () => {
-                    saveState();
-                    saveToLocalStorage();
+                    saveState(Array.from(selectedElements, el => el.id), 'drag');
                 }
             }
         });
@@ -2309,7 +2991,7 @@ function highlightMultipleCodeLines() {
     
     // Resaltar todas las líneas
     lineNumbers.forEach(lineNum => {
-        window.codeMirrorEditor.addLineClass(lineNum, 'background', 'highlighted-line');
+        addCodeLineClass(lineNum, 'highlighted-line');
     });
     
     // Scroll a la primera línea (centrada)
@@ -2365,7 +3047,7 @@ updateScale = function(factor) {
                 console.log(`[Scale Multi] ✅ Python actualizado para "${el.textContent.trim()}"`);
             }
         });
-        saveState();
+        saveState(Array.from(selectedElements, el => el.id));
     } else {
         originalUpdateScale(factor);
     }
@@ -2384,7 +3066,7 @@ deleteSelectedElement = function() {
         });
         
         clearMultipleSelection();
-        saveState();
+        saveState(deletedIds);
         
         // Actualizar código Python
         if (typeof window.updateDeletionsInPython === 'function') {
@@ -2416,7 +3098,7 @@ function updateScaleMultiple(factor) {
         }
     });
     
-    saveState();
+    saveState(Array.from(selectedElements, el => el.id));
     showMultipleSelectionPalette();
     
     // ✅ FIX: Mantener resaltado al escalar multi-selección
@@ -2443,7 +3125,7 @@ function deleteMultipleElements() {
     
     clearMultipleSelection();
     hideMultipleSelectionPalette();
-    saveState();
+    saveState(deletedIds);
     
     // Actualizar código Python
     if (typeof window.updateDeletionsInPython === 'function') {
@@ -2858,8 +3540,10 @@ window.applyTransform = applyTransform;
 window.dragMoveListener = dragMoveListener;
 window.handleDragEnd = handleDragEnd;
 window.updateScale = updateScale;
-window.loadFromLocalStorage = loadFromLocalStorage;
-window.saveToLocalStorage = saveToLocalStorage;
+window.loadSession = loadSession;
+window.saveSession = saveSession;
+window.clearSession = clearSession;
+window.setSessionDocument = setSessionDocument;
 window.getDeletions = getDeletions;
 window.exportAsPNG = exportAsPNG;
 window.exportAsSVG = exportAsSVG;
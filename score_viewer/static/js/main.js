@@ -1,6 +1,539 @@
 let lastLoadedXML = ''; // Variable global para guardar el último XML
+let lastLoadedHash = null; // Hash del XML en el almacén del servidor (protocolo delta)
+let lastLayoutHints = null; // Pistas de layout calculadas por el servidor (X-Layout-Hints)
 let convertedTexts = new Set(); // IDs de textos convertidos a overlay
 
+// ====== PARTITURA COMPLETA TRAS UN RENDER PAGINADO ======
+// Con render paginado lastLoadedXML es al principio solo la primera ventana de compases:
+// la partitura completa llega después desde /document/<hash>. Todo lo que trabaja sobre
+// el documento entero (parches y su fallback con XML completo) pasa por ensureFullScoreXML.
+let partialScoreHash = null;    // documento cuya partitura completa aún no está en lastLoadedXML
+let fullScoreDownload = null;   // { hash, promise } descarga en curso
+
+function loadFullScoreXML(hash) {
+  if (!fullScoreDownload || fullScoreDownload.hash !== hash) {
+    const download = { hash };
+    download.promise = fetch(`/document/${hash}`)
+      .then(r => {
+        if (!r.ok) throw new Error(`HTTP ${r.status}`);
+        return r.text();
+      })
+      .then(fullXML => {
+        if (partialScoreHash === hash) {
+          lastLoadedXML = fullXML;
+          partialScoreHash = null;
+        }
+      })
+      .finally(() => {
+        if (fullScoreDownload === download) fullScoreDownload = null;
+      });
+    fullScoreDownload = download;
+  }
+  return fullScoreDownload.promise;
+}
+
+// Espera (o reintenta) la partitura completa; nunca devuelve una ventana de compases
+async function ensureFullScoreXML() {
+  if (partialScoreHash) {
+    try {
+      await loadFullScoreXML(partialScoreHash);
+    } catch (e) {
+      throw new Error(`La partitura completa aún no está disponible (${e.message})`);
+    }
+  }
+  return lastLoadedXML;
+}
+window.ensureFullScoreXML = ensureFullScoreXML;
+
+// ====== PISTAS DE LAYOUT DEL SERVIDOR ======
+// El servidor las calcula durante el export; evitan re-parsear el XML en el cliente.
+function readLayoutHints(resp) {
+  const header = resp.headers.get('X-Layout-Hints');
+  if (!header) return null;
+  try {
+    return JSON.parse(header);
+  } catch (e) {
+    console.warn('[Layout] Pistas de layout inválidas:', e);
+    return null;
+  }
+}
+
+// Adapta las pistas al formato de analyzeMusicXML (measureCount = todos los <measure>)
+function layoutHintsToAnalysis(hints) {
+  return {
+    measureCount: hints.measure_elements || 0,
+    avgMeasureWidth: hints.avg_measure_width || 150,
+    totalComplexity: hints.total_complexity || 0
+  };
+}
+
+// ====== RENDER CON HASH DEL CÓDIGO (CACHÉ DEL SERVICE WORKER) ======
+// X-Code-Hash = SHA-256 del cuerpo de la petición: el service worker lo usa como clave
+// para responder al instante documentos recientes y revalidar en segundo plano.
+// 429 (control de admisión saturado): se reintenta tras Retry-After unas pocas veces,
+// avisando en #error-output; si sigue ocupado, error claro en vez de uno genérico.
+const RENDER_BUSY_MAX_RETRIES = 3;
+const RENDER_BUSY_MAX_WAIT_S = 15;   // esperas más largas no se hacen en silencio
+
+async function fetchRender(payload) {
+  const body = JSON.stringify(payload);
+  const headers = { 'Content-Type': 'application/json' };
+  if (window.crypto && crypto.subtle) {
+    const digest = await crypto.subtle.digest('SHA-256', new TextEncoder().encode(body));
+    headers['X-Code-Hash'] = Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+  }
+  const status = document.getElementById('error-output');
+  for (let attempt = 0; ; attempt++) {
+    const resp = await fetch('/render-xml', { method: 'POST', headers, body });
+    if (resp.status !== 429) {
+      if (attempt > 0 && status) status.textContent = '';
+      if (resp.headers.get('X-Render-Cache') === 'hit') {
+        console.log('[score-viewer] ⚡ Render servido desde la caché del service worker');
+      }
+      return resp;
+    }
+    const retryAfter = Math.max(1, parseInt(resp.headers.get('Retry-After'), 10) || 1);
+    if (attempt >= RENDER_BUSY_MAX_RETRIES || retryAfter > RENDER_BUSY_MAX_WAIT_S) {
+      throw new Error(`Servidor ocupado: vuelve a intentarlo en ${retryAfter} s`);
+    }
+    console.warn(`[score-viewer] ⏳ Servidor ocupado (429), reintento ${attempt + 1}/${RENDER_BUSY_MAX_RETRIES} en ${retryAfter}s`);
+    if (status) status.textContent = `⏳ Servidor ocupado, reintentando en ${retryAfter} s…`;
+    await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+  }
+}
+
+if ('serviceWorker' in navigator) {
+  navigator.serviceWorker.addEventListener('message', event => {
+    if (event.data && event.data.type === 'render-updated') {
+      console.log('[score-viewer] El servidor generó un render distinto al de la caché; se usará en la próxima carga');
+    }
+  });
+}
+
+// ====== ÍNDICE DE ELEMENTOS DEL SVG (CÓDIGO ↔ SVG) ======
+// Se construye una vez por render: id → nodo, compás → nodos, línea → ids.
+// La vinculación y el resaltado lo consultan en lugar de recorrer el SVG entero,
+// y editing.js lo actualiza al asignar IDs o líneas a elementos nuevos.
+const scoreIndex = {
+  byId: new Map(),          // id → nodo SVG
+  byMeasure: new Map(),     // nº de compás → [nodos]
+  byLine: new Map(),        // línea de código → Set(ids)
+  measureOf: new WeakMap(), // nodo → nº de compás (caché)
+  measureRects: [],         // [{ number, left, right, top, bottom }] de los g.vf-measure
+  texts: [],
+  noteHeads: [],
+  timings: {},              // ms por fase del último render (construcción, vinculación...)
+
+  clear() {
+    this.byId.clear();
+    this.byMeasure.clear();
+    this.byLine.clear();
+    this.measureOf = new WeakMap();
+    this.measureRects = [];
+    this.texts = [];
+    this.noteHeads = [];
+    this.timings = {};
+  },
+
+  build(svg) {
+    const t0 = performance.now();
+    this.clear();
+    if (!svg) return this;
+
+    // OSMD agrupa cada compás en <g class="vf-measure" id="número">
+    svg.querySelectorAll('g.vf-measure').forEach(group => {
+      const number = parseInt(group.id, 10);
+      const rect = group.getBoundingClientRect();
+      this.measureRects.push({
+        number: isNaN(number) ? 1 : number,
+        left: rect.left, right: rect.right, top: rect.top, bottom: rect.bottom
+      });
+    });
+
+    svg.querySelectorAll('[id]').forEach(el => {
+      if (!el.classList.contains('vf-measure')) this.byId.set(el.id, el);
+    });
+    this.texts = Array.from(svg.querySelectorAll('text'));
+    this.noteHeads = Array.from(svg.querySelectorAll('ellipse'));
+
+    for (const el of this.texts.concat(this.noteHeads)) {
+      const measure = this.measure(el);
+      if (!this.byMeasure.has(measure)) this.byMeasure.set(measure, []);
+      this.byMeasure.get(measure).push(el);
+      if (el.id && el.dataset.codeLine !== undefined) this._addLine(el.dataset.codeLine, el.id);
+    }
+
+    spatialIndex.reset(svg);
+    this.timings.build = performance.now() - t0;
+    console.log(`[Índice] ${this.byId.size} ids, ${this.byMeasure.size} compases, ${this.texts.length} textos, ${this.noteHeads.length} notas en ${this.timings.build.toFixed(1)}ms`);
+    return this;
+  },
+
+  // Compás de un elemento: grupo g.vf-measure que lo contiene o, si está fuera
+  // (letras, cifrados, textos), el compás más cercano por posición
+  measure(el) {
+    const cached = this.measureOf.get(el);
+    if (cached !== undefined) return cached;
+
+    let number = 1;
+    const group = el.closest ? el.closest('g.vf-measure') : null;
+    if (group) {
+      const parsed = parseInt(group.id, 10);
+      if (!isNaN(parsed)) number = parsed;
+    } else if (this.measureRects.length > 0) {
+      const rect = el.getBoundingClientRect();
+      const x = rect.left + rect.width / 2;
+      const y = rect.top + rect.height / 2;
+      let best = Infinity;
+      for (const m of this.measureRects) {
+        const dx = x < m.left ? m.left - x : (x > m.right ? x - m.right : 0);
+        const dy = y < m.top ? m.top - y : (y > m.bottom ? y - m.bottom : 0);
+        if (dx + dy < best) {
+          best = dx + dy;
+          number = m.number;
+        }
+      }
+    }
+    this.measureOf.set(el, number);
+    return number;
+  },
+
+  get(id) {
+    const el = this.byId.get(id);
+    if (el && el.isConnected) return el;
+    // Elementos fuera del SVG de OSMD (overlay) o creados después del render
+    const found = document.getElementById(id);
+    if (found) this.byId.set(id, found);
+    else this.byId.delete(id);
+    return found;
+  },
+
+  nodesInMeasure(number) {
+    return this.byMeasure.get(number) || [];
+  },
+
+  idsForLine(line) {
+    return Array.from(this.byLine.get(String(line)) || []);
+  },
+
+  setId(el, id) {
+    const line = el.dataset ? el.dataset.codeLine : undefined;
+    if (el.id) {
+      if (this.byId.get(el.id) === el) this.byId.delete(el.id);
+      if (line !== undefined) this._removeLine(line, el.id);
+    }
+    el.id = id;
+    this.byId.set(id, el);
+    if (line !== undefined) this._addLine(line, id);
+  },
+
+  setLine(el, line) {
+    if (el.dataset.codeLine !== undefined && el.id) this._removeLine(el.dataset.codeLine, el.id);
+    el.dataset.codeLine = line;
+    if (el.id) {
+      this.byId.set(el.id, el);
+      this._addLine(line, el.id);
+    }
+  },
+
+  _addLine(line, id) {
+    const key = String(line);
+    if (!this.byLine.has(key)) this.byLine.set(key, new Set());
+    this.byLine.get(key).add(id);
+  },
+
+  _removeLine(line, id) {
+    const ids = this.byLine.get(String(line));
+    if (!ids) return;
+    ids.delete(id);
+    if (ids.size === 0) this.byLine.delete(String(line));
+  }
+};
+window.scoreIndex = scoreIndex;
+
+// ====== ÍNDICE ESPACIAL DEL SVG (HIT-TESTING) ======
+// Rejilla uniforme con las cajas de textos y cabezas de nota, en coordenadas
+// relativas al SVG de OSMD (no cambian con el scroll). Responde en editing.js a
+// "vecino más cercano" (nota ↔ letra) y "qué hay en este rectángulo" (selección
+// múltiple) sin medir todo el SVG en cada interacción. Se invalida en cada render,
+// se construye en tiempo ocioso y applyTransform lo actualiza al mover elementos.
+// Las anotaciones (#annotation-svg) no entran: son pocas y se crean/borran a menudo.
+const spatialIndex = {
+  cellSize: 48,             // px; del orden de una cabeza de nota o una sílaba
+  maxCellsPerEntry: 64,     // cajas mayores (líneas, ligaduras largas) van aparte
+  svg: null,
+  origin: null,             // caja del SVG de OSMD en la última consulta
+  originWidth: 0,           // ancho al construir: si cambia (zoom, resize) se reconstruye
+  cells: new Map(),         // clave de celda → [entradas]
+  oversize: [],             // entradas que cubren demasiadas celdas
+  entries: new Map(),       // nodo → { el, kind, left, top, right, bottom, cx, cy }
+  bounds: null,             // celdas extremas ocupadas { minX, maxX, minY, maxY }
+  built: false,
+  _idleHandle: null,
+
+  clear() {
+    this.cells.clear();
+    this.entries.clear();
+    this.oversize = [];
+    this.bounds = null;
+    this.built = false;
+  },
+
+  // Tras cada render: descartar y reconstruir en cuanto el navegador esté ocioso
+  reset(svg) {
+    this.clear();
+    this.svg = svg || null;
+    const schedule = window.requestIdleCallback || (cb => setTimeout(cb, 50));
+    const cancel = window.cancelIdleCallback || clearTimeout;
+    if (this._idleHandle !== null) cancel(this._idleHandle);
+    this._idleHandle = svg ? schedule(() => {
+      this._idleHandle = null;
+      this.ensure();
+    }) : null;
+  },
+
+  build(svg, origin) {
+    const t0 = performance.now();
+    this.clear();
+    this.svg = svg;
+    this.originWidth = origin.width;
+    this.origin = origin;
+    // Mismos candidatos que usaban las búsquedas lineales de editing.js
+    svg.querySelectorAll('text').forEach(el => this._insert(el, 'text'));
+    svg.querySelectorAll('ellipse, path[d*="M"]').forEach(el => this._insert(el, 'note'));
+    this.built = true;
+    console.log(`[Índice espacial] ${this.entries.size} cajas (${this.oversize.length} grandes) en ${this.cells.size} celdas, ${(performance.now() - t0).toFixed(1)}ms`);
+  },
+
+  // Garantiza un índice válido para el SVG actual; devuelve false si no hay partitura
+  ensure() {
+    const svg = document.querySelector('#osmd-container svg');
+    if (!svg) return false;
+    const origin = svg.getBoundingClientRect();
+    if (!this.built || svg !== this.svg || Math.abs(origin.width - this.originWidth) > 0.5) {
+      this.build(svg, origin);
+    }
+    this.origin = origin;
+    return true;
+  },
+
+  _key(cx, cy) {
+    return (cx + 32768) * 65536 + (cy + 32768);
+  },
+
+  _insert(el, kind) {
+    const rect = el.getBoundingClientRect();
+    const left = rect.left - this.origin.left;
+    const top = rect.top - this.origin.top;
+    const entry = {
+      el, kind, left, top,
+      right: left + rect.width,
+      bottom: top + rect.height,
+      cx: left + rect.width / 2,
+      cy: top + rect.height / 2,
+      keys: null
+    };
+    this.entries.set(el, entry);
+
+    const size = this.cellSize;
+    const x0 = Math.floor(entry.left / size), x1 = Math.floor(entry.right / size);
+    const y0 = Math.floor(entry.top / size), y1 = Math.floor(entry.bottom / size);
+    if ((x1 - x0 + 1) * (y1 - y0 + 1) > this.maxCellsPerEntry) {
+      this.oversize.push(entry);
+      return entry;
+    }
+    entry.keys = [];
+    for (let x = x0; x <= x1; x++) {
+      for (let y = y0; y <= y1; y++) {
+        const key = this._key(x, y);
+        let bucket = this.cells.get(key);
+        if (!bucket) this.cells.set(key, bucket = []);
+        bucket.push(entry);
+        entry.keys.push(key);
+      }
+    }
+    const b = this.bounds;
+    if (!b) this.bounds = { minX: x0, maxX: x1, minY: y0, maxY: y1 };
+    else {
+      b.minX = Math.min(b.minX, x0); b.maxX = Math.max(b.maxX, x1);
+      b.minY = Math.min(b.minY, y0); b.maxY = Math.max(b.maxY, y1);
+    }
+    return entry;
+  },
+
+  _remove(entry) {
+    this.entries.delete(entry.el);
+    if (!entry.keys) {
+      this.oversize.splice(this.oversize.indexOf(entry), 1);
+      return;
+    }
+    for (const key of entry.keys) {
+      const bucket = this.cells.get(key);
+      if (!bucket) continue;
+      const i = bucket.indexOf(entry);
+      if (i !== -1) bucket.splice(i, 1);
+      if (bucket.length === 0) this.cells.delete(key);
+    }
+  },
+
+  // Un elemento indexado se movió o cambió de escala: re-medir solo ese
+  update(el) {
+    const entry = this.built ? this.entries.get(el) : null;
+    if (!entry) return;  // no indexado, o se construirá entero en la próxima consulta
+    this._remove(entry);
+    if (el.isConnected) {
+      this.origin = this.svg.getBoundingClientRect();
+      this._insert(el, entry.kind);
+    }
+  },
+
+  // Vecino más cercano a un punto (coordenadas de viewport) entre las entradas de un tipo.
+  // anchor: 'center' o 'top' (centro horizontal del borde superior); side: 'above'/'below'
+  // exige que el anclaje quede por encima/debajo del punto; accept filtra por elemento.
+  nearest(clientX, clientY, kind, { anchor = 'center', side = null, accept = null } = {}) {
+    if (!this.ensure()) return null;
+    const x = clientX - this.origin.left;
+    const y = clientY - this.origin.top;
+    let best = null;
+    let bestDist = Infinity;
+    const consider = entry => {
+      if (entry.kind !== kind || !entry.el.isConnected) return;
+      const ey = anchor === 'top' ? entry.top : entry.cy;
+      if ((side === 'above' && !(ey < y)) || (side === 'below' && !(ey > y))) return;
+      const d = Math.hypot(entry.cx - x, ey - y);
+      if (d < bestDist && (!accept || accept(entry.el))) {
+        bestDist = d;
+        best = entry;
+      }
+    };
+    this.oversize.forEach(consider);
+
+    const b = this.bounds;
+    if (b) {
+      const size = this.cellSize;
+      const qx = Math.floor(x / size);
+      const qy = Math.floor(y / size);
+      const maxRing = Math.max(qx - b.minX, b.maxX - qx, qy - b.minY, b.maxY - qy);
+      const visit = (cx, cy) => {
+        const bucket = this.cells.get(this._key(cx, cy));
+        if (bucket) bucket.forEach(consider);
+      };
+      // Anillos concéntricos: el punto de anclaje de una entrada cae en una celda del
+      // anillo r, a distancia >= (r - 1) · celda, así que se para al superar al mejor
+      for (let r = 0; r <= maxRing && (r - 1) * size < bestDist; r++) {
+        if (r === 0) { visit(qx, qy); continue; }
+        for (let i = -r; i <= r; i++) {
+          visit(qx + i, qy - r);
+          visit(qx + i, qy + r);
+        }
+        for (let j = -r + 1; j <= r - 1; j++) {
+          visit(qx - r, qy + j);
+          visit(qx + r, qy + j);
+        }
+      }
+    }
+    return best ? best.el : null;
+  },
+
+  // Elementos de un tipo cuya caja corta el rectángulo (coordenadas de viewport)
+  query(rect, kind) {
+    if (!this.ensure()) return [];
+    const left = rect.left - this.origin.left;
+    const right = rect.right - this.origin.left;
+    const top = rect.top - this.origin.top;
+    const bottom = rect.bottom - this.origin.top;
+    const found = new Set();
+    const consider = entry => {
+      if (entry.kind !== kind || found.has(entry.el) || !entry.el.isConnected) return;
+      if (!(entry.right < left || entry.left > right || entry.bottom < top || entry.top > bottom)) {
+        found.add(entry.el);
+      }
+    };
+    this.oversize.forEach(consider);
+
+    const b = this.bounds;
+    if (b) {
+      const size = this.cellSize;
+      const x0 = Math.max(b.minX, Math.floor(left / size)), x1 = Math.min(b.maxX, Math.floor(right / size));
+      const y0 = Math.max(b.minY, Math.floor(top / size)), y1 = Math.min(b.maxY, Math.floor(bottom / size));
+      for (let x = x0; x <= x1; x++) {
+        for (let y = y0; y <= y1; y++) {
+          const bucket = this.cells.get(this._key(x, y));
+          if (bucket) bucket.forEach(consider);
+        }
+      }
+    }
+    return Array.from(found);
+  }
+};
+window.spatialIndex = spatialIndex;
+
+// ====== PROTOCOLO DELTA: PARCHES SOBRE EL XML BASE ======
+// Envía solo operaciones (set-attribute, delete, insert) contra el hash del XML base.
+// Si el servidor no conoce la base (409), reenvía una vez con el XML completo.
+// Devuelve { xml, hash, report } sin modificar lastLoadedXML.
+async function patchScoreXML(ops) {
+  // Las rutas de los cambios y el fallback son del documento entero, no de la ventana
+  const baseXML = await ensureFullScoreXML();
+  const send = (withFullXML) => fetch('/apply-patch', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({
+      base_hash: lastLoadedHash,
+      ops,
+      xml_content: withFullXML ? baseXML : undefined
+    })
+  });
+
+  let resp = await send(false);
+  if (resp.status === 409) {
+    console.log('[Delta] Base desconocida en el servidor, reenviando XML completo');
+    resp = await send(true);
+  }
+  if (!resp.ok) throw new Error(`Error aplicando parche: ${resp.status}`);
+
+  const result = await resp.json();
+  if (result.full_transfer) lastLoadedHash = result.base_hash;
+
+  const xml = applyPatchChanges(baseXML, result.changes);
+  console.log(`[Delta] ${ops.length} operación(es) → ${result.changes.length} cambio(s), hash ${result.hash.slice(0, 8)}`);
+  return { xml, hash: result.hash, report: result.report };
+}
+
+// Replica en local los fragmentos devueltos por /apply-patch (rutas de índices de hijos)
+function applyPatchChanges(xmlString, changes) {
+  const xmlDoc = new DOMParser().parseFromString(xmlString, 'text/xml');
+  const walk = (path) => path.reduce((node, i) => node && node.children[i], xmlDoc.documentElement);
+
+  changes.forEach(change => {
+    const node = walk(change.path);
+    if (!node) return;
+
+    if (change.op === 'set-attribute') {
+      if (change.value === null) node.removeAttribute(change.attr);
+      else node.setAttribute(change.attr, change.value);
+    } else if (change.op === 'delete') {
+      node.remove();
+    } else if (change.op === 'insert') {
+      const fragment = new DOMParser().parseFromString(change.xml, 'text/xml').documentElement;
+      node.insertBefore(xmlDoc.importNode(fragment, true), node.children[change.index] || null);
+    }
+  });
+
+  return '<?xml version="1.0" encoding="UTF-8"?>\n' + new XMLSerializer().serializeToString(xmlDoc);
+}
+
+// Convierte ediciones { id: {...} } en operaciones set-attribute de default-x/default-y
+function editsToPatchOps(editsById, xKey, yKey) {
+  const ops = [];
+  Object.keys(editsById || {}).forEach(id => {
+    const edit = editsById[id];
+    if (edit[xKey] !== undefined) ops.push({ op: 'set-attribute', id, attr: 'default-x', value: String(edit[xKey]) });
+    if (edit[yKey] !== undefined) ops.push({ op: 'set-attribute', id, attr: 'default-y', value: String(edit[yKey]) });
+  });
+  return ops;
+}
+
 document.addEventListener('DOMContentLoaded', () => {
   const renderBtn   = document.getElementById('render-btn');
   const codeEditor  = document.getElementById('code-editor');
@@ -20,7 +553,7 @@ document.addEventListener('DOMContentLoaded', () => {
     errorOutput.textContent = '❌ OSMD no cargó. Revisa el <script> de OSMD.';
     return;
   }
-  let osmd = new OSMD(container, {
+  const osmdOptions = {
     autoResize: true,
     drawTitle: true,
     drawPartNames: false,
@@ -30,11 +563,116 @@ document.addEventListener('DOMContentLoaded', () => {
     drawCredits: false,          // desactivar para evitar duplicación
     drawPartAbbreviations: false,
     backend: 'svg'
-  });
+  };
+  let osmd = new OSMD(container, osmdOptions);
 
   // para evitar llamar clear() antes del primer render
   let hasRenderedOnce = false;
 
+  // ====== RENDER PAGINADO (PARTITURAS LARGAS) ======
+  // El servidor materializa la partitura completa una sola vez y devuelve la
+  // primera ventana de compases; las siguientes se piden al hacer scroll a
+  // /document/<hash>/measures y se dibujan en páginas OSMD de solo lectura.
+  const PAGE_MEASURES = 32;   // ventana inicial del render normal
+  const PAGE_SYSTEMS = 8;     // sistemas por página con los botones de layout
+  let pagination = null;      // { hash, code, count, next, total, pages, sentinel, observer, loading }
+
+  function readMeasureWindow(resp) {
+    const end = parseInt(resp.headers.get('X-Measure-End'), 10);
+    const total = parseInt(resp.headers.get('X-Measure-Total'), 10);
+    if (!end || !total) return null;
+    return { start: parseInt(resp.headers.get('X-Measure-Start'), 10) || 1, end, total };
+  }
+
+  function resetPagination() {
+    partialScoreHash = null;
+    if (!pagination) return;
+    pagination.observer.disconnect();
+    pagination.sentinel.remove();
+    pagination.pages.forEach(page => page.remove());
+    pagination = null;
+  }
+
+  function setupPagination(resp, code, count) {
+    resetPagination();
+    const win = readMeasureWindow(resp);
+    const hash = resp.headers.get('X-Content-Hash');
+    if (!win || !hash || win.end >= win.total) return;
+
+    console.log(`[Paginado] Compases ${win.start}-${win.end} de ${win.total}; el resto al hacer scroll`);
+    const sentinel = document.createElement('div');
+    sentinel.className = 'osmd-page-sentinel';
+    container.after(sentinel);
+
+    const state = { hash, code, count, next: win.end + 1, total: win.total, pages: [], sentinel, loading: false };
+    state.observer = new IntersectionObserver(entries => {
+      if (entries.some(entry => entry.isIntersecting)) loadNextPage(state);
+    }, { rootMargin: '600px 0px' });
+    state.observer.observe(sentinel);
+    pagination = state;
+
+    // lastLoadedXML es solo la primera ventana hasta que llegue la partitura completa;
+    // mientras tanto los parches la esperan (ensureFullScoreXML)
+    partialScoreHash = hash;
+    loadFullScoreXML(hash)
+      .catch(e => console.warn('[Paginado] No se pudo obtener la partitura completa (se reintentará al usarla):', e));
+  }
+
+  async function fetchMeasureWindow(state) {
+    let resp = await fetch(`/document/${state.hash}/measures?start=${state.next}&count=${state.count}`);
+    if (resp.status === 404) {
+      // El documento salió del almacén: volver a materializarlo con el código
+      resp = await fetchRender({ code: state.code, measure_start: state.next, measure_count: state.count });
+      state.hash = resp.headers.get('X-Content-Hash') || state.hash;
+    }
+    if (!resp.ok) throw new Error(`HTTP ${resp.status}`);
+    return { xml: await resp.text(), win: readMeasureWindow(resp) };
+  }
+
+  async function loadNextPage(state) {
+    if (state.loading || pagination !== state || state.next > state.total) return;
+    state.loading = true;
+    try {
+      const t0 = performance.now();
+      const { xml, win } = await fetchMeasureWindow(state);
+      if (pagination !== state) return; // hubo un render nuevo mientras tanto
+
+      const page = document.createElement('div');
+      page.className = 'osmd-page';
+      page.style.width = container.style.width;
+      state.sentinel.before(page);
+      state.pages.push(page);
+
+      const pageOsmd = new OSMD(page, { ...osmdOptions, drawTitle: false });
+      await pageOsmd.load(xml);
+      await pageOsmd.render();
+
+      state.next = (win ? win.end : state.next + state.count - 1) + 1;
+      console.log(`[Paginado] Página ${state.pages.length + 1} en ${(performance.now() - t0).toFixed(0)}ms`);
+    } catch (e) {
+      console.error('[Paginado] Error cargando compases:', e);
+      state.next = state.total + 1; // no reintentar en bucle
+    } finally {
+      state.loading = false;
+    }
+
+    if (state.next > state.total) {
+      state.observer.disconnect();
+      state.sentinel.remove();
+    } else if (state.sentinel.getBoundingClientRect().top < window.innerHeight + 600) {
+      loadNextPage(state); // el centinela sigue visible: el observer no vuelve a disparar
+    }
+  }
+
+  // Cargar de una vez las páginas pendientes (p. ej. para exportar la partitura completa a PNG)
+  window.loadAllScorePages = async function() {
+    const state = pagination;
+    while (state && pagination === state && state.next <= state.total) {
+      if (state.loading) await new Promise(r => setTimeout(r, 50));
+      else await loadNextPage(state);
+    }
+  };
+
   async function waitForNonZeroWidth(el, tries = 10) {
     for (let i = 0; i < tries; i++) {
       const w = el.clientWidth || el.getBoundingClientRect().width;
@@ -55,19 +693,23 @@ document.addEventListener('DOMContentLoaded', () => {
     if (typeof window.clearDeletions === 'function') {
       window.clearDeletions();
     }
-    localStorage.removeItem('scoreEdits');
+    if (typeof window.clearSession === 'function') {
+      window.clearSession();
+    }
     convertedTexts.clear();
+    resetPagination();
     
     try {
       console.log('[score-viewer] POST /render-xml …');
-      const resp = await fetch('/render-xml', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ code })
-      });
+      const resp = await fetchRender({ code, measure_start: 1, measure_count: PAGE_MEASURES });
 
       const xml = await resp.text();
       lastLoadedXML = xml; // Guardar el XML
+      lastLoadedHash = resp.headers.get('X-Content-Hash');
+      lastLayoutHints = readLayoutHints(resp);
+      if (typeof window.setSessionDocument === 'function') {
+        window.setSessionDocument(lastLoadedHash); // Persistencia por documento
+      }
       
       // ✅ LEER MAPEO DEL HEADER
       const mapeoHeader = resp.headers.get('X-Element-Line-Map');
@@ -109,6 +751,7 @@ document.addEventListener('DOMContentLoaded', () => {
       await osmd.load(xml);
       await osmd.render();
       hasRenderedOnce = true;
+      setupPagination(resp, code, PAGE_MEASURES);
 
       // ✅ FIX: Esperar a que DOM se estabilice completamente (más tiempo)
       await new Promise(resolve => requestAnimationFrame(resolve));
@@ -143,7 +786,7 @@ document.addEventListener('DOMContentLoaded', () => {
       }
 
       // NUEVO: Cargar ediciones guardadas si existen
-      if (typeof loadFromLocalStorage === 'function' && loadFromLocalStorage()) {
+      if (typeof loadSession === 'function' && await loadSession()) {
         // Re-aplicar transforms CSS
         Object.keys(window.edits || {}).forEach(id => {
           const el = document.getElementById(id);
@@ -151,7 +794,7 @@ document.addEventListener('DOMContentLoaded', () => {
             window.applyTransform(el);
           }
         });
-        console.log('[Persistencia] Ediciones restauradas desde LocalStorage');
+        console.log('[Persistencia] Ediciones restauradas desde IndexedDB');
       }
 
       console.log('[score-viewer] OSMD render OK, staff-only group created, duplicates removed');
@@ -333,12 +976,17 @@ document.addEventListener('DOMContentLoaded', () => {
       return {};
     }
     
+    // Índice del SVG: una sola pasada por render
+    scoreIndex.build(osmdSVG);
+    const t0 = performance.now();
+    
     // Mapeo: texto + compás + tipo → ID estable
     const stableIdMap = {};
     let elementCounter = 0;
     
     // 1. Parsear código Python para extraer elementos
     const lines = pythonCode.split('\n');
+    const compasPorLinea = detectarCompasesPorLinea(lines);
     const codeElements = []; // {tipo, texto, compas, idEstable}
     
     for (let i = 0; i < lines.length; i++) {
@@ -349,7 +997,7 @@ document.addEventListener('DOMContentLoaded', () => {
         const match = line.match(/harmony\.ChordSymbol\(["'](.+?)["']\)/);
         if (match) {
           const texto = match[1];
-          const compas = detectarCompasPorLinea(lines, i);
+          const compas = compasPorLinea[i];
           const idEstable = `element_${elementCounter++}`;
           codeElements.push({tipo: 'ChordSymbol', texto, compas, idEstable, linea: i});
           console.log(`[ID Mapping] ChordSymbol "${texto}" → ${idEstable} (línea ${i})`);
@@ -361,7 +1009,7 @@ document.addEventListener('DOMContentLoaded', () => {
         const match = line.match(/expressions\.TextExpression\(["'](.+?)["']\)/);
         if (match) {
           const texto = match[1];
-          const compas = detectarCompasPorLinea(lines, i);
+          const compas = compasPorLinea[i];
           const idEstable = `element_${elementCounter++}`;
           codeElements.push({tipo: 'TextExpression', texto, compas, idEstable, linea: i});
           console.log(`[ID Mapping] TextExpression "${texto}" → ${idEstable} (línea ${i})`);
@@ -374,7 +1022,7 @@ document.addEventListener('DOMContentLoaded', () => {
         
         if (match) {
           const texto = match[1];
-          const compas = detectarCompasPorLinea(lines, i);
+          const compas = compasPorLinea[i];
           const idEstable = `element_${elementCounter++}`;
           
           // ✅ NUEVO: Calcular posición Y aproximada (lyrics van en orden de arriba-abajo)
@@ -405,7 +1053,7 @@ document.addEventListener('DOMContentLoaded', () => {
               const idMatch = lines[j].match(/\.id\s*=\s*["'](.+?)["']/);
               if (idMatch) {
                 const noteId = idMatch[1];
-                const compas = detectarCompasPorLinea(lines, i);
+                const compas = compasPorLinea[i];
                 
                 codeElements.push({
                   tipo: 'Note',
@@ -427,7 +1075,7 @@ document.addEventListener('DOMContentLoaded', () => {
         const textMatch = line.match(/text\s*=\s*["'](.+?)["']/);
         if (textMatch) {
           const texto = textMatch[1];
-          const compas = detectarCompasPorLinea(lines, i);
+          const compas = compasPorLinea[i];
           const idEstable = `element_${elementCounter++}`;
           codeElements.push({tipo: 'MetronomeMark', texto, compas, idEstable, linea: i});
           console.log(`[ID Mapping] MetronomeMark "${texto}" → ${idEstable} (línea ${i})`);
@@ -447,50 +1095,49 @@ document.addEventListener('DOMContentLoaded', () => {
     }
     
     // 2. Buscar elementos en SVG y asignar IDs estables (TEXTOS)
-    const allTexts = osmdSVG.querySelectorAll('text');
     let matchedTexts = 0;
     const usedElements = new Set(); // Para marcar elementos ya usados
     
-    // ✅ MEJORADO: Agrupar elementos del código por tipo y texto
-    const elementsByTypeAndText = {};
+    // ✅ MEJORADO: Colas por texto (en orden del código): O(1) amortizado por match
+    const lyricsByText = new Map();
+    const elementsByText = new Map();
     codeElements.forEach(el => {
-      const key = `${el.tipo}_${el.texto}`;
-      if (!elementsByTypeAndText[key]) {
-        elementsByTypeAndText[key] = [];
+      if (el.texto === undefined) return;
+      if (el.tipo === 'Lyric') {
+        if (!lyricsByText.has(el.texto)) lyricsByText.set(el.texto, []);
+        lyricsByText.get(el.texto).push(el);
       }
-      elementsByTypeAndText[key].push(el);
+      if (!elementsByText.has(el.texto)) elementsByText.set(el.texto, []);
+      elementsByText.get(el.texto).push(el);
     });
     
-    // ✅ NUEVO: Ordenar elementos SVG por posición Y (de arriba abajo)
-    const sortedTexts = Array.from(allTexts).sort((a, b) => {
-      const aY = a.getBBox().y;
-      const bY = b.getBBox().y;
-      return aY - bY;
-    });
+    // Primer elemento no usado de la cola (descarta de la cabeza los ya usados)
+    const takeUnused = (queues, texto) => {
+      const queue = queues.get(texto);
+      while (queue && queue.length > 0) {
+        if (!usedElements.has(queue[0].idEstable)) return queue[0];
+        queue.shift();
+      }
+      return null;
+    };
+    
+    // ✅ NUEVO: Ordenar elementos SVG por posición Y (de arriba abajo), midiendo cada uno una sola vez
+    const sortedTexts = scoreIndex.texts
+      .map(textElement => ({ textElement, y: textElement.getBBox().y }))
+      .sort((a, b) => a.y - b.y)
+      .map(entry => entry.textElement);
     
     sortedTexts.forEach(textElement => {
       const textoSVG = textElement.textContent.trim();
-      const key = `Lyric_${textoSVG}`; // Asumir que son lyrics por ahora
       
-      // Buscar en grupo de elementos con mismo tipo y texto
-      let match = null;
-      if (elementsByTypeAndText[key] && elementsByTypeAndText[key].length > 0) {
-        // Tomar el PRIMER elemento no usado (en orden del código)
-        match = elementsByTypeAndText[key].find(el => !usedElements.has(el.idEstable));
-      }
-      
-      // Si no es lyric, buscar en otros tipos
-      if (!match) {
-        match = codeElements.find(el => 
-          el.texto === textoSVG && !usedElements.has(el.idEstable)
-        );
-      }
+      // Asumir que son lyrics por ahora; si no, cualquier tipo con el mismo texto
+      const match = takeUnused(lyricsByText, textoSVG) || takeUnused(elementsByText, textoSVG);
       
       if (match) {
         // ✅ ASIGNAR ID ESTABLE
-        textElement.id = match.idEstable;
+        scoreIndex.setId(textElement, match.idEstable);
         textElement.setAttribute('data-code-line', match.linea);
-        textElement.dataset.codeLine = match.linea; // Doble para compatibilidad
+        scoreIndex.setLine(textElement, match.linea); // Doble para compatibilidad
         
         stableIdMap[match.idEstable] = {
           svgId: match.idEstable,
@@ -507,20 +1154,17 @@ document.addEventListener('DOMContentLoaded', () => {
       } else {
         // No match: asignar ID temporal
         const tempId = `temp_${textoSVG.replace(/\s+/g, '-')}_${Date.now()}`;
-        textElement.id = tempId;
+        scoreIndex.setId(textElement, tempId);
         console.log(`[ID Mapping] ⚠️ Sin match: "${textoSVG}" → ${tempId} (manual)`);
       }
     });
     
     console.log(`[ID Mapping] ✅ ${matchedTexts} textos vinculados`);
     
-    // 3. ✅ NUEVO: Buscar NOTAS (ellipses) y asignar IDs por compás
-    const allNotes = Array.from(osmdSVG.querySelectorAll('ellipse'));
-    const notesByMeasure = {}; // Agrupar notas por compás
-    
-    // Agrupar notas SVG por compás
-    allNotes.forEach(noteEl => {
-      const measureNum = calcularCompasDesdeElemento(noteEl);
+    // 3. ✅ NUEVO: Buscar NOTAS (ellipses) y asignar IDs por compás (agrupadas en el índice)
+    const notesByMeasure = {};
+    scoreIndex.noteHeads.forEach(noteEl => {
+      const measureNum = scoreIndex.measure(noteEl);
       if (!notesByMeasure[measureNum]) {
         notesByMeasure[measureNum] = [];
       }
@@ -540,12 +1184,12 @@ document.addEventListener('DOMContentLoaded', () => {
     let matchedNotes = 0;
     Object.keys(noteIdsByMeasure).forEach(measureNum => {
       const codeNotesInMeasure = noteIdsByMeasure[measureNum];
-      const svgNotesInMeasure = notesByMeasure[measureNum] || [];
       
-      // Ordenar notas SVG por X (izquierda→derecha)
-      svgNotesInMeasure.sort((a, b) => {
-        return a.getBoundingClientRect().left - b.getBoundingClientRect().left;
-      });
+      // Ordenar notas SVG por X (izquierda→derecha), midiendo cada una una sola vez
+      const svgNotesInMeasure = (notesByMeasure[measureNum] || [])
+        .map(noteEl => ({ noteEl, left: noteEl.getBoundingClientRect().left }))
+        .sort((a, b) => a.left - b.left)
+        .map(entry => entry.noteEl);
       
       // Matchear: nota N del SVG → nota N del código en este compás
       const minLength = Math.min(codeNotesInMeasure.length, svgNotesInMeasure.length);
@@ -554,8 +1198,8 @@ document.addEventListener('DOMContentLoaded', () => {
         const codeNote = codeNotesInMeasure[i];
         
         // Asignar ID del código a la nota SVG
-        svgNote.id = codeNote.noteId;
-        svgNote.dataset.codeLine = codeNote.linea;
+        scoreIndex.setId(svgNote, codeNote.noteId);
+        scoreIndex.setLine(svgNote, codeNote.linea);
         
         matchedNotes++;
         
@@ -567,29 +1211,39 @@ document.addEventListener('DOMContentLoaded', () => {
     
     console.log(`[ID Mapping] ✅ ${matchedNotes} notas vinculadas`);
     
+    scoreIndex.timings.assignIds = performance.now() - t0;
+    console.log(`[ID Mapping] ⏱️ Asignación en ${scoreIndex.timings.assignIds.toFixed(1)}ms (índice: ${scoreIndex.timings.build.toFixed(1)}ms)`);
+    
     // Guardar mapeo global
     window.stableMapping = stableIdMap;
     
     return stableIdMap;
   }
   
-  // Helper: Detectar compás por línea de código
-  function detectarCompasPorLinea(lines, lineIndex) {
-    // Buscar hacia atrás la declaración de compás más cercana
-    for (let i = lineIndex; i >= Math.max(0, lineIndex - 20); i--) {
+  // Helper: Detectar el compás de cada línea de código en una sola pasada
+  // (declaración stream.Measure más cercana hacia atrás, como máximo 20 líneas)
+  function detectarCompasesPorLinea(lines) {
+    const compases = new Array(lines.length).fill(1); // Default: compás 1
+    let ultimoCompas = null;
+    let ultimaLinea = -Infinity;
+    
+    for (let i = 0; i < lines.length; i++) {
       const line = lines[i];
       if (line.includes('stream.Measure(')) {
         // ✅ MEJORADO: Detectar ambos formatos
         // Formato 1: stream.Measure(number=1)
-        let match = line.match(/Measure\(number=(\d+)\)/);
-        if (match) return parseInt(match[1]);
-        
         // Formato 2: stream.Measure(1) (antiguo)
-        match = line.match(/Measure\((\d+)\)/);
-        if (match) return parseInt(match[1]);
+        const match = line.match(/Measure\(number=(\d+)\)/) || line.match(/Measure\((\d+)\)/);
+        if (match) {
+          ultimoCompas = parseInt(match[1]);
+          ultimaLinea = i;
+        }
+      }
+      if (ultimoCompas !== null && i - ultimaLinea <= 20) {
+        compases[i] = ultimoCompas;
       }
     }
-    return 1; // Default: compás 1
+    return compases;
   }
   
   // ====== MAPEAR NOTAS GLOBALMENTE (SIN DEPENDER DE COMPASES) ======
@@ -599,24 +1253,25 @@ document.addEventListener('DOMContentLoaded', () => {
       console.warn('[Note Map] No se encontró SVG de OSMD');
       return;
     }
+    const t0 = performance.now();
     
     // 1. Obtener TODAS las notas del SVG ordenadas por X (izquierda→derecha)
-    const allNotes = Array.from(osmdSVG.querySelectorAll('ellipse, path[d*="M"]'))
-      .filter(el => {
-        // Filtrar solo elementos que parecen notas (ellipses o paths pequeños)
-        try {
+    // Cada candidato se mide una sola vez (no dentro del comparador)
+    const candidates = scoreIndex.noteHeads.concat(Array.from(osmdSVG.querySelectorAll('path[d*="M"]')));
+    const allNotes = [];
+    candidates.forEach(el => {
+      // Filtrar solo elementos que parecen notas (ellipses o paths pequeños)
+      try {
+        if (el.tagName === 'path') {
           const bbox = el.getBBox();
-          // Ellipses son notas, paths con cierto tamaño también
-          return el.tagName === 'ellipse' || (el.tagName === 'path' && bbox.width < 20 && bbox.height < 20);
-        } catch (e) {
-          return false;
+          if (bbox.width >= 20 || bbox.height >= 20) return;
         }
-      })
-      .sort((a, b) => {
-        const aX = a.getBoundingClientRect().left;
-        const bX = b.getBoundingClientRect().left;
-        return aX - bX;
-      });
+        allNotes.push({ el, left: el.getBoundingClientRect().left });
+      } catch (e) {
+        // Ignorar elementos sin bbox
+      }
+    });
+    allNotes.sort((a, b) => a.left - b.left);
     
     // 2. Obtener TODAS las note.Note() del código en orden
     const code = window.getCodeEditorValue();
@@ -633,10 +1288,10 @@ document.addEventListener('DOMContentLoaded', () => {
     
     // 3. Matchear: Nota N del SVG → note.Note() N del código
     let matched = 0;
-    allNotes.forEach((noteHead, index) => {
+    allNotes.forEach(({ el: noteHead }, index) => {
       if (noteLinesInOrder[index] !== undefined) {
-        noteHead.dataset.codeLine = noteLinesInOrder[index];
-        noteHead.id = `note_${index}`;
+        scoreIndex.setId(noteHead, `note_${index}`);
+        scoreIndex.setLine(noteHead, noteLinesInOrder[index]);
         matched++;
         
         if (index < 5) { // Log primeras 5 para debug
@@ -645,84 +1300,13 @@ document.addEventListener('DOMContentLoaded', () => {
       }
     });
     
-    console.log(`[Note Map] ✅ ${matched} nota(s) mapeada(s) globalmente`);
+    scoreIndex.timings.mapNotes = performance.now() - t0;
+    console.log(`[Note Map] ✅ ${matched} nota(s) mapeada(s) globalmente en ${scoreIndex.timings.mapNotes.toFixed(1)}ms`);
   }
 
-  // Helper: Calcular compás desde estructura DOM de OSMD
+  // Helper: Calcular compás de un elemento (consulta el índice del render)
   function calcularCompasDesdeElemento(element) {
-    // ✅ MÉTODO ROBUSTO: Usar jerarquía DOM de OSMD
-    // OSMD organiza elementos en grupos <g> que representan compases
-    
-    let parent = element.parentElement;
-    let measureCount = 0;
-    
-    // 1. Subir en la jerarquía DOM buscando el grupo del compás
-    while (parent && parent.tagName === 'g') {
-      // Buscar hermanos previos que parezcan compases (tienen líneas de compás)
-      const siblings = Array.from(parent.parentElement?.children || []);
-      const currentIndex = siblings.indexOf(parent);
-      
-      // Contar cuántos grupos "compás" hay antes de este
-      for (let i = 0; i < currentIndex; i++) {
-        const sibling = siblings[i];
-        if (sibling.tagName === 'g') {
-          // Un grupo es un compás si contiene líneas verticales (barlines)
-          const hasBarline = sibling.querySelector('path[d*="M"], line');
-          if (hasBarline) {
-            measureCount++;
-          }
-        }
-      }
-      
-      // Si encontramos evidencia de compás en este nivel, retornar
-      const hasBarline = parent.querySelector('path[d*="M"], line');
-      if (hasBarline && measureCount > 0) {
-        return measureCount + 1; // +1 porque el compás actual cuenta
-      }
-      
-      parent = parent.parentElement;
-    }
-    
-    // 2. FALLBACK: Si no encontramos por estructura, usar posición X mejorada
-    const osmdSVG = container.querySelector('svg');
-    if (!osmdSVG) return 1;
-    
-    try {
-      const elementX = element.getBBox().x;
-      
-      // Contar todos los grupos que parecen compases en el SVG
-      const allGroups = osmdSVG.querySelectorAll('g');
-      const measureGroups = Array.from(allGroups).filter(g => 
-        g.querySelector('path[d*="M"], line')
-      );
-      
-      if (measureGroups.length === 0) return 1;
-      
-      // Encontrar el compás más cercano por posición X
-      let closestMeasure = 1;
-      let minDistance = Infinity;
-      
-      measureGroups.forEach((group, index) => {
-        try {
-          const groupX = group.getBBox().x;
-          const distance = Math.abs(elementX - groupX);
-          
-          if (distance < minDistance) {
-            minDistance = distance;
-            closestMeasure = index + 1;
-          }
-        } catch (e) {
-          // Ignorar grupos sin bbox válido
-        }
-      });
-      
-      console.log(`[Compás Calc] Elemento en X=${elementX.toFixed(0)} → Compás ${closestMeasure} (${measureGroups.length} compases totales)`);
-      return closestMeasure;
-      
-    } catch (e) {
-      console.warn(`[Compás Calc] Error calculando compás:`, e);
-      return 1; // Fallback final
-    }
+    return scoreIndex.measure(element);
   }
 
   // ====== VINCULAR TEXTOS OVERLAY CON PENTAGRAMA Y SVG PRINCIPAL ======
@@ -950,6 +1534,150 @@ document.addEventListener('DOMContentLoaded', () => {
     }
   });
 
+  // ====== SOUNDFONTS LOCALES (DECODIFICACIÓN PEREZOSA) ======
+  // Las muestras se sirven desde Flask (/soundfont/<instrumento>/<midi>) y solo se
+  // decodifican las del rango de alturas de la partitura. El PCM decodificado se
+  // guarda en IndexedDB, así que en sesiones siguientes no hay red ni decodeAudioData.
+  const SAMPLE_DB_NAME = 'score-viewer-samples';
+  const SAMPLE_STORE = 'buffers';
+  const decodedSamples = new Map(); // `${instrumento}/${versión}/${midi}` → AudioBuffer
+  let sampleDbPromise = null;
+
+  function openSampleDb() {
+    if (!sampleDbPromise) {
+      sampleDbPromise = new Promise(resolve => {
+        if (!window.indexedDB) return resolve(null);
+        const req = indexedDB.open(SAMPLE_DB_NAME, 1);
+        req.onupgradeneeded = () => req.result.createObjectStore(SAMPLE_STORE);
+        req.onsuccess = () => resolve(req.result);
+        req.onerror = () => resolve(null); // sin caché persistente
+      });
+    }
+    return sampleDbPromise;
+  }
+
+  async function readStoredSample(key) {
+    const db = await openSampleDb();
+    if (!db) return null;
+    return new Promise(resolve => {
+      const req = db.transaction(SAMPLE_STORE, 'readonly').objectStore(SAMPLE_STORE).get(key);
+      req.onsuccess = () => resolve(req.result || null);
+      req.onerror = () => resolve(null);
+    });
+  }
+
+  async function storeSample(key, buffer) {
+    const db = await openSampleDb();
+    if (!db) return;
+    const channels = [];
+    for (let c = 0; c < buffer.numberOfChannels; c++) {
+      channels.push(buffer.getChannelData(c).slice());
+    }
+    const tx = db.transaction(SAMPLE_STORE, 'readwrite');
+    tx.objectStore(SAMPLE_STORE).put({ sampleRate: buffer.sampleRate, channels }, key);
+    tx.onerror = () => console.warn('[Soundfont] No se pudo guardar la muestra:', key, tx.error);
+  }
+
+  // Borra de IndexedDB las muestras de versiones anteriores del instrumento
+  async function pruneStoredSamples(name, version) {
+    const db = await openSampleDb();
+    if (!db) return;
+    const prefix = `${name}/`;
+    const current = `${name}/${version}/`;
+    const store = db.transaction(SAMPLE_STORE, 'readwrite').objectStore(SAMPLE_STORE);
+    const req = store.openKeyCursor(IDBKeyRange.bound(prefix, prefix + '\uffff'));
+    req.onsuccess = () => {
+      const cursor = req.result;
+      if (!cursor) return;
+      if (!cursor.key.startsWith(current)) store.delete(cursor.key);
+      cursor.continue();
+    };
+  }
+
+  async function loadSample(ctx, name, version, midi) {
+    const key = `${name}/${version}/${midi}`;
+    if (decodedSamples.has(key)) return decodedSamples.get(key);
+
+    let buffer = null;
+    const stored = await readStoredSample(key);
+    if (stored) {
+      buffer = ctx.createBuffer(stored.channels.length, stored.channels[0].length, stored.sampleRate);
+      stored.channels.forEach((data, c) => buffer.copyToChannel(data, c));
+    } else {
+      const resp = await fetch(`/soundfont/${name}/${midi}?v=${version}`);
+      if (!resp.ok) throw new Error(`Muestra no disponible: ${name}/${midi}`);
+      buffer = await ctx.decodeAudioData(await resp.arrayBuffer());
+      storeSample(key, buffer);
+    }
+    decodedSamples.set(key, buffer);
+    return buffer;
+  }
+
+  // Instrumento con la misma interfaz que soundfont-player (play → nodo con stop)
+  function createLocalInstrument(ctx, name, manifest) {
+    const available = manifest.notes;
+    const version = manifest.version;
+    const samples = new Map(); // midi de la muestra → AudioBuffer
+    const output = ctx.createGain();
+    output.gain.value = 2.0;
+    output.connect(ctx.destination);
+
+    // Muestra más cercana (se transpone con playbackRate si no existe la exacta)
+    function nearestSample(midi) {
+      let best = available[0];
+      for (const candidate of available) {
+        if (Math.abs(candidate - midi) < Math.abs(best - midi)) best = candidate;
+      }
+      return best;
+    }
+
+    return {
+      name,
+      local: true,
+
+      // Decodifica solo las muestras necesarias para estas alturas
+      async prepare(pitches) {
+        const needed = new Set();
+        for (const midi of pitches) needed.add(nearestSample(midi));
+        const missing = [...needed].filter(midi => !samples.has(midi));
+        const buffers = await Promise.all(missing.map(midi => loadSample(ctx, name, version, midi)));
+        missing.forEach((midi, i) => samples.set(midi, buffers[i]));
+        console.log(`[Soundfont] ${needed.size} muestras listas (${missing.length} cargadas)`);
+      },
+
+      play(midi, when, { gain = 1, duration = 0.5 } = {}) {
+        const sampleMidi = nearestSample(midi);
+        const buffer = samples.get(sampleMidi);
+        if (!buffer) return null;
+
+        const source = ctx.createBufferSource();
+        source.buffer = buffer;
+        source.playbackRate.value = Math.pow(2, (midi - sampleMidi) / 12);
+        const envelope = ctx.createGain();
+        envelope.gain.setValueAtTime(gain, when);
+        envelope.gain.setTargetAtTime(0, when + duration, 0.1); // release corto
+        source.connect(envelope).connect(output);
+        source.start(when);
+        source.stop(when + duration + 1);
+        return { stop: () => source.stop() };
+      }
+    };
+  }
+
+  async function loadLocalInstrument(ctx, name) {
+    try {
+      const resp = await fetch(`/soundfont/${name}`);
+      if (!resp.ok) return null;
+      const manifest = await resp.json();
+      if (!manifest.notes || manifest.notes.length === 0) return null;
+      pruneStoredSamples(name, manifest.version);
+      return createLocalInstrument(ctx, name, manifest);
+    } catch (err) {
+      console.warn('[Soundfont] Soundfont local no disponible:', err.message);
+      return null;
+    }
+  }
+
   // Función para cargar instrumento
   async function loadInstrument() {
     if (!audioContext) {
@@ -964,12 +1692,17 @@ document.addEventListener('DOMContentLoaded', () => {
     playBtn.textContent = '⏳';
     
     try {
-      currentInstrument = await Soundfont.instrument(audioContext, currentInstrumentName, {
-        soundfont: 'MusyngKite',
-        gain: 2.0
-      });
+      // Primero el soundfont local; si no está instalado, el CDN de soundfont-player
+      currentInstrument = await loadLocalInstrument(audioContext, currentInstrumentName);
+      if (!currentInstrument) {
+        console.log('[Soundfont] Instrumento local no instalado, usando CDN');
+        currentInstrument = await Soundfont.instrument(audioContext, currentInstrumentName, {
+          soundfont: 'MusyngKite',
+          gain: 2.0
+        });
+      }
       
-      console.log(`[Soundfont] ✅ Instrumento cargado: ${currentInstrumentName}`);
+      console.log(`[Soundfont] ✅ Instrumento cargado: ${currentInstrumentName}${currentInstrument.local ? ' (local)' : ''}`);
       return currentInstrument;
     } catch (err) {
       console.error('[Soundfont] Error cargando instrumento:', err);
@@ -1015,86 +1748,56 @@ document.addEventListener('DOMContentLoaded', () => {
     try {
       playBtn.textContent = '⏳';
       playBtn.disabled = true;
-      console.log('[Soundfont] Exportando MIDI...');
+      console.log('[Soundfont] Solicitando eventos de nota...');
       
       console.log(`[Soundfont] Acompañamiento de acordes: ${chordsEnabled ? 'ACTIVADO' : 'DESACTIVADO'}`);
       
-      // Obtener MIDI del backend con parámetros de acompañamiento
-      const resp = await fetch('/export-midi', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ 
+      // Eventos de nota en binario (sin MIDI intermedio); el instrumento
+      // se carga en paralelo mientras el backend procesa la partitura
+      const [events, instrument] = await Promise.all([
+        fetchPlaybackEvents({
           code,
           include_chords: chordsEnabled,
           chord_rhythm: 'auto',    // Duración inteligente hasta siguiente acorde
           chord_octave: 3,         // Octava 3 (configurable)
           chord_velocity: 0.5      // Volumen medio (configurable)
-        })
-      });
+        }),
+        loadInstrument()
+      ]);
 
-      if (!resp.ok) {
-        const error = await resp.text();
-        throw new Error(error || 'Error exportando MIDI');
-      }
+      console.log('[Soundfont]', events.count, 'notas en', events.tracks, 'pistas');
 
-      const midiBlob = await resp.blob();
-
-      console.log('[Soundfont] MIDI obtenido, parseando...');
-
-      // Parsear MIDI con @tonejs/midi
-      const midi = await Midi.fromUrl(URL.createObjectURL(midiBlob));
-      
-      console.log('[Soundfont] MIDI parseado:', midi.tracks.length, 'pistas');
-
-      // Cargar instrumento
-      const instrument = await loadInstrument();
-
-      // Extraer notas de todas las pistas
-      const notes = [];
-      
-      midi.tracks.forEach(track => {
-        track.notes.forEach(note => {
-          if (note.duration > 0.01) { // Filtrar notas muy cortas
-            notes.push({
-              time: note.time,
-              midi: note.midi,
-              velocity: note.velocity,
-              duration: note.duration
-            });
-          }
-        });
-      });
-
-      console.log('[Soundfont]', notes.length, 'notas encontradas');
-      console.log('[Soundfont] Tempo:', midi.header.tempos[0]?.bpm || 120, 'BPM');
-
-      // Ordenar por tiempo
-      notes.sort((a, b) => a.time - b.time);
+      // Soundfont local: decodificar solo el rango de alturas de la partitura
+      if (instrument.prepare) {
+        await instrument.prepare(events.pitch);
+      }
 
-      // Calcular duración total
-      const maxTime = notes.length > 0 ? notes[notes.length - 1].time + 2 : 0;
+      // Duración total (los eventos ya vienen ordenados por onset)
+      const maxTime = events.count > 0 ? events.onset[events.count - 1] + 2 : 0;
       
       // Crear visualización
       createPlaybackVisualization(maxTime);
 
-      // Programar notas
+      // Programar notas directamente desde los arrays tipados
       const startTime = audioContext.currentTime;
       scheduledNotes = [];
       
-      notes.forEach(note => {
-        const scheduleTime = startTime + note.time;
-        const noteObj = instrument.play(note.midi, scheduleTime, {
-          gain: note.velocity,
-          duration: note.duration || 0.5
+      for (let i = 0; i < events.count; i++) {
+        const noteDuration = events.duration[i];
+        if (noteDuration <= 0.01) continue; // Filtrar notas muy cortas
+
+        const noteObj = instrument.play(events.pitch[i], startTime + events.onset[i], {
+          gain: events.velocity[i] / 127,
+          duration: noteDuration
         });
         scheduledNotes.push(noteObj);
         
         // Log primera nota para debug de octavas
         if (scheduledNotes.length === 1) {
-          const noteName = midiNoteToName(note.midi);
-          console.log(`[Soundfont] Primera nota: MIDI ${note.midi} = ${noteName}, velocity: ${note.velocity.toFixed(2)}`);
+          const noteName = midiNoteToName(events.pitch[i]);
+          console.log(`[Soundfont] Primera nota: MIDI ${events.pitch[i]} = ${noteName}, velocity: ${events.velocity[i]}`);
         }
-      });
+      }
 
       // Programar fin de reproducción
       setTimeout(() => {
@@ -1118,6 +1821,45 @@ document.addEventListener('DOMContentLoaded', () => {
     }
   }
 
+  // Pide /playback-events y crea vistas tipadas sobre el buffer (sin copiar).
+  // Formato: cabecera 'SVEV' (u32 nº eventos, u32 nº pistas, f32 duración total),
+  // después onset[f32], duration[f32], pitch[u8], velocity[u8], track[u8].
+  async function fetchPlaybackEvents(payload) {
+    const resp = await fetch('/playback-events', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(payload)
+    });
+
+    if (!resp.ok) {
+      const error = await resp.text();
+      throw new Error(error || 'Error obteniendo eventos de reproducción');
+    }
+
+    const buffer = await resp.arrayBuffer();
+    const header = new DataView(buffer, 0, 16);
+    const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+    if (magic !== 'SVEV') {
+      throw new Error('Formato de eventos desconocido');
+    }
+
+    const count = header.getUint32(4, true);
+    const floatBytes = count * 4;
+    let offset = 16;
+    const events = {
+      count,
+      tracks: header.getUint32(8, true),
+      totalSeconds: header.getFloat32(12, true),
+      onset: new Float32Array(buffer, offset, count),
+      duration: new Float32Array(buffer, offset += floatBytes, count)
+    };
+    offset += floatBytes;
+    events.pitch = new Uint8Array(buffer, offset, count);
+    events.velocity = new Uint8Array(buffer, offset += count, count);
+    events.track = new Uint8Array(buffer, offset += count, count);
+    return events;
+  }
+
   // Función helper para convertir MIDI a nombre de nota
   function midiNoteToName(midi) {
     const noteNames = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B'];
@@ -1227,24 +1969,23 @@ document.addEventListener('DOMContentLoaded', () => {
   function linkElementsFromBackend(idToLineMap) {
     const osmdSVG = container.querySelector('svg');
     if (!osmdSVG) return;
+    const t0 = performance.now();
     
     let linked = 0;
     
-    // Recorrer TODOS los elementos con ID
-    const allElements = osmdSVG.querySelectorAll('[id]');
-    
-    allElements.forEach(el => {
-      const elementId = el.id;
+    // Buscar cada ID del mapeo en el índice (no recorrer todo el SVG)
+    Object.keys(idToLineMap).forEach(elementId => {
+      const el = scoreIndex.get(elementId);
+      if (!el || !osmdSVG.contains(el)) return;
       
-      if (idToLineMap[elementId] !== undefined) {
-        const lineNumber = idToLineMap[elementId];
-        el.dataset.codeLine = lineNumber;
-        linked++;
-        console.log(`[Link] "${elementId}" → línea ${lineNumber}`);
-      }
+      const lineNumber = idToLineMap[elementId];
+      scoreIndex.setLine(el, lineNumber);
+      linked++;
+      console.log(`[Link] "${elementId}" → línea ${lineNumber}`);
     });
     
-    console.log(`[Link] ✅ ${linked}/${Object.keys(idToLineMap).length} elementos vinculados`);
+    scoreIndex.timings.link = performance.now() - t0;
+    console.log(`[Link] ✅ ${linked}/${Object.keys(idToLineMap).length} elementos vinculados en ${scoreIndex.timings.link.toFixed(1)}ms`);
   }
 
   // ====== ACTUALIZAR CÓDIGO PYTHON AUTOMÁTICAMENTE (SISTEMA SIMPLE) ======
@@ -1854,22 +2595,16 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     try {
-      // 1. Aplicar ediciones al XML (en tenths)
-      const response = await fetch('/apply-edits-xml', {
-        method: 'POST',
-        headers: {'Content-Type': 'application/json'},
-        body: JSON.stringify({
-          xml_content: lastLoadedXML,
-          edits: window.edits  // Usa xTenths/yTenths
-        })
-      });
+      // 1. Aplicar ediciones al XML (en tenths) enviando solo el parche
+      const { xml: modifiedXML, report } = await patchScoreXML(
+        editsToPatchOps(window.edits, 'xTenths', 'yTenths')
+      );
 
-      if (!response.ok) {
-        throw new Error(`Error aplicando ediciones: ${response.status}`);
+      const missingEdits = report.filter(r => r.status !== 'applied');
+      if (missingEdits.length > 0) {
+        console.warn(`[Responsividad] ⚠️ ${missingEdits.length} operación(es) sin elemento en el XML:`, missingEdits);
       }
 
-      const modifiedXML = await response.text();
-
       // 2. Limpiar contenedor
       container.innerHTML = '';
       if (hasRenderedOnce && typeof osmd.clear === 'function') {
@@ -1994,8 +2729,12 @@ document.addEventListener('DOMContentLoaded', () => {
       btn.classList.add('active');
       
       // NUEVO: Analizar MusicXML para calcular ancho inteligente
+      // (con las pistas del servidor si existen; si no, re-parseando el XML)
       let containerWidth;
-      if (lastLoadedXML) {
+      if (lastLayoutHints) {
+        const xmlAnalysis = layoutHintsToAnalysis(lastLayoutHints);
+        containerWidth = calculateSmartWidth(measuresPerSystem, xmlAnalysis);
+      } else if (lastLoadedXML) {
         const xmlAnalysis = analyzeMusicXML(lastLoadedXML);
         containerWidth = calculateSmartWidth(measuresPerSystem, xmlAnalysis);
       } else {
@@ -2013,16 +2752,25 @@ document.addEventListener('DOMContentLoaded', () => {
       
       try {
         // 1. Generar nuevo XML desde código actualizado
-        const resp = await fetch('/render-xml', {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({ code: updatedCode })
+        resetPagination();
+        const resp = await fetchRender({
+          code: updatedCode,
+          measure_start: 1,
+          systems_per_page: PAGE_SYSTEMS,
+          measures_per_system: measuresPerSystem
         });
         
         if (!resp.ok) throw new Error('Error regenerando XML');
         
         const newXML = await resp.text();
         lastLoadedXML = newXML; // Actualizar XML global
+        lastLoadedHash = resp.headers.get('X-Content-Hash');
+        lastLayoutHints = readLayoutHints(resp);
+        if (typeof window.setSessionDocument === 'function') {
+          // Las ediciones en memoria pasan a persistirse bajo el nuevo documento
+          window.setSessionDocument(lastLoadedHash);
+          window.saveSession();
+        }
         
         // ✅ FIX: Leer mapeo del backend (igual que en carga inicial)
         const mapeoHeader = resp.headers.get('X-Element-Line-Map');
@@ -2048,6 +2796,7 @@ document.addEventListener('DOMContentLoaded', () => {
         
         await osmd.load(newXML);
         await osmd.render();
+        setupPagination(resp, updatedCode, PAGE_SYSTEMS * measuresPerSystem);
         
         // ✅ FIX: Esperar a que DOM se estabilice (igual que en carga inicial)
         await new Promise(resolve => requestAnimationFrame(resolve));
@@ -2228,6 +2977,8 @@ document.addEventListener('DOMContentLoaded', () => {
       
       // ✅ CORREGIDO: Limpiar lastLoadedXML para forzar regeneración
       lastLoadedXML = '';
+      lastLoadedHash = null;
+      lastLayoutHints = null;
       
       // ✅ CORREGIDO: Limpiar memoria de textos convertidos
       if (typeof window.convertedTexts !== 'undefined') {
@@ -2243,6 +2994,7 @@ document.addEventListener('DOMContentLoaded', () => {
       
       // Limpiar partitura renderizada
       container.innerHTML = '';
+      resetPagination();
       errorOutput.textContent = '';
       
       // Limpiar OSMD instance
@@ -2258,8 +3010,8 @@ document.addEventListener('DOMContentLoaded', () => {
       if (typeof window.clearDeletions === 'function') {
         window.clearDeletions();
       }
-      if (typeof window.saveToLocalStorage === 'function') {
-        localStorage.removeItem('scoreEdits');
+      if (typeof window.clearSession === 'function') {
+        window.clearSession();
       }
       
       // ✅ CORREGIDO: Resetear estado del reproductor
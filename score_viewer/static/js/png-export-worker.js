@@ -0,0 +1,24 @@
+// ====== WORKER DE EXPORTACIÓN PNG ======
+// Recibe cada tile de la partitura ya rasterizado (ImageBitmap transferido desde
+// editing.js), lo compone sobre fondo blanco en un OffscreenCanvas y lo codifica a
+// PNG fuera del hilo principal. Un tile cada vez: el canvas se libera al terminar.
+
+self.onmessage = async (event) => {
+  const { id, bitmap } = event.data;
+  try {
+    const canvas = new OffscreenCanvas(bitmap.width, bitmap.height);
+    const ctx = canvas.getContext('2d');
+    ctx.fillStyle = 'white';
+    ctx.fillRect(0, 0, canvas.width, canvas.height);
+    ctx.drawImage(bitmap, 0, 0);
+    bitmap.close();
+
+    const blob = await canvas.convertToBlob({ type: 'image/png' });
+    canvas.width = canvas.height = 0;  // soltar el buffer de píxeles ya
+    const bytes = new Uint8Array(await blob.arrayBuffer());
+    self.postMessage({ id, bytes }, [bytes.buffer]);
+  } catch (e) {
+    if (bitmap) bitmap.close();
+    self.postMessage({ id, error: e.message || String(e) });
+  }
+};
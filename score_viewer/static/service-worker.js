@@ -1,9 +1,16 @@
-const CACHE_NAME = 'score-viewer-v1';
+const CACHE_NAME = 'score-viewer-v5';
+
+// Caché de renders (/render-xml) direccionada por el hash del código (header X-Code-Hash)
+const RENDER_CACHE_NAME = 'score-viewer-renders-v1';
+const RENDER_CACHE_MAX_BYTES = 20 * 1024 * 1024;
+const RENDER_CACHE_MAX_ENTRIES = 100;
+const RENDER_CACHE_INDEX_URL = '/__render-cache__/index';
 const urlsToCache = [
   '/',
   '/static/css/style.css',
   '/static/js/main.js',
   '/static/js/editing.js',
+  '/static/js/png-export-worker.js',
   '/static/js/interact.min.js',
   '/static/js/opensheetmusicdisplay.min.js',
   '/static/fonts/BravuraText.otf',
@@ -16,8 +23,7 @@ const urlsToCache = [
   'https://cdnjs.cloudflare.com/ajax/libs/codemirror/5.65.2/codemirror.min.js',
   'https://cdnjs.cloudflare.com/ajax/libs/codemirror/5.65.2/mode/python/python.min.js',
   'https://cdnjs.cloudflare.com/ajax/libs/codemirror/5.65.2/addon/display/placeholder.min.js',
-  'https://cdn.jsdelivr.net/npm/soundfont-player@0.12.0/dist/soundfont-player.min.js',
-  'https://unpkg.com/@tonejs/midi'
+  'https://cdn.jsdelivr.net/npm/soundfont-player@0.12.0/dist/soundfont-player.min.js'
 ];
 
 // Instalación - cachear archivos
@@ -43,7 +49,7 @@ self.addEventListener('activate', event => {
     caches.keys().then(cacheNames => {
       return Promise.all(
         cacheNames.map(cacheName => {
-          if (cacheName !== CACHE_NAME) {
+          if (cacheName !== CACHE_NAME && cacheName !== RENDER_CACHE_NAME) {
             console.log('[SW] Eliminando caché viejo:', cacheName);
             return caches.delete(cacheName);
           }
@@ -54,20 +60,130 @@ self.addEventListener('activate', event => {
   self.clients.claim();
 });
 
+// ====== CACHÉ DE RENDERS (STALE-WHILE-REVALIDATE + LRU) ======
+// El cliente envía X-Code-Hash (SHA-256 del cuerpo de la petición). Si hay copia se
+// responde al instante y se revalida contra el servidor en segundo plano; el índice
+// LRU (bytes y último uso por hash) limita tamaño y número de entradas.
+let renderIndex = null;                 // hash → { bytes, lastUsed }
+let renderIndexQueue = Promise.resolve(); // serializa lecturas/escrituras del índice
+
+function renderCacheKey(codeHash) {
+  return `/__render-cache__/${codeHash}`;
+}
+
+function updateRenderIndex(mutate) {
+  renderIndexQueue = renderIndexQueue.then(async () => {
+    const cache = await caches.open(RENDER_CACHE_NAME);
+    if (!renderIndex) {
+      const stored = await cache.match(RENDER_CACHE_INDEX_URL);
+      renderIndex = stored ? await stored.json() : {};
+    }
+    const evicted = mutate(renderIndex) || [];
+
+    // Límite de tamaño y de entradas: descartar las menos usadas recientemente
+    const entries = Object.entries(renderIndex).sort((a, b) => a[1].lastUsed - b[1].lastUsed);
+    let total = entries.reduce((sum, [, meta]) => sum + meta.bytes, 0);
+    let count = entries.length;
+    for (const [hash, meta] of entries) {
+      if (total <= RENDER_CACHE_MAX_BYTES && count <= RENDER_CACHE_MAX_ENTRIES) break;
+      delete renderIndex[hash];
+      evicted.push(hash);
+      total -= meta.bytes;
+      count--;
+    }
+
+    await Promise.all(evicted.map(hash => cache.delete(renderCacheKey(hash))));
+    await cache.put(RENDER_CACHE_INDEX_URL, new Response(JSON.stringify(renderIndex), {
+      headers: { 'Content-Type': 'application/json' }
+    }));
+    if (evicted.length > 0) {
+      console.log(`[SW] Renders descartados (LRU): ${evicted.length}`);
+    }
+  }).catch(err => console.error('[SW] Error actualizando índice de renders:', err));
+  return renderIndexQueue;
+}
+
+async function storeRender(codeHash, response) {
+  const body = await response.clone().arrayBuffer();
+  const cache = await caches.open(RENDER_CACHE_NAME);
+  await cache.put(renderCacheKey(codeHash), response);
+  await updateRenderIndex(index => {
+    index[codeHash] = { bytes: body.byteLength, lastUsed: Date.now() };
+  });
+}
+
+// Solo se guardan renders correctos (no errores, ni 429 del control de admisión)
+function isCacheableRender(response) {
+  const type = response.headers.get('Content-Type') || '';
+  return response.status === 200 && type.includes('musicxml');
+}
+
+async function notifyClients(message) {
+  const clients = await self.clients.matchAll({ type: 'window' });
+  clients.forEach(client => client.postMessage(message));
+}
+
+async function revalidateRender(codeHash, networkRequest, cachedContentHash) {
+  try {
+    const response = await fetch(networkRequest);
+    if (!isCacheableRender(response)) return;
+    await storeRender(codeHash, response.clone());
+    const contentHash = response.headers.get('X-Content-Hash');
+    if (contentHash && contentHash !== cachedContentHash) {
+      notifyClients({ type: 'render-updated', codeHash, contentHash });
+    }
+  } catch (err) {
+    console.log('[SW] Revalidación pendiente (servidor no disponible):', err.message);
+  }
+}
+
+async function handleRenderRequest(event, codeHash) {
+  const networkRequest = event.request.clone();
+  const cache = await caches.open(RENDER_CACHE_NAME);
+  const cached = await cache.match(renderCacheKey(codeHash));
+
+  if (cached) {
+    // Stale-while-revalidate: responder ya y refrescar en segundo plano
+    event.waitUntil(Promise.all([
+      revalidateRender(codeHash, networkRequest, cached.headers.get('X-Content-Hash')),
+      updateRenderIndex(index => {
+        if (index[codeHash]) index[codeHash].lastUsed = Date.now();
+      })
+    ]));
+    const headers = new Headers(cached.headers);
+    headers.set('X-Render-Cache', 'hit');
+    return new Response(cached.body, { status: cached.status, statusText: cached.statusText, headers });
+  }
+
+  const response = await fetch(networkRequest);
+  if (isCacheableRender(response)) {
+    event.waitUntil(storeRender(codeHash, response.clone()));
+  }
+  return response;
+}
+
 // Fetch - estrategia de caché
 self.addEventListener('fetch', event => {
   const { request } = event;
   const url = new URL(request.url);
 
+  // Renders con hash de código: caché propia
+  const codeHash = request.headers.get('X-Code-Hash');
+  if (request.method === 'POST' && url.pathname === '/render-xml' && codeHash) {
+    event.respondWith(handleRenderRequest(event, codeHash));
+    return;
+  }
+
   // Para API requests (POST), siempre usar red
   if (request.method === 'POST') {
     event.respondWith(fetch(request));
     return;
   }
 
-  // Para assets estáticos, usar Cache First
+  // Para assets estáticos y muestras versionadas de soundfont, usar Cache First
   if (
     url.pathname.startsWith('/static/') ||
+    (url.pathname.startsWith('/soundfont/') && url.searchParams.has('v')) ||
     url.hostname.includes('cdnjs.cloudflare.com') ||
     url.hostname.includes('cdn.jsdelivr.net') ||
     url.hostname.includes('unpkg.com')
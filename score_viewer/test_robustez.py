@@ -14,7 +14,12 @@ from app import (
     safe_create_chord_symbol,
     normalize_to_score,
     deduplicate_in_memory,
-    to_musicxml_string
+    to_musicxml_string,
+    run_music21_snippet_any,
+    compile_snippet,
+    AdmissionController,
+    AdmissionRejected,
+    app
 )
 from music21 import stream, note, chord, expressions, harmony
 
@@ -173,6 +178,1036 @@ def test_export_musicxml():
     
     return True
 
+def test_apply_edits_xml_exact_ids():
+    """Test de ediciones XML por índice de IDs exactos"""
+    print("\n=== Test: /apply-edits-xml con índice exacto ===")
+    
+    xml = """<?xml version="1.0" encoding="UTF-8"?>
+<score-partwise version="4.0">
+  <part id="P1">
+    <measure number="1">
+      <direction placement="above"><direction-type><words>Hola mundo</words></direction-type></direction>
+      <direction placement="above"><direction-type><words>Hola</words></direction-type></direction>
+      <direction placement="below"><direction-type><words>Hola</words></direction-type></direction>
+    </measure>
+  </part>
+</score-partwise>"""
+    
+    edits = {
+        "Hola-1": {"xTenths": 10, "yTenths": 20},
+        "temp_Hola-mundo_1700000000000": {"xTenths": 5, "yTenths": 6},
+        "inexistente-0": {"xTenths": 1, "yTenths": 1},
+    }
+    
+    client = app.test_client()
+    resp = client.post('/apply-edits-xml', json={"xml_content": xml, "edits": edits})
+    assert resp.status_code == 200, "Debe responder 200"
+    
+    import json
+    import xml.etree.ElementTree as ET
+    report = {r["id"]: r["status"] for r in json.loads(resp.headers['X-Edit-Report'])}
+    print(f"  Reporte: {report}")
+    assert report["Hola-1"] == "applied"
+    assert report["temp_Hola-mundo_1700000000000"] == "applied"
+    assert report["inexistente-0"] == "not_found"
+    assert resp.headers['X-Edits-Missing'] == "1"
+    
+    root = ET.fromstring(resp.get_data(as_text=True).split('\n', 2)[2])
+    directions = root.findall('.//direction')
+    # "Hola" NO debe mover "Hola mundo" (antes se comparaba por subcadena)
+    assert directions[0].get('default-x') == '5', "'Hola mundo' recibe su propia edición"
+    assert directions[1].get('default-x') is None, "Primera 'Hola' intacta"
+    assert directions[2].get('default-x') == '10', "Segunda 'Hola' (Hola-1) editada"
+    assert 'X-Edit-Report-Truncated' not in resp.headers
+    
+    # Lote grande: la cabecera se acota (solo fallos) y el informe completo va en JSON
+    many = {f"inexistente-{i}": {"xTenths": i, "yTenths": i} for i in range(600)}
+    many["Hola-1"] = {"xTenths": 1, "yTenths": 1}
+    resp = client.post('/apply-edits-xml', json={"xml_content": xml, "edits": many})
+    assert resp.headers['X-Edit-Report-Truncated'] == '1'
+    assert len(resp.headers['X-Edit-Report']) <= 4096
+    assert all(r["status"] == "not_found" for r in json.loads(resp.headers['X-Edit-Report']))
+    body = client.post('/apply-edits-xml', json={"xml_content": xml, "edits": many, "report": "json"}).get_json()
+    assert len(body["report"]) == 601 and body["applied"] == 1 and body["xml"].startswith("<?xml")
+    
+    # /apply-edits: el mismo temp_ en edits y deletions es el mismo elemento
+    temp_id = "temp_Hola_1700000000001"
+    resp = client.post('/apply-edits', json={"xml_content": xml, "edits": {temp_id: {"x": 3, "y": 4}},
+                                             "deletions": [temp_id]})
+    directions = ET.fromstring(resp.get_data(as_text=True).split('\n', 2)[2]).findall('.//direction')
+    words = [d.findtext('.//words') for d in directions]
+    print(f"  Tras editar y borrar {temp_id}: {words}")
+    assert words == ["Hola mundo", "Hola"], "Se borra la 'Hola' editada, no la siguiente"
+    assert all(d.get('default-x') is None for d in directions), "Ninguna otra dirección movida"
+    
+    # Ids sintéticos que coinciden: /apply-edits mueve el cifrado y el título, no la dirección
+    clash = """<score-partwise version="4.0"><work><work-title>Coral</work-title></work>
+<part id="P1"><measure number="1">
+<direction><direction-type><words>Cmaj7</words></direction-type></direction>
+<direction><direction-type><words>Coral</words></direction-type></direction>
+<harmony><root><root-step>C</root-step></root><kind text="maj7">major-seventh</kind></harmony>
+</measure></part></score-partwise>"""
+    resp = client.post('/apply-edits', json={"xml_content": clash, "edits": {
+        "Cmaj7-0": {"x": 1, "y": 2}, "Coral-0": {"x": 3, "y": 4}}})
+    moved = ET.fromstring(resp.get_data(as_text=True).split('\n', 2)[2])
+    assert moved.find('.//harmony').get('default-x') == '1'
+    assert moved.find('.//work-title').get('default-x') == '3'
+    assert all(d.get('default-x') is None for d in moved.findall('.//direction'))
+    
+    print("✅ Test de índice exacto pasado")
+    return True
+
+def test_apply_patch_delta():
+    """Test del protocolo delta (/apply-patch)"""
+    print("\n=== Test: Protocolo delta /apply-patch ===")
+    
+    xml = """<?xml version="1.0" encoding="UTF-8"?>
+<score-partwise version="4.0">
+  <part id="P1">
+    <measure number="1">
+      <direction><direction-type><words>Hola</words></direction-type></direction>
+      <direction><direction-type><words>Adiós</words></direction-type></direction>
+    </measure>
+  </part>
+</score-partwise>"""
+    
+    client = app.test_client()
+    ops = [{"op": "set-attribute", "id": "Hola-0", "attr": "default-x", "value": "12"}]
+    
+    # Base desconocida sin XML → 409
+    resp = client.post('/apply-patch', json={"base_hash": "desconocido", "ops": ops})
+    assert resp.status_code == 409, "Base desconocida debe devolver 409"
+    
+    # Fallback con XML completo
+    resp = client.post('/apply-patch', json={"base_hash": "desconocido", "ops": ops, "xml_content": xml})
+    data = resp.get_json()
+    assert resp.status_code == 200 and data["full_transfer"], "Debe aceptar transferencia completa"
+    assert data["changes"] == [{"op": "set-attribute", "path": [0, 0, 0], "attr": "default-x", "value": "12"}]
+    print(f"  Cambios: {data['changes']}")
+    
+    # Parche sobre la nueva base, sin XML: borrar e insertar
+    ops = [
+        {"op": "delete", "id": "Adiós-0"},
+        {"op": "insert", "parent": "P1/1", "xml": "<direction id='d9'><direction-type><words>Nuevo</words></direction-type></direction>"},
+        {"op": "delete", "id": "inexistente"},
+    ]
+    resp = client.post('/apply-patch', json={"base_hash": data["hash"], "ops": ops})
+    patched = resp.get_json()
+    assert resp.status_code == 200 and not patched["full_transfer"], "La base debe estar en el almacén"
+    assert [c["op"] for c in patched["changes"]] == ["delete", "insert"]
+    assert patched["changes"][1]["path"] == [0, 0] and patched["changes"][1]["index"] == 1
+    assert patched["report"][2]["status"] == "not_found"
+    
+    # El documento completo sigue disponible por hash
+    full = client.get(f"/document/{patched['hash']}").get_data(as_text=True)
+    assert 'default-x="12"' in full and 'Nuevo' in full and 'Adiós' not in full
+    
+    # Hash de contenido: el mismo resultado por otra secuencia de ops comparte id,
+    # y coincide con el de subir ese XML tal cual
+    from app import content_hash
+    assert patched["hash"] == content_hash(full)
+    twice = [{"op": "set-attribute", "id": "Hola-0", "attr": "default-x", "value": "7"},
+             {"op": "set-attribute", "id": "Hola-0", "attr": "default-x", "value": "12"}]
+    again = client.post('/apply-patch', json={"base_hash": "desconocido", "ops": twice, "xml_content": xml}).get_json()
+    assert again["hash"] == data["hash"]
+    
+    # Un id borrado antes en el mismo lote ya no existe: ni set-attribute ni insert
+    # sobre él (ni sobre lo que contenía) producen cambios con ruta de nodo suelto
+    ops = [
+        {"op": "delete", "id": "Hola-0"},
+        {"op": "set-attribute", "id": "Hola-0", "attr": "default-x", "value": "5"},
+        {"op": "insert", "parent": "Hola-0", "xml": "<offset>1</offset>"},
+        {"op": "delete", "id": "P1/1"},
+        {"op": "insert", "after": "Adiós-0", "xml": "<direction/>"},
+        {"op": "insert", "parent": "P1/1", "xml": "<direction/>"},
+    ]
+    gone = client.post('/apply-patch', json={"base_hash": data["hash"], "ops": ops}).get_json()
+    print(f"  Tras borrar: {[r['status'] for r in gone['report']]}")
+    assert [r["status"] for r in gone["report"]] == ["applied", "not_found", "not_found",
+                                                    "applied", "not_found", "not_found"]
+    assert [c["op"] for c in gone["changes"]] == ["delete", "delete"]
+    assert all(c["path"] for c in gone["changes"]), "Ningún cambio apunta a la raíz"
+    
+    # Copia en escritura: la base queda intacta y lo no tocado se comparte con ella
+    import app as app_module
+    base_xml = client.get(f"/document/{data['hash']}").get_data(as_text=True)
+    two = xml.replace("</part>", "</part><part id='P2'><measure number='1'/></part>")
+    data = client.post('/apply-patch', json={"base_hash": "x", "ops": ops, "xml_content": two}).get_json()
+    base_root = app_module.get_stored_root(data["base_hash"])
+    new_root = app_module.get_stored_root(data["hash"])
+    assert new_root is not base_root and new_root[1] is base_root[1], "P2 no se tocó: debe compartirse"
+    assert new_root[0] is not base_root[0] and len(base_root[0][0]) == 2
+    assert client.get(f"/document/{patched['base_hash']}").get_data(as_text=True) == base_xml
+    
+    # Almacén acotado por bytes aproximados además de por número de documentos
+    saved = app_module.XML_STORE_MAX_BYTES
+    try:
+        app_module.XML_STORE_MAX_BYTES = len(xml) * app_module.XML_STORE_BYTES_PER_CHAR * 2
+        hashes = [app_module.store_xml_document(xml.replace("Hola", f"Hola{i}")) for i in range(4)]
+        assert app_module.get_stored_xml(hashes[0]) is None and app_module.get_stored_xml(hashes[3])
+        assert app_module._xml_store_bytes <= app_module.XML_STORE_MAX_BYTES
+        print(f"  Almacén: {len(app_module._xml_store)} documento(s), {app_module._xml_store_bytes} bytes aprox.")
+    finally:
+        app_module.XML_STORE_MAX_BYTES = saved
+    
+    print("✅ Test de protocolo delta pasado")
+    return True
+
+def test_snippet_preprocessor():
+    """Test del pre-procesado AST del snippet y su caché"""
+    print("\n=== Test: Pre-procesado AST del snippet ===")
+    
+    code = """from music21 import harmony
+from music21 import stream, note, harmony
+# score.metadata = no cuenta (comentario)
+score = stream.Score()
+score.metadata.title = "Prueba"
+p = stream.Part()
+m = stream.Measure(number=1)
+c1 = harmony.ChordSymbol("XXX###")
+c1.id = "c1"
+n1 = note.Note("C4", quarterLength=4)
+n1.id = "n1"
+m.append(n1)
+m.insert(0, c1)
+p.append(m)
+score.append(p)
+"""
+    xml, warnings, err, line_map = run_music21_snippet_any(code)
+    
+    # harmony filtrado del import → SafeChordSymbol degrada el cifrado inválido a texto
+    assert err is None, f"No debe fallar: {err}"
+    assert "XXX###" in xml, "Cifrado inválido mostrado como texto"
+    
+    # metadata auto-inicializada
+    assert "Metadata inicializada automáticamente para 'score'" in warnings
+    assert "Prueba" in xml
+    
+    # Líneas del código ORIGINAL (0-based)
+    print(f"  Mapeo: c1 → {line_map.get('c1')}, n1 → {line_map.get('n1')}")
+    assert line_map.get("c1") == 7 and line_map.get("n1") == 9
+    
+    # Caché por hash: mismo code object y mismos warnings en la segunda ejecución
+    assert compile_snippet(code) is compile_snippet(code), "Debe reutilizar el code object"
+    _, warnings_again, _, _ = run_music21_snippet_any(code)
+    assert warnings_again == warnings
+    
+    # Con metadata inicializada por el usuario no se añade nada
+    _, warnings_init, _, _ = run_music21_snippet_any(
+        "from music21 import stream, metadata\n"
+        "score = stream.Score()\n"
+        "score.insert(0, metadata.Metadata())\n"
+        "score.metadata.title = 'X'\n"
+    )
+    assert not any("Metadata inicializada" in w for w in warnings_init)
+    
+    # Errores de sintaxis se devuelven como error, no como excepción
+    _, _, err, _ = run_music21_snippet_any("x = (")
+    assert err and "SyntaxError" in err
+    
+    print("✅ Test de pre-procesado AST pasado")
+    return True
+
+def test_admission_control():
+    """Test del control de admisión: prioridades y rechazo por saturación"""
+    print("\n=== Test: Control de admisión ===")
+    import threading
+    import time
+    
+    controller = AdmissionController({
+        'ADMISSION_MAX_IN_FLIGHT': 1,
+        'ADMISSION_MAX_QUEUE': 2,
+        'ADMISSION_QUEUE_TIMEOUT': 5.0,
+        'ADMISSION_CPU_LIMIT': None,
+        'ADMISSION_RSS_LIMIT_MB': None,
+    })
+    first, _ = controller.acquire('export')
+    order = []
+    
+    def worker(priority):
+        ticket, _ = controller.acquire(priority)
+        order.append(priority)
+        controller.release(ticket)
+    
+    threads = [threading.Thread(target=worker, args=(p,)) for p in ('batch', 'interactive')]
+    for t in threads:
+        t.start()
+        time.sleep(0.05)
+    
+    # Cola llena → rechazo inmediato con Retry-After
+    try:
+        controller.acquire('interactive')
+        assert False, "Debe rechazar con la cola llena"
+    except AdmissionRejected as e:
+        assert e.retry_after >= 1
+    
+    snapshot = controller.snapshot()
+    print(f"  Estado: {snapshot['in_flight']} en curso, cola {snapshot['queue_depth_by_priority']}")
+    assert snapshot['queue_depth'] == 2 and snapshot['rejected'] == 1
+    
+    controller.release(first)
+    for t in threads:
+        t.join()
+    
+    print(f"  Orden de admisión: {order}")
+    assert order == ['interactive', 'batch'], "interactive debe adelantar a batch"
+    
+    # Guarda de RSS del proceso: con el techo ya superado no se mata a nadie, y lo
+    # nuevo solo espera si hay peticiones en curso que puedan liberar memoria
+    from app import _current_rss_bytes, _thread_cpu_time
+    assert _current_rss_bytes() > 0 and _thread_cpu_time(threading.get_ident()) is not None
+    guarded = AdmissionController({
+        'ADMISSION_MAX_IN_FLIGHT': 2,
+        'ADMISSION_MAX_QUEUE': 2,
+        'ADMISSION_QUEUE_TIMEOUT': 0.3,
+        'ADMISSION_CPU_LIMIT': None,
+        'ADMISSION_RSS_LIMIT_MB': 1,
+    })
+    ticket, info = guarded.acquire('interactive')  # nada en curso: se admite
+    try:
+        guarded.acquire('interactive')
+        assert False, "Con RSS sobre el techo y una petición en curso debe esperar"
+    except AdmissionRejected:
+        pass
+    time.sleep(0.3)
+    assert info['aborted'] is None, "Ya estaba sobre el techo al entrar: no es atribuible"
+    guarded.release(ticket)
+    
+    # Un fallo justo tras admitir (diagnóstico de memoria, perfilado) no pierde el hueco
+    from app import admission, memory_diagnostics
+    original_begin = memory_diagnostics.begin
+    def failing_begin():
+        raise RuntimeError("fallo simulado")
+    memory_diagnostics.begin = failing_begin
+    try:
+        resp = app.test_client().post('/render-xml', json={"code": "score = None"})
+        assert resp.status_code == 500
+        resp.close()
+    finally:
+        memory_diagnostics.begin = original_begin
+    assert admission.snapshot()['in_flight'] == 0, "El hueco debe liberarse"
+    
+    print("✅ Test de control de admisión pasado")
+    return True
+
+def test_render_batch():
+    """Test del render por lotes (/render-batch)"""
+    print("\n=== Test: Render por lotes ===")
+    import io
+    import json
+    import zipfile
+    
+    items = [
+        {"name": "escala", "code": "from music21 import note\nn = note.Note('C4')"},
+        {"name": "roto", "code": "x = ("},
+        {"name": "escala", "xml": "<?xml version='1.0'?><score-partwise version='4.0'/>"},
+    ]
+    client = app.test_client()
+    
+    # Manifiesto JSON: los errores por elemento no hacen fallar el lote
+    resp = client.post('/render-batch', json={"items": items})
+    data = resp.get_json()
+    assert resp.status_code == 200
+    assert [e["ok"] for e in data["items"]] == [True, False, True]
+    assert [e["name"] for e in data["items"]] == ["escala", "roto", "escala_2"]
+    assert "SyntaxError" in data["items"][1]["error"]
+    assert "score-partwise" in data["items"][0]["xml"]
+    print(f"  JSON: {data['ok']} ok, {data['failed']} con error")
+    
+    # ZIP en streaming con MusicXML + MIDI + manifest.json
+    resp = client.post('/render-batch', json={"items": items[:2], "formats": ["musicxml", "midi"], "output": "zip"})
+    archive = zipfile.ZipFile(io.BytesIO(resp.data))
+    print(f"  ZIP: {archive.namelist()}")
+    assert set(archive.namelist()) == {"escala.musicxml", "escala.mid", "manifest.json"}
+    assert archive.read("escala.mid").startswith(b"MThd")
+    assert json.loads(archive.read("manifest.json"))["failed"] == 1
+    resp.close()  # la respuesta en streaming libera su hueco al cerrarse
+    
+    # Cada proceso del pool cuenta en la admisión: al terminar no queda ningún hueco tomado
+    from app import admission, _get_batch_pool
+    assert admission.snapshot()["in_flight"] == 0
+    assert _get_batch_pool()._mp_context.get_start_method() == "spawn"
+    
+    # Huecos extra: solo si hay sitio libre, y se pueden liberar sin hilo asociado
+    tickets = []
+    while True:
+        ticket = admission.try_acquire('batch')
+        if ticket is None:
+            break
+        tickets.append(ticket)
+    assert len(tickets) == admission.snapshot()["max_in_flight"]
+    for ticket in tickets:
+        admission.release(ticket)
+    assert admission.snapshot()["in_flight"] == 0
+    print(f"  Huecos extra disponibles: {len(tickets)}")
+    
+    print("✅ Test de render por lotes pasado")
+    return True
+
+def test_batch_convert():
+    """Test del conversor por lotes sin interfaz (batch_convert.py)"""
+    print("\n=== Test: Conversor por lotes ===")
+    import contextlib
+    import io
+    import json
+    import tempfile
+    from app import render_batch_item
+    import batch_convert
+    
+    # Tres fuentes con el mismo nombre base: ninguna sobrescribe a otra
+    sources = [("/in/a.py", "a.py"), ("/in/a.mid", "a.mid"), ("/in/b/a.mid", "a.mid"), ("/in/A.musicxml", "A.musicxml")]
+    targets = [os.path.basename(t) for _, t in batch_convert.plan_outputs(sources, "/out", ".musicxml")]
+    print(f"  Salidas: {targets}")
+    assert targets == ["a.musicxml", "a_mid.musicxml", "a_mid_2.musicxml", "A_musicxml.musicxml"]
+    
+    code = "from music21 import note\nn = note.Note('C4')"
+    xml = render_batch_item({"code": code})["xml"]
+    with tempfile.TemporaryDirectory() as tmp:
+        src, out = os.path.join(tmp, "in"), os.path.join(tmp, "out")
+        os.makedirs(os.path.join(src, "sub"))
+        inputs = [("a.py", code), ("a.musicxml", xml), ("a.xml", xml), ("sub/a.py", code), ("roto.py", "x = (")]
+        for relative, content in inputs:
+            with open(os.path.join(src, relative), "w", encoding="utf-8") as f:
+                f.write(content)
+        
+        def run():
+            buffer = io.StringIO()
+            with contextlib.redirect_stdout(buffer):
+                status = batch_convert.main([src, "-o", out, "--jobs", "2"])
+            return status, buffer.getvalue()
+        
+        # Primera pasada: un fallo no detiene el resto; código de salida 2
+        status, output = run()
+        assert status == 2, output
+        written = sorted(f for f in os.listdir(out) if not f.startswith("."))
+        print(f"  Escritos: {written}")
+        assert written == ["a.musicxml", "a_py.musicxml", "a_xml.musicxml", "sub"]
+        assert os.listdir(os.path.join(out, "sub")) == ["a.musicxml"]
+        assert "❌" in output and "roto.py" in output
+        with open(os.path.join(out, batch_convert.JOURNAL_NAME), encoding="utf-8") as f:
+            assert len(f.readlines()) == 4  # solo lo convertido entra en el diario
+        
+        # Reanudar: lo convertido se salta, el fallo se reintenta
+        status, output = run()
+        assert status == 2 and "1 pendiente(s), 4 ya convertido(s)" in output, output
+        
+        # Una salida borrada se vuelve a convertir aunque esté en el diario
+        os.remove(os.path.join(out, "a_py.musicxml"))
+        status, output = run()
+        assert "2 pendiente(s), 3 ya convertido(s)" in output, output
+        assert os.path.exists(os.path.join(out, "a_py.musicxml"))
+    
+    print("✅ Test del conversor por lotes pasado")
+    return True
+
+def test_layout_hints():
+    """Test de las pistas de layout calculadas en el export"""
+    print("\n=== Test: Pistas de layout ===")
+    import json
+    
+    code = """from music21 import stream, note, harmony
+score = stream.Score()
+p = stream.Part()
+m1 = stream.Measure(number=1)
+m1.insert(0, harmony.ChordSymbol("C"))
+for pitch in ["C4", "E4", "G4", "F#4"]:
+    m1.append(note.Note(pitch, quarterLength=1))
+m2 = stream.Measure(number=2)
+m2.append(note.Note("C5", quarterLength=4))
+p.append([m1, m2])
+score.append(p)
+"""
+    resp = app.test_client().post('/render-xml', json={"code": code})
+    assert resp.status_code == 200
+    hints = json.loads(resp.headers['X-Layout-Hints'])
+    print(f"  Pistas: {hints}")
+    
+    assert hints["parts"] == 1 and hints["measures"] == 2
+    assert hints["max_notes_per_measure"] == 4
+    assert hints["harmonies"] == 1 and hints["accidentals"] == 1
+    # Misma heurística que analyzeMusicXML: (100+60+20+10) + (100+15)
+    assert hints["total_complexity"] == 305
+    assert hints["avg_measure_width"] == 152.5
+    
+    print("✅ Test de pistas de layout pasado")
+    return True
+
+def test_measure_window():
+    """Test del render paginado por rango de compases"""
+    print("\n=== Test: Render paginado por compases ===")
+    from music21 import converter
+    
+    code = """from music21 import stream, note, meter, key, clef, tempo
+score = stream.Score()
+p = stream.Part()
+for i in range(1, 41):
+    m = stream.Measure(number=i)
+    if i == 1:
+        m.append([clef.BassClef(), key.Key('D'), meter.TimeSignature('3/4')])
+        m.insert(0, tempo.MetronomeMark(number=90))
+    if i == 20:
+        m.append(meter.TimeSignature('2/4'))
+    m.append(note.Note('D3', quarterLength=3 if i < 20 else 2))
+    p.append(m)
+score.append(p)
+"""
+    client = app.test_client()
+    resp = client.post('/render-xml', json={"code": code, "measure_start": 1, "measure_count": 16})
+    assert resp.status_code == 200
+    assert (resp.headers['X-Measure-End'], resp.headers['X-Measure-Total']) == ('16', '40')
+    assert resp.data.count(b'<measure ') == 16
+    
+    # Página siguiente desde el almacén, sin volver a ejecutar el snippet
+    doc_hash = resp.headers['X-Content-Hash']
+    page = client.get(f'/document/{doc_hash}/measures?start=25&count=20')
+    assert page.headers['X-Measure-End'] == '40'
+    
+    # Documento independiente con clave, armadura, compás y tempo vigentes
+    window = converter.parseData(page.data.decode('utf-8'))
+    first = window.parts[0].getElementsByClass('Measure').first()
+    print(f"  Primer compás de la ventana: {first.number}, {first.clef}, {first.keySignature}, {first.timeSignature}")
+    assert first.number == 25
+    assert first.clef.sign == 'F'
+    assert first.keySignature.sharps == 2
+    assert first.timeSignature.ratioString == '2/4'
+    assert window.metronomeMarkBoundaries()[0][2].number == 90
+    
+    assert client.get(f'/document/{doc_hash}/measures?start=0').status_code == 400
+    assert client.get('/document/desconocido/measures').status_code == 404
+    
+    print("✅ Test de render paginado pasado")
+    return True
+
+def test_playback_events():
+    """Test de los eventos de nota binarios para reproducción"""
+    print("\n=== Test: Eventos de reproducción ===")
+    import array
+    import struct
+    
+    code = """from music21 import stream, note, chord, tempo, tie, harmony
+score = stream.Score()
+p = stream.Part()
+p.append(tempo.MetronomeMark(number=60))
+p.insert(0, harmony.ChordSymbol("C"))
+n1 = note.Note("C4", quarterLength=2)
+n1.tie = tie.Tie("start")
+n2 = note.Note("C4", quarterLength=2)
+n2.tie = tie.Tie("stop")
+p.append([n1, n2, chord.Chord(["E4", "G4"], quarterLength=4)])
+score.append(p)
+"""
+    resp = app.test_client().post('/playback-events', json={"code": code, "include_chords": True})
+    assert resp.status_code == 200
+    data = resp.data
+    magic, count, tracks, total = struct.unpack('<4sIIf', data[:16])
+    onsets = array.array('f', data[16:16 + 4 * count])
+    durations = array.array('f', data[16 + 4 * count:16 + 8 * count])
+    base = 16 + 8 * count
+    pitches = list(data[base:base + count])
+    track_ids = list(data[base + 2 * count:base + 3 * count])
+    print(f"  {count} eventos, {tracks} pistas: {list(zip(onsets, durations, pitches, track_ids))}")
+    
+    assert magic == b'SVEV' and len(data) == 16 + 11 * count
+    assert tracks == 2 and total == 8.0
+    # Ligadura fundida en una sola nota de 4 s (negra = 1 s a 60 BPM)
+    assert (onsets[pitches.index(60)], durations[pitches.index(60)]) == (0.0, 4.0)
+    assert onsets[pitches.index(64)] == 4.0
+    assert sorted(p for p, t in zip(pitches, track_ids) if t == 1) == [48, 52, 55]
+    assert list(onsets) == sorted(onsets)
+    
+    print("✅ Test de eventos de reproducción pasado")
+    return True
+
+def test_local_soundfont():
+    """Test de los soundfonts locales servidos nota a nota"""
+    print("\n=== Test: Soundfonts locales ===")
+    import base64
+    import tempfile
+    
+    samples = {"A0": b"muestra-a0", "Bb1": b"muestra-bb1", "C4": b"muestra-c4"}
+    body = ",\n".join(
+        f'"{name}": "data:audio/mp3;base64,{base64.b64encode(data).decode()}"'
+        for name, data in samples.items()
+    )
+    previous_dir = app.config['SOUNDFONT_DIR']
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "test_piano-mp3.js"), "w", encoding="utf-8") as f:
+            f.write("if (typeof(MIDI) === 'undefined') var MIDI = {};\n"
+                    f"MIDI.Soundfont.test_piano = {{\n{body}\n}}\n")
+        app.config['SOUNDFONT_DIR'] = tmp
+        try:
+            client = app.test_client()
+            manifest = client.get('/soundfont/test_piano').get_json()
+            print(f"  Manifest: {manifest}")
+            assert manifest["notes"] == [21, 34, 60]
+            
+            resp = client.get(f'/soundfont/test_piano/34?v={manifest["version"]}')
+            assert resp.status_code == 200 and resp.data == b"muestra-bb1"
+            assert resp.mimetype == "audio/mp3"
+            assert "immutable" in resp.headers["Cache-Control"]
+            
+            assert client.get('/soundfont/test_piano/61').status_code == 404
+            assert client.get('/soundfont/no_instalado').status_code == 404
+        finally:
+            app.config['SOUNDFONT_DIR'] = previous_dir
+    
+    print("✅ Test de soundfonts locales pasado")
+    return True
+
+def test_export_audio():
+    """Test del render de audio WAV con sintetizador vectorizado"""
+    print("\n=== Test: Exportación de audio ===")
+    import io
+    import wave
+    
+    code = """from music21 import stream, note, tempo, harmony
+score = stream.Score()
+p = stream.Part()
+p.append(tempo.MetronomeMark(number=120))
+p.insert(0, harmony.ChordSymbol("Am"))
+p.append([note.Note("A4", quarterLength=2), note.Note("C5", quarterLength=2)])
+score.append(p)
+"""
+    client = app.test_client()
+    resp = client.post('/export-audio', json={
+        "code": code, "include_chords": True, "sample_rate": 22050, "instrument": "strings"
+    })
+    assert resp.status_code == 200 and resp.mimetype == 'audio/wav'
+    
+    with wave.open(io.BytesIO(resp.data)) as wav:
+        frames = wav.readframes(wav.getnframes())
+        seconds = wav.getnframes() / wav.getframerate()
+        print(f"  {seconds:.2f}s, {wav.getframerate()} Hz, {wav.getnchannels()} canal(es)")
+        assert wav.getframerate() == 22050 and wav.getsampwidth() == 2
+        # 2 s de notas a 120 BPM + release de la voz
+        assert 2.0 < seconds < 3.0
+    assert any(frames)
+    resp.close()  # libera el hueco de admisión del streaming
+    
+    assert client.post('/export-audio', json={"code": code, "instrument": "theremin"}).status_code == 400
+    
+    print("✅ Test de exportación de audio pasado")
+    return True
+
+def test_analyze():
+    """Test del análisis armónico vectorizado (/analyze)"""
+    print("\n=== Test: Análisis armónico ===")
+    
+    code = """from music21 import stream, note, chord, meter
+score = stream.Score()
+p = stream.Part()
+for i, pitches in enumerate([["A3", "C4", "E4"], ["D4", "F4", "A4"], ["E4", "G#4", "B4", "D5"], ["A3", "C4", "E4"]], 1):
+    m = stream.Measure(number=i)
+    if i == 1:
+        m.append(meter.TimeSignature("4/4"))
+    m.append(chord.Chord(pitches, quarterLength=2))
+    m.append(note.Note(pitches[0], quarterLength=2))
+    p.append(m)
+score.append(p)
+"""
+    client = app.test_client()
+    resp = client.post('/analyze', json={"code": code})
+    assert resp.status_code == 200 and resp.headers['X-Analysis-Cache'] == 'miss'
+    data = resp.get_json()
+    labels = [m["chord"]["label"] for m in data["measures"]]
+    print(f"  Tonalidad: {data['key']['name']}, cifrados: {labels}")
+    
+    assert data["key"]["name"] == "A minor"
+    assert labels == ["Am", "Dm", "E7", "Am"]
+    assert [m["number"] for m in data["measures"]] == ["1", "2", "3", "4"]
+    assert [m["first_onset"] for m in data["measures"]] == [0.0, 4.0, 8.0, 12.0]
+    assert abs(sum(data["histogram"]) - 1.0) < 1e-3
+    
+    # Segunda petición por hash: desde la caché, sin volver a analizar
+    again = client.post('/analyze', json={"hash": data["hash"]})
+    assert again.headers['X-Analysis-Cache'] == 'hit'
+    assert again.get_json()["measures"] == data["measures"]
+    assert client.post('/analyze', json={"hash": "desconocido"}).status_code == 404
+    
+    print("✅ Test de análisis armónico pasado")
+    return True
+
+def test_transpose():
+    """Test de la transposición directa sobre MusicXML (/transpose)"""
+    print("\n=== Test: Transposición XML ===")
+    import json
+    
+    # Clarinete en Si bemol (escrito): Fa mayor, Bb4 y F#4 con alteración visible
+    xml = """<?xml version="1.0" encoding="UTF-8"?>
+<score-partwise version="4.0"><part-list><score-part id="P1"><part-name>Cl</part-name></score-part></part-list>
+<part id="P1"><measure number="1"><attributes><divisions>1</divisions><key><fifths>-1</fifths></key>
+<transpose><diatonic>-1</diatonic><chromatic>-2</chromatic></transpose></attributes>
+<harmony><root><root-step text="F">F</root-step></root><kind>major</kind><bass><bass-step>A</bass-step></bass></harmony>
+<note><pitch><step>B</step><alter>-1</alter><octave>4</octave></pitch><duration>1</duration><accidental>flat</accidental></note>
+<note><pitch><step>F</step><alter>1</alter><octave>4</octave></pitch><duration>1</duration><accidental>sharp</accidental></note>
+<note><rest/><duration>2</duration></note></measure></part></score-partwise>"""
+    client = app.test_client()
+    
+    # Escrito → sonido real: una 2ª mayor descendente, con ortografía por intervalo
+    resp = client.post('/transpose', json={"xml_content": xml, "to_concert": True})
+    assert resp.status_code == 200
+    concert = resp.data.decode('utf-8')
+    report = json.loads(resp.headers['X-Transpose-Report'])
+    print(f"  Informe: {report}")
+    assert report == {"notes": 2, "keys": 1, "harmonies": 1, "parts": 1, "keys_respelled": 0}
+    assert "<fifths>-3</fifths>" in concert and "<transpose>" not in concert
+    assert "<step>A</step><alter>-1</alter><octave>4</octave>" in concert
+    assert "<step>E</step><octave>4</octave></pitch><duration>1</duration><accidental>natural</accidental>" in concert
+    assert '<root-step text="Eb">E</root-step><root-alter>-1</root-alter>' in concert
+    assert "<bass-step>G</bass-step>" in concert
+    
+    # Vuelta a escrito desde el almacén: se recupera el documento original
+    back = client.post('/transpose', json={"hash": resp.headers['X-Content-Hash'], "to_written": {"P1": "M-2"}})
+    assert "".join(back.data.decode('utf-8').split()) == "".join(xml.split())
+    
+    # Intervalo compuesto: cambio de octava y armadura nueva
+    up = client.post('/transpose', json={"xml_content": xml, "interval": "A8"})
+    assert "<step>B</step><octave>5</octave>" in up.data.decode('utf-8')
+    assert "<fifths>6</fifths>" in up.data.decode('utf-8')
+    
+    # Armadura reescrita (F♯ mayor + M2 = G♯, 8 sostenidos → A♭ mayor): notas y cifrados
+    # con el intervalo enarmónico (3ª disminuida), concordando con la armadura
+    sharp = """<score-partwise version="4.0"><part id="P1">
+<measure number="1"><attributes><key><fifths>6</fifths></key></attributes>
+<harmony><root><root-step text="F#">F</root-step><root-alter>1</root-alter></root><kind>major</kind></harmony>
+<note><pitch><step>F</step><alter>1</alter><octave>4</octave></pitch></note>
+<note><pitch><step>E</step><alter>1</alter><octave>4</octave></pitch></note></measure>
+<measure number="2"><attributes><key><fifths>0</fifths></key></attributes>
+<note><pitch><step>C</step><octave>5</octave></pitch></note></measure></part></score-partwise>"""
+    resp = client.post('/transpose', json={"xml_content": sharp, "interval": "M2"})
+    respelled = resp.data.decode('utf-8')
+    assert json.loads(resp.headers['X-Transpose-Report'])["keys_respelled"] == 1
+    assert "<fifths>-4</fifths>" in respelled
+    assert "<step>A</step><alter>-1</alter><octave>4</octave>" in respelled, "F♯ → A♭, no G♯"
+    assert "<step>G</step><octave>4</octave>" in respelled, "E♯ → G (sensible de A♭)"
+    assert '<root-step text="Ab">A</root-step><root-alter>-1</root-alter>' in respelled
+    # La armadura siguiente (C → D) vuelve al intervalo normal
+    assert "<fifths>2</fifths>" in respelled and "<step>D</step><octave>5</octave>" in respelled
+    
+    assert client.post('/transpose', json={"xml_content": xml, "interval": "M5"}).status_code == 400
+    assert client.post('/transpose', json={"hash": "desconocido"}).status_code == 409
+    
+    print("✅ Test de transposición XML pasado")
+    return True
+
+def test_element_index():
+    """Test del índice de elementos por documento (/document/<hash>/index)"""
+    print("\n=== Test: Índice de elementos ===")
+    
+    xml = """<?xml version="1.0" encoding="UTF-8"?>
+<score-partwise version="4.0">
+  <part id="P1">
+    <measure number="1">
+      <attributes><divisions>2</divisions></attributes>
+      <note><pitch><step>C</step><octave>4</octave></pitch><duration>2</duration></note>
+      <direction id="t1"><direction-type><words>Hola</words></direction-type></direction>
+      <harmony><root><root-step>G</root-step></root><kind text="7">dominant</kind></harmony>
+      <note><pitch><step>G</step><octave>4</octave></pitch><duration>2</duration></note>
+    </measure>
+  </part>
+</score-partwise>"""
+    
+    client = app.test_client()
+    doc_hash = client.post('/render-xml', json={"xml": xml}).headers['X-Content-Hash']
+    
+    resp = client.get(f"/document/{doc_hash}/index")
+    assert resp.status_code == 200
+    elements = resp.get_json()["elements"]
+    print(f"  Entradas: {sorted(elements)}")
+    assert elements["t1"]["kind"] == "direction" and elements["t1"]["part"] == "P1"
+    assert elements["t1"]["measure"] == "1" and elements["t1"]["offset"] == 1.0
+    assert elements["t1"]["path"] == [0, 0, 2]
+    assert elements["G7-0"]["kind"] == "harmony" and elements["G7-0"]["offset"] == 1.0
+    
+    measure = client.get(f"/document/{doc_hash}/element/P1/1").get_json()
+    assert measure["kind"] == "measure" and measure["path"] == [0, 0]
+    assert client.get(f"/document/{doc_hash}/element/inexistente").status_code == 404
+    assert client.get("/document/desconocido/index").status_code == 404
+    
+    # Los endpoints de edición resuelven por hash con el índice cacheado
+    patched = client.post('/apply-patch', json={"base_hash": doc_hash, "ops": [
+        {"op": "set-attribute", "id": "t1", "attr": "default-y", "value": "30"},
+        {"op": "delete", "id": "G7-0"}]}).get_json()
+    assert [c["path"] for c in patched["changes"]] == [[0, 0, 2], [0, 0, 3]]
+    edited = client.post('/apply-edits-xml', json={"hash": doc_hash, "edits": {"t1": {"xTenths": 5}}})
+    assert edited.status_code == 200 and 'default-x="5"' in edited.get_data(as_text=True)
+    
+    # El documento base del almacén no se modifica
+    base = client.get(f"/document/{doc_hash}").get_data(as_text=True)
+    assert "default-y" not in base and "default-x" not in base and "<harmony>" in base
+    
+    print("✅ Test de índice de elementos pasado")
+    return True
+
+def test_memory_diagnostics():
+    """Test del diagnóstico de memoria opt-in (/debug/memory)"""
+    print("\n=== Test: Diagnóstico de memoria ===")
+    from app import memory_diagnostics
+    
+    client = app.test_client()
+    code = "s = stream.Score()\np = stream.Part()\np.append(note.Note('C4', quarterLength=4))\ns.insert(0, p)\nscore = s"
+    
+    # Desactivado por defecto: sin cabeceras ni volcado
+    assert not client.get('/debug/memory').get_json()["enabled"]
+    assert 'X-Memory-Peak-Mb' not in client.post('/render-xml', json={"code": code}).headers
+    
+    saved = {k: app.config[k] for k in ('MEMORY_GROWTH_WINDOW', 'MEMORY_GROWTH_WARN_MB')}
+    app.config.update(MEMORY_GROWTH_WINDOW=2, MEMORY_GROWTH_WARN_MB=-1024)  # aviso garantizado
+    try:
+        assert client.post('/debug/memory', json={"enabled": True}).get_json()["enabled"]
+        for _ in range(2):
+            resp = client.post('/render-xml', json={"code": code})
+            assert resp.status_code == 200 and float(resp.headers['X-Memory-Peak-Mb']) > 0
+        
+        dump = client.get('/debug/memory?limit=5').get_json()
+        print(f"  RSS {dump['rss_mb']}MB, pico {dump['peak_mb']}MB, Score vivos {dump['live_scores']}")
+        assert len(dump["top_sites"]) == 5 and dump["last_render_diff"]
+        assert isinstance(dump["live_scores"], int) and dump["growth_warnings"] >= 1
+        
+        # El aviso lo completa el hilo muestreador (gc.collect fuera de la petición)
+        import time
+        deadline = time.time() + 5
+        while memory_diagnostics.last_warning is None and time.time() < deadline:
+            time.sleep(0.05)
+        warning = memory_diagnostics.last_warning
+        print(f"  Aviso en segundo plano: {warning}")
+        assert warning is not None and isinstance(warning["live_scores"], int)
+        assert memory_diagnostics._sampler.name == "memory-sampler"
+        assert client.get('/debug/memory?group=otro').status_code == 400
+    finally:
+        app.config.update(saved)
+        client.post('/debug/memory', json={"enabled": False})
+    assert not memory_diagnostics.enabled
+    
+    print("✅ Test de diagnóstico de memoria pasado")
+    return True
+
+def test_request_profiling():
+    """Test del perfilado bajo demanda (X-Profile / ?profile=)"""
+    print("\n=== Test: Perfilado por petición ===")
+    import marshal
+    
+    client = app.test_client()
+    code = "s = stream.Score()\np = stream.Part()\nfor i in range(64):\n    p.append(note.Note(60 + i % 12))\ns.insert(0, p)\nscore = s"
+    
+    # Sin marca: ni perfilador ni cabeceras
+    assert 'X-Profile-Id' not in client.post('/render-xml', json={"code": code}).headers
+    
+    # Muestreo: pilas colapsadas que parten de la vista
+    resp = client.post('/render-xml', json={"code": code}, headers={"X-Profile": "1"})
+    assert resp.status_code == 200 and resp.data.lstrip().startswith(b"<?xml")
+    url = resp.headers['X-Profile-Url']
+    collapsed = client.get(url).get_data(as_text=True)
+    print(f"  {url}: {len(collapsed.splitlines())} pilas distintas")
+    assert collapsed.startswith("render_xml (app.py:")
+    stack, count = collapsed.splitlines()[0].rsplit(" ", 1)
+    assert int(count) > 0
+    tree = client.get(url + "?format=json").get_json()["tree"]
+    assert tree["children"][0]["name"].startswith("render_xml")
+    assert client.get(url + "?format=prof").status_code == 400
+    
+    # Determinista: pstats y .prof exportable
+    resp = client.post('/export-midi?profile=cprofile', json={"code": code})
+    assert resp.status_code == 200
+    url = resp.headers['X-Profile-Url']
+    assert "(export_midi)" in client.get(url).get_data(as_text=True)
+    assert isinstance(marshal.loads(client.get(url + "?format=prof").data), dict)
+    
+    # Se puede deshabilitar por configuración
+    app.config['PROFILING_ALLOWED'] = False
+    try:
+        resp = client.post('/render-xml', json={"code": code}, headers={"X-Profile": "sample"})
+        assert 'X-Profile-Id' not in resp.headers
+    finally:
+        app.config['PROFILING_ALLOWED'] = True
+    assert client.get('/debug/profile/desconocido').status_code == 404
+    
+    print("✅ Test de perfilado por petición pasado")
+    return True
+
+def test_mxl_roundtrip():
+    """Test de .mxl de extremo a extremo (subida, descarga y snippet)"""
+    print("\n=== Test: MusicXML comprimido (.mxl) ===")
+    import io
+    import zipfile
+    from app import iter_mxl_chunks, read_mxl
+    
+    client = app.test_client()
+    code = "s = stream.Score()\np = stream.Part()\nfor i in range(200):\n    p.append(note.Note(60 + i % 12))\ns.insert(0, p)\nscore = s"
+    plain = client.post('/export-xml', json={"code": code})
+    
+    # Descarga comprimida en streaming, con 'mimetype' sin comprimir en primer lugar
+    resp = client.post('/export-xml', json={"code": code, "format": "mxl"})
+    assert resp.status_code == 200 and resp.mimetype == 'application/vnd.recordare.musicxml'
+    assert resp.headers['Content-Disposition'].endswith('.mxl')
+    mxl = resp.data
+    resp.close()
+    print(f"  {len(plain.data)} bytes → {len(mxl)} bytes comprimido")
+    assert len(mxl) * 5 < len(plain.data)
+    with zipfile.ZipFile(io.BytesIO(mxl)) as zf:
+        first = zf.infolist()[0]
+        assert first.filename == 'mimetype' and first.compress_type == zipfile.ZIP_STORED
+        assert zf.read('mimetype') == b'application/vnd.recordare.musicxml'
+    xml_text = read_mxl(mxl)
+    assert xml_text.startswith('<?xml') and xml_text.count('<note') == plain.data.count(b'<note') == 200
+    
+    # Subida binaria sin JSON ni base64 (también por multipart)
+    resp = client.post('/render-xml?measure_start=2&measure_count=3', data=mxl,
+                       content_type='application/vnd.recordare.musicxml')
+    assert resp.status_code == 200 and resp.headers['X-Measure-Start'] == '2'
+    doc_hash = resp.headers['X-Content-Hash']
+    resp = client.post('/render-xml', data={"file": (io.BytesIO(mxl), "partitura.mxl")},
+                       content_type='multipart/form-data')
+    assert resp.headers['X-Content-Hash'] == doc_hash
+    
+    # Descarga comprimida de un documento del almacén
+    stored = client.get(f"/document/{doc_hash}?format=mxl")
+    assert read_mxl(stored.data) == xml_text
+    stored.close()
+    
+    # Variable 'mxl' en el snippet
+    snippet = f"mxl = {b''.join(iter_mxl_chunks(plain.data.decode('utf-8')))!r}"
+    assert client.post('/render-xml', json={"code": snippet}).status_code == 200
+    
+    bad = client.post('/render-xml', data=b'PK\x03\x04basura', content_type='application/zip')
+    assert bad.status_code == 400
+    
+    # Subida sin comprimir que empieza por un comentario: válida, y un campo 'xml'
+    # del formulario no sustituye al fichero
+    commented = b"<!-- exportado -->\n" + xml_text.split('?>', 1)[1].encode('utf-8')
+    resp = client.post('/render-xml', data={"file": (io.BytesIO(commented), "p.musicxml"), "xml": "<?xml?><otro/>"},
+                       content_type='multipart/form-data')
+    assert resp.status_code == 200 and resp.data.startswith(b"<!-- exportado -->")
+    assert client.post('/render-xml', data=b'hola', content_type='text/xml').status_code == 400
+    
+    print("✅ Test de MusicXML comprimido pasado")
+    return True
+
+def test_notation_fast_path():
+    """Test de la vía rápida de finalize_notation (compases ya notados)"""
+    print("\n=== Test: Vía rápida de notación ===")
+    import json
+    from music21 import converter, meter
+    from app import finalize_notation
+    
+    def build_score(third_measure=None):
+        score = stream.Score()
+        part = stream.Part()
+        for number in range(1, 9):
+            measure = stream.Measure(number=number)
+            if number == 1:
+                measure.append(meter.TimeSignature('4/4'))
+            notes = third_measure if number == 3 and third_measure else ['C4', 'D4', 'E4', 'G4']
+            for name in notes:
+                measure.append(note.Note(name, quarterLength=4 / len(notes)))
+            part.append(measure)
+        score.insert(0, part)
+        return score
+    
+    # Compases explícitos, negras diatónicas: nada que hacer
+    score = build_score()
+    report = {}
+    finalize_notation(score, report)
+    print(f"  Negras diatónicas: {report}")
+    assert report == {'measures': 8, 'skipped': 8, 'local': 0, 'full': 0}
+    
+    # Corcheas sin barras y una alteración: retoque del compás, sin makeNotation completo
+    score = build_score(['C4', 'F#4', 'E4', 'G4', 'C4', 'D4', 'E4', 'G4'])
+    report = {}
+    finalize_notation(score, report)
+    print(f"  Corcheas con alteración: {report}")
+    third = score.parts[0].getElementsByClass(stream.Measure)[2].notes
+    assert report == {'measures': 8, 'skipped': 7, 'local': 1, 'full': 0}
+    assert third[0].beams.beamsList and third[1].pitch.accidental.displayStatus
+    
+    # Parte con barras por hacer (streamStatus) y un compás barrado solo en parte:
+    # no cuenta como ya barrado
+    score = build_score(['C4', 'D4', 'E4', 'G4', 'C4', 'D4', 'E4', 'G4'])
+    third = score.parts[0].getElementsByClass(stream.Measure)[2].notes
+    third[0].beams.fill('eighth', 'start')
+    third[1].beams.fill('eighth', 'stop')
+    score.parts[0].streamStatus.beams = False
+    report = {}
+    finalize_notation(score, report)
+    print(f"  Barras parciales: {report}")
+    assert report == {'measures': 8, 'skipped': 7, 'local': 1, 'full': 0}
+    assert all(n.beams.beamsList for n in third), "makeBeams completa las barras del compás"
+    
+    # MusicXML leído: barras y alteraciones se respetan tal cual
+    xml = to_musicxml_string(score)
+    parsed = converter.parse(xml, format='musicxml')
+    report = {}
+    finalize_notation(parsed, report)
+    assert report['skipped'] == report['measures'] == 8
+    
+    # Una blanca con puntillo que desborda el compás: makeNotation completo (ligaduras)
+    resp = app.test_client().post('/render-xml', json={
+        "code": "s = stream.Score()\np = stream.Part()\nfor i in range(3):\n    p.append(note.Note('C4', quarterLength=3))\ns.insert(0, p)\nscore = s"})
+    notation = json.loads(resp.headers['X-Notation-Report'])
+    print(f"  Desborde de compás: {notation}")
+    assert notation['full'] == notation['measures'] and '<tie type="start"' in resp.get_data(as_text=True)
+    
+    print("✅ Test de vía rápida de notación pasado")
+    return True
+
+def test_metrics_endpoint():
+    """Test del endpoint /metrics (formato de texto Prometheus)"""
+    print("\n=== Test: Métricas Prometheus ===")
+    import re
+    
+    client = app.test_client()
+    
+    def scrape():
+        text = client.get('/metrics').get_data(as_text=True)
+        samples = {}
+        for line in text.splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return text, samples
+    
+    _, before = scrape()
+    code = "s = stream.Score()\np = stream.Part()\nfor i in range(16):\n    p.append(note.Note(60 + i % 12))\ns.insert(0, p)\nscore = s"
+    ok_key = 'score_viewer_http_requests_total{method="POST",route="/render-xml",status="200"}'
+    error_key = 'score_viewer_render_errors_total{cause="snippet"}'
+    for _ in range(2):
+        client.post('/render-xml', json={"code": code}).close()
+    client.post('/render-xml', json={"code": "raise ValueError('roto')"}).close()
+    client.post('/validate-chord', json={"chord": "Cmaj7"}).close()
+    
+    resp = client.get('/metrics')
+    assert resp.status_code == 200 and resp.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    text, after = scrape()
+    print(f"  {len(after)} muestras, {text.count('# TYPE')} familias")
+    
+    # Contadores y latencias por ruta (plantilla de la ruta, no la URL)
+    assert after[ok_key] - before.get(ok_key, 0) == 2
+    assert after[error_key] - before.get(error_key, 0) == 1
+    assert after['score_viewer_http_requests_in_flight{route="/render-xml"}'] == 0
+    count = after['score_viewer_http_request_duration_seconds_count{route="/validate-chord"}']
+    assert after['score_viewer_http_request_duration_seconds_bucket{route="/validate-chord",le="+Inf"}'] == count
+    
+    # Etapas del pipeline y caché de snippets (el segundo render reutiliza el compilado)
+    for stage in ('compile', 'exec', 'normalize', 'notation', 'export'):
+        assert after[f'score_viewer_pipeline_stage_duration_seconds_count{{stage="{stage}"}}'] > 0
+    assert after['score_viewer_cache_requests_total{cache="snippet",result="hit"}'] >= 1
+    assert 0 < after['score_viewer_cache_hit_ratio{cache="snippet"}'] <= 1
+    
+    # Familias declaradas aunque no tengan muestras; histogramas con cubos crecientes
+    assert '# TYPE score_viewer_render_fallback_scores_total counter' in text
+    buckets = [float(v) for v in re.findall(r'duration_seconds_bucket\{route="/render-xml",le="[^"]+"\} (\S+)', text)]
+    assert buckets == sorted(buckets)
+    assert buckets[-1] == after['score_viewer_http_request_duration_seconds_count{route="/render-xml"}']
+    
+    app.config['METRICS_ENABLED'] = False
+    try:
+        assert client.get('/metrics').status_code == 404
+    finally:
+        app.config['METRICS_ENABLED'] = True
+    
+    print("✅ Test de métricas pasado")
+    return True
+
 def run_all_tests():
     """Ejecuta todos los tests"""
     print("\n" + "="*60)
@@ -185,6 +1220,25 @@ def run_all_tests():
         "Normalización a Score": test_normalize_to_score(),
         "Deduplicación en Memoria": test_deduplicate_in_memory(),
         "Exportación a MusicXML": test_export_musicxml(),
+        "Ediciones XML por ID exacto": test_apply_edits_xml_exact_ids(),
+        "Protocolo delta": test_apply_patch_delta(),
+        "Pre-procesado AST del snippet": test_snippet_preprocessor(),
+        "Control de admisión": test_admission_control(),
+        "Render por lotes": test_render_batch(),
+        "Conversor por lotes": test_batch_convert(),
+        "Pistas de layout": test_layout_hints(),
+        "Render paginado por compases": test_measure_window(),
+        "Eventos de reproducción": test_playback_events(),
+        "Soundfonts locales": test_local_soundfont(),
+        "Exportación de audio": test_export_audio(),
+        "Análisis armónico": test_analyze(),
+        "Transposición XML": test_transpose(),
+        "Índice de elementos": test_element_index(),
+        "Diagnóstico de memoria": test_memory_diagnostics(),
+        "Perfilado por petición": test_request_profiling(),
+        "MusicXML comprimido (.mxl)": test_mxl_roundtrip(),
+        "Vía rápida de notación": test_notation_fast_path(),
+        "Métricas Prometheus": test_metrics_endpoint(),
     }
     
     print("\n" + "="*60)